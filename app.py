@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, has_request_context, Response, stream_with_context, g, abort, before_render_template, template_rendered
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
@@ -6,18 +6,41 @@ from functools import wraps
 import os
 from pathlib import Path
 import shutil
+import gzip
 import io
+import json
+import uuid
+import hashlib
+import re
+import logging
+from logging.handlers import RotatingFileHandler
+import hmac
+import heapq
+import bisect
+import cProfile
+import tempfile
+import csv
+import time
+import queue
+import atexit
+import mimetypes
 import xlsxwriter
-from openpyxl import Workbook, load_workbook
+from openpyxl import load_workbook
 from contextlib import contextmanager
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
-from threading import Thread
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+from threading import Thread, Lock, Event, BoundedSemaphore
 from flask_mail import Mail, Message
+import click
 from werkzeug.utils import secure_filename
+try:
+    import brotli
+except ImportError:  # optional: without it, assets are precompressed with gzip only
+    brotli = None
 import os
 
 # Initialize Flask app
@@ -25,49 +48,761 @@ app = Flask(__name__)
 app.secret_key = 'your_secure_secret_key_here'
 
 # Email Configuration
-app.config['MAIL_SERVER'] = 'smtp.example.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = 'your_email@example.com'
-app.config['MAIL_PASSWORD'] = 'your_email_password'
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.example.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
+app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'your_email@example.com')
+app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'your_email_password')
 app.config['MAIL_DEFAULT_SENDER'] = 'inventory@yourdomain.com'
 app.config['ADMINS'] = ['admin@yourdomain.com']
 app.config['LOW_STOCK_THRESHOLD'] = 10
 app.config['EXPIRING_SOON_DAYS'] = 30
+app.config['DASHBOARD_CACHE_TTL'] = 10
+app.config['ALERT_DIGEST_INTERVAL'] = 60
+app.config['ALERT_SWEEP_INTERVAL'] = 24 * 3600
+
+# Listings, API and documents
+app.config['MOVEMENTS_PER_PAGE'] = 50
+app.config['MOVEMENTS_MAX_PER_PAGE'] = 500
+app.config['API_PAGE_SIZE'] = 100
+app.config['API_MAX_PAGE_SIZE'] = 1000
+app.config['RECEIPT_CACHE_MAX_BYTES'] = 200 * 1024 * 1024
+app.config['RECEIPT_CACHE_MAX_AGE'] = 24 * 3600
+app.config['CLIENT_PDF_MAX_ROWS'] = 5000
+app.config['CLIENT_PDF_CHUNK_ROWS'] = 500
+
+# Full-history client statements (see StatementExporter)
+app.config['EXPORT_QUEUE_SIZE'] = 20
+app.config['EXPORT_WORKERS'] = 2
+app.config['EXPORT_MAX_AGE'] = 24 * 3600
+
+# Outbound mail queue (see MailQueue)
+app.config['MAIL_QUEUE_SIZE'] = 200
+app.config['MAIL_WORKERS'] = 1
+app.config['MAIL_BATCH_SIZE'] = 20
+app.config['MAIL_MAX_RETRIES'] = 4
+app.config['MAIL_RETRY_BACKOFF'] = 2
+
+# SQLite connection pool (see ConnectionPool)
+app.config['DB_POOL_SIZE'] = 16  # connections open at once, background threads included
+app.config['DB_POOL_TIMEOUT'] = 30  # seconds to wait for a free connection
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+app.config['DB_CACHE_SIZE_KB'] = 20000
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['DB_STATEMENT_CACHE_SIZE'] = 256
+app.config['DB_HEALTHCHECK_INTERVAL'] = 30
+
+# Backups (see backup_db and BackupScheduler)
+app.config['BACKUP_INTERVAL'] = 3600
+app.config['BACKUP_PAGES_PER_STEP'] = 1024
+app.config['BACKUP_STEP_SLEEP'] = 0.005
+app.config['BACKUP_KEEP_HOURLY'] = 24
+app.config['BACKUP_KEEP_DAILY'] = 7
+app.config['BACKUP_KEEP_WEEKLY'] = 8
+
+# Movements log (see ExcelLogWriter)
+app.config['EXCEL_LOG_BATCH_SIZE'] = 500
+app.config['EXCEL_LOG_COMPACT_INTERVAL'] = 300
+
+# Stock snapshots (see take_snapshots and SnapshotScheduler)
+app.config['SNAPSHOT_INTERVAL'] = 3600
+app.config['SNAPSHOT_LOTS_DAILY'] = False
+
+# Inventory reconciliation (see reconcile_inventory and ReconciliationScheduler)
+app.config['RECONCILE_INTERVAL'] = 300  # incremental check, 0 disables the scheduler
+app.config['RECONCILE_FULL_INTERVAL'] = 24 * 3600
+app.config['RECONCILE_AUTO_REPAIR'] = False
+app.config['RECONCILE_KEEP_RUNS'] = 500
+
+# Movement writes (see MovementWriter)
+app.config['MOVEMENT_WRITER_BATCH'] = 64
+app.config['MOVEMENT_WRITER_RETRIES'] = 5
+app.config['MOVEMENT_WRITER_BACKOFF'] = 0.05  # seconds, doubled on each retry
+app.config['MOVEMENT_WRITER_TIMEOUT'] = 30
+app.config['DELIVERY_NOTE_MAX_LINES'] = 200
+
+# Static assets (see build_assets); served from ASSET_DIR once built
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+app.config['ASSET_SOURCES'] = ('css', 'js', 'img')  # folders of static/ that are fingerprinted
+app.config['ASSET_COMPRESS_TYPES'] = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+
+# Profile pictures (see store_avatar and ThumbnailWorker)
+app.config['AVATAR_MAX_BYTES'] = 5 * 1024 * 1024
+app.config['AVATAR_SIZES'] = {'small': 64, 'medium': 256}  # square thumbnails, in pixels
+app.config['AVATAR_CACHE_MAX_AGE'] = 365 * 24 * 3600
+
+# Profiling (see RequestProfiler); off unless FROZEN_PROFILING=1
+app.config['PROFILING_ENABLED'] = os.environ.get('FROZEN_PROFILING', '0') == '1'
+app.config['PROFILING_TRACE_THRESHOLD'] = float(os.environ.get('FROZEN_PROFILING_TRACE_THRESHOLD', 0))  # seconds, 0 disables
+app.config['PROFILING_MAX_TRACES'] = 50
+app.config['METRICS_TOKEN'] = os.environ.get('FROZEN_METRICS_TOKEN', '')
+
+# Slow-query log (see SlowQueryLog)
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.environ.get('FROZEN_SLOW_QUERY_MS', 0))  # 0 disables
+app.config['SLOW_QUERY_QUEUE_SIZE'] = 1000
+app.config['SLOW_QUERY_LOG_MAX_BYTES'] = 2 * 1024 * 1024
+app.config['SLOW_QUERY_LOG_BACKUPS'] = 5
 
 mail = Mail(app)
 
 # Database Configuration
-DATA_DIR = Path.home() / "frozen_management_data"
+DATA_DIR = Path(os.environ.get('FROZEN_DATA_DIR', Path.home() / "frozen_management_data"))
 DB_PATH = DATA_DIR / "frozen.db"
 EXCEL_LOG_PATH = DATA_DIR / "movements_log.xlsx"
+EXCEL_LOG_DIR = DATA_DIR / "movements_log"
+EXCEL_LOG_STATE_PATH = EXCEL_LOG_DIR / "last_id"
 BACKUP_DIR = DATA_DIR / "backups"
+RECEIPT_CACHE_DIR = DATA_DIR / "receipt_cache"
+EXPORT_DIR = DATA_DIR / "exports"
+PROFILE_DIR = DATA_DIR / "profiles"
+SLOW_QUERY_LOG_PATH = DATA_DIR / "slow_queries.log"
+ARCHIVE_DIR = DATA_DIR / "archive"
+AVATAR_DIR = DATA_DIR / "avatars"
 LOGO_PATH = Path(__file__).parent / "static" / "img" / "logo.png"
+ASSET_DIR = Path(__file__).parent / "static" / "dist"
+ASSET_MANIFEST_PATH = ASSET_DIR / "manifest.json"
 
 # Ensure directories exist
-DATA_DIR.mkdir(exist_ok=True)
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 BACKUP_DIR.mkdir(exist_ok=True)
+RECEIPT_CACHE_DIR.mkdir(exist_ok=True)
+EXPORT_DIR.mkdir(exist_ok=True)
+AVATAR_DIR.mkdir(exist_ok=True)
 
 # Context processor to make current year available in templates
 @app.context_processor
 def inject_now():
     return {'now': datetime.now()}
 
+# Static Assets
+# {static path: fingerprinted path under ASSET_DIR}, empty until build_assets has run
+_asset_manifest = {}
+# Its values, which are the only paths /assets serves
+_asset_files = set()
+
+def load_asset_manifest():
+    _asset_manifest.clear()
+    if ASSET_MANIFEST_PATH.exists():
+        _asset_manifest.update(json.loads(ASSET_MANIFEST_PATH.read_text()))
+    _asset_files.clear()
+    _asset_files.update(_asset_manifest.values())
+
+def build_assets():
+    """Copies the ASSET_SOURCES files of static/ into ASSET_DIR under content-hashed names.
+
+    css/style.css becomes css/style.<hash>.css, so its URL changes exactly
+    when its content does and can be cached forever. Text assets also get
+    .gz and, when the brotli package is installed, .br siblings, compressed
+    once here instead of per request. Files of earlier builds are removed
+    and manifest.json maps each static path to its copy. Returns the manifest.
+    """
+    static_dir = Path(app.static_folder)
+    manifest = {}
+    written = set()
+    for source in app.config['ASSET_SOURCES']:
+        for path in sorted((static_dir / source).rglob('*')):
+            if not path.is_file():
+                continue
+            content = path.read_bytes()
+            name = path.relative_to(static_dir).as_posix()
+            fingerprinted = f"{name[:-len(path.suffix)] if path.suffix else name}.{hashlib.sha256(content).hexdigest()[:12]}{path.suffix}"
+            target = ASSET_DIR / fingerprinted
+            variants = {target: content}
+            if path.suffix in app.config['ASSET_COMPRESS_TYPES']:
+                variants[target.with_name(target.name + '.gz')] = gzip.compress(content, compresslevel=9, mtime=0)
+                if brotli:
+                    variants[target.with_name(target.name + '.br')] = brotli.compress(content, quality=11)
+            for variant, data in variants.items():
+                # Same name, same content: an unchanged asset is not rewritten
+                if not variant.exists():
+                    variant.parent.mkdir(parents=True, exist_ok=True)
+                    temp_path = variant.with_name(f"temp_{uuid.uuid4().hex}_{variant.name}")
+                    temp_path.write_bytes(data)
+                    os.replace(str(temp_path), str(variant))
+                written.add(variant)
+            manifest[name] = fingerprinted
+
+    temp_path = ASSET_MANIFEST_PATH.with_name(f"temp_{ASSET_MANIFEST_PATH.name}")
+    temp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(str(temp_path), str(ASSET_MANIFEST_PATH))
+    written.add(ASSET_MANIFEST_PATH)
+    for path in ASSET_DIR.rglob('*'):
+        if path.is_file() and path not in written:
+            path.unlink()
+    load_asset_manifest()
+    return manifest
+
+def asset_url_for(endpoint, **values):
+    """url_for for templates: static files listed in the manifest resolve to their fingerprinted copy."""
+    if endpoint == 'static' and values.get('filename') in _asset_manifest:
+        values['filename'] = _asset_manifest[values['filename']]
+        endpoint = 'asset'
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = asset_url_for
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    # Only files of the current build; this also keeps paths inside ASSET_DIR
+    if filename not in _asset_files:
+        abort(404)
+    path, encoding = ASSET_DIR / filename, None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] and (ASSET_DIR / (filename + suffix)).exists():
+            path, encoding = ASSET_DIR / (filename + suffix), candidate
+            break
+    response = send_file(str(path), mimetype=mimetypes.guess_type(filename)[0],
+                         max_age=app.config['ASSET_MAX_AGE'], conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static assets into static/dist."""
+    manifest = build_assets()
+    for name, fingerprinted in sorted(manifest.items()):
+        click.echo(f'{name} -> {fingerprinted}')
+    if not brotli:
+        click.echo('brotli non installé: variantes gzip uniquement', err=True)
+
+# Profiling
+PROFILE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROFILE_METRICS = {
+    'request': ('frozen_request_duration_seconds', 'Time to handle a request'),
+    'sql': ('frozen_sql_duration_seconds', 'SQL execute, fetch and commit time per request'),
+    'template': ('frozen_template_render_seconds', 'Jinja rendering time per request'),
+    'pdf': ('frozen_pdf_build_seconds', 'ReportLab build time per request'),
+    'excel_log': ('frozen_excel_log_seconds', 'Movements log time per request'),
+}
+
+class RequestProfiler:
+    """Aggregates per-route timings into Prometheus-style histograms.
+
+    Each request gets one observation per section (sql, template, pdf,
+    excel_log) holding that section's total; sections may overlap, e.g. SQL
+    run while building a PDF counts in both. Work outside a request (the log
+    writer, background PDF jobs) is observed per call under route
+    "background". Requests slower than PROFILING_TRACE_THRESHOLD also get a
+    cProfile dump in PROFILE_DIR.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}  # (section, route) -> [bucket counts..., sum]
+        self.statements = {}  # route -> SQL statements run
+
+    def observe(self, section, route, seconds, statements=0):
+        with self.lock:
+            histogram = self.histograms.get((section, route))
+            if histogram is None:
+                histogram = self.histograms[(section, route)] = [0] * (len(PROFILE_BUCKETS) + 2)
+            histogram[bisect.bisect_left(PROFILE_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            if statements:
+                self.statements[route] = self.statements.get(route, 0) + statements
+
+    def record(self, section, seconds, statements=0):
+        if has_request_context() and 'profile' in g:
+            g.profile[section] = g.profile.get(section, 0) + seconds
+            g.profile['statements'] += statements
+        else:
+            self.observe(section, 'background', seconds, statements)
+
+    def begin_request(self):
+        g.profile = {'statements': 0}
+        g.profile_started = time.perf_counter()
+        if app.config['PROFILING_TRACE_THRESHOLD']:
+            g.profile_trace = cProfile.Profile()
+            try:
+                g.profile_trace.enable()
+            except ValueError:
+                # Another profiler is already active on this thread
+                g.profile_trace = None
+
+    def end_request(self):
+        elapsed = time.perf_counter() - g.profile_started
+        route = request.endpoint or 'unmatched'
+        self.observe('request', route, elapsed, g.profile['statements'])
+        for section in PROFILE_METRICS:
+            if section in g.profile:
+                self.observe(section, route, g.profile[section])
+
+        trace = g.pop('profile_trace', None)
+        if trace:
+            trace.disable()
+            if elapsed >= app.config['PROFILING_TRACE_THRESHOLD']:
+                self.dump_trace(trace, route, elapsed)
+        g.pop('profile')
+
+    def dump_trace(self, trace, route, elapsed):
+        try:
+            PROFILE_DIR.mkdir(exist_ok=True)
+            trace.dump_stats(PROFILE_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{route}_{int(elapsed * 1000)}ms.prof")
+            for old in self.traces()[app.config['PROFILING_MAX_TRACES']:]:
+                old.unlink()
+        except OSError as e:
+            print(f"Error writing profile trace: {str(e)}")
+
+    def traces(self):
+        # Newest first
+        return sorted(PROFILE_DIR.glob('*.prof'), reverse=True) if PROFILE_DIR.exists() else []
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.statements.clear()
+
+    def summary(self):
+        """Per-route rows for the admin page, slowest total time first."""
+        with self.lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            statements = dict(self.statements)
+        rows = []
+        for (section, route), histogram in histograms.items():
+            if section != 'request':
+                continue
+            count = sum(histogram[:-1])
+            p95 = self._quantile(histogram, 0.95)
+            row = {'route': route, 'count': count, 'total': histogram[-1],
+                   'mean_ms': histogram[-1] / count * 1000,
+                   'p95_ms': p95 * 1000 if p95 != float('inf') else None,
+                   'statements': statements.get(route, 0) / count}
+            for other in PROFILE_METRICS:
+                if other != 'request' and (other, route) in histograms:
+                    row[f'{other}_ms'] = histograms[(other, route)][-1] / count * 1000
+            rows.append(row)
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+    @staticmethod
+    def _quantile(histogram, q):
+        # Upper bound of the bucket holding the quantile, as Prometheus would report it
+        target = q * sum(histogram[:-1])
+        seen = 0
+        for bound, n in zip(PROFILE_BUCKETS + (float('inf'),), histogram[:-1]):
+            seen += n
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render_prometheus(self):
+        with self.lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            statements = dict(self.statements)
+        lines = []
+        for section, (name, help_text) in PROFILE_METRICS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for (key, route), histogram in sorted(histograms.items()):
+                if key != section:
+                    continue
+                cumulative = 0
+                for bound, n in zip(PROFILE_BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{route="{route}"}} {histogram[-1]:.6f}')
+                lines.append(f'{name}_count{{route="{route}"}} {cumulative}')
+
+        lines += ['# HELP frozen_sql_statements_total SQL statements executed',
+                  '# TYPE frozen_sql_statements_total counter']
+        lines += [f'frozen_sql_statements_total{{route="{route}"}} {n}' for route, n in sorted(statements.items())]
+
+        for key, value in mail_queue.metrics().items():
+            kind = 'gauge' if key in ('depth', 'capacity', 'max_depth') else 'counter'
+            name = f'frozen_mail_queue_{key}' if kind == 'gauge' else f'frozen_mail_{key}_total'
+            lines += [f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+profiler = RequestProfiler()
+
+def profiled(section):
+    """Adds the wrapped function's run time to `section` when profiling is on."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not app.config['PROFILING_ENABLED']:
+                return f(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profiler.record(section, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# Slow-query log
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def normalize_sql(sql):
+    """Collapses whitespace and replaces literals with ? so repeats group together."""
+    return ' '.join(SQL_LITERAL_RE.sub('?', sql).split())
+
+def parameters_shape(parameters, many=False):
+    if many:
+        if isinstance(parameters, (list, tuple)):
+            return f"{len(parameters)} x {parameters_shape(parameters[0]) if parameters else '()'}"
+        return 'iterator'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in parameters.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+
+class SlowQueryLog:
+    """Writes statements slower than SLOW_QUERY_THRESHOLD_MS to a rotating log.
+
+    Each line is a JSON object with the normalized SQL, the shape of its
+    parameters (never their values), the duration, the route and the
+    EXPLAIN QUERY PLAN output, so table scans show up as the data grows.
+    The plan is taken and the line written by a background thread, so a slow
+    request is not made slower; past SLOW_QUERY_QUEUE_SIZE pending entries,
+    new ones are dropped.
+    """
+    PLANNABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+    _STOP = object()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.logger = None
+        self.queue = None
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.queue = queue.Queue(app.config['SLOW_QUERY_QUEUE_SIZE'])
+            self.thread = Thread(target=self._run, name='slow-query-log', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except queue.Full:
+                return
+            self.thread.join(timeout)
+
+    def _get_logger(self):
+        with self.lock:
+            if self.logger is None:
+                handler = RotatingFileHandler(self.path,
+                                              maxBytes=app.config['SLOW_QUERY_LOG_MAX_BYTES'],
+                                              backupCount=app.config['SLOW_QUERY_LOG_BACKUPS'],
+                                              encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger = logging.getLogger('frozen.slow_queries')
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(handler)
+                self.logger = logger
+            return self.logger
+
+    def record(self, seconds, sql, parameters, many=False):
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'route': (request.endpoint or 'unmatched') if has_request_context() else 'background',
+            'duration_ms': round(seconds * 1000, 1),
+            'sql': normalize_sql(sql),
+            'params': parameters_shape(parameters, many),
+        }
+        # Copied, as callers may reuse their parameter list once we return
+        parameters = None if many else dict(parameters) if isinstance(parameters, dict) else tuple(parameters)
+        self.start()
+        try:
+            self.queue.put_nowait((entry, sql, parameters))
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._STOP:
+                    break
+                entry, sql, parameters = item
+                entry['plan'] = [] if parameters is None else self.explain(sql, parameters)
+                self._get_logger().info(json.dumps(entry, ensure_ascii=False))
+            except Exception as e:
+                print(f"Error writing slow-query log: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def explain(self, sql, parameters):
+        words = sql.split(None, 1)
+        if not words or words[0].upper() not in self.PLANNABLE:
+            return []
+        try:
+            with db_connection() as conn:
+                # Archived years the statement read from were attached on its own connection
+                years = {int(year) for year in re.findall(r'\barchive_(\d{4})\.', sql)}
+                if years:
+                    attach_archives(conn, [archive for archive in conn.execute('SELECT year, path FROM archives')
+                                           if archive['year'] in years])
+                # A plain cursor, so the EXPLAIN itself is not timed or logged
+                rows = conn.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except (sqlite3.Error, RuntimeError) as e:
+            return [f'EXPLAIN failed: {str(e)}']
+        depth = {}
+        plan = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            plan.append('  ' * depth[node_id] + detail)
+        return plan
+
+    def entries(self, limit=5000):
+        """Newest entries first, reading the rotated files as needed."""
+        paths = [self.path] + [Path(f'{self.path}.{n}') for n in range(1, app.config['SLOW_QUERY_LOG_BACKUPS'] + 1)]
+        entries = []
+        for path in paths:
+            if not path.exists():
+                continue
+            with open(path, encoding='utf-8') as f:
+                lines = f.readlines()
+            for line in reversed(lines):
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+                if len(entries) >= limit:
+                    return entries
+        return entries
+
+    def summary(self, entries):
+        """Groups entries by normalized SQL, largest total time first."""
+        groups = {}
+        for entry in entries:
+            group = groups.get(entry['sql'])
+            if group is None:
+                # Entries are newest first, so the first one seen has the latest plan
+                group = groups[entry['sql']] = {
+                    'sql': entry['sql'], 'params': entry['params'], 'plan': entry['plan'],
+                    'last_seen': entry['time'], 'count': 0, 'total_ms': 0, 'max_ms': 0, 'routes': set(),
+                    'full_scan': any(line.strip().startswith('SCAN ') and 'INDEX' not in line
+                                     for line in entry['plan']),
+                    'temp_sort': any('TEMP B-TREE' in line for line in entry['plan']),
+                }
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+            group['routes'].add(entry['route'])
+        return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG_PATH)
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports its timings to the profiler and the slow-query log.
+
+    A statement's time is its execute plus the fetch calls made for it, and it
+    is logged once, when that total first passes SLOW_QUERY_THRESHOLD_MS.
+    Rows read by iterating the cursor are not timed.
+    """
+    statement = None
+    elapsed = 0
+
+    def _timed(self, method, *args, statements=0):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - started
+            if app.config['PROFILING_ENABLED']:
+                profiler.record('sql', seconds, statements)
+            threshold = app.config['SLOW_QUERY_THRESHOLD_MS']
+            if self.statement is not None:
+                self.elapsed += seconds
+                if threshold and self.elapsed * 1000 >= threshold:
+                    slow_query_log.record(self.elapsed, *self.statement)
+                    self.statement = None
+
+    def execute(self, sql, parameters=()):
+        self.statement, self.elapsed = (sql, parameters), 0
+        return self._timed(super().execute, sql, parameters, statements=1)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement, self.elapsed = (sql, seq_of_parameters, True), 0
+        return self._timed(super().executemany, sql, seq_of_parameters, statements=1)
+
+    def executescript(self, sql_script):
+        self.statement, self.elapsed = (sql_script, ()), 0
+        return self._timed(super().executescript, sql_script, statements=1)
+
+    # Rows after the first are stepped while fetching
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose statements are timed (see ConnectionPool)."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        if not app.config['PROFILING_ENABLED']:
+            return super().commit()
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            profiler.record('sql', time.perf_counter() - started)
+
+@app.before_request
+def start_request_profile():
+    if app.config['PROFILING_ENABLED']:
+        profiler.begin_request()
+
+@app.teardown_request
+def finish_request_profile(exc):
+    if 'profile' in g:
+        profiler.end_request()
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    if 'profile' in g:
+        g.template_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    if 'profile' in g and 'template_started' in g:
+        profiler.record('template', time.perf_counter() - g.pop('template_started'))
+
+# Database Connection Pool
+class ConnectionPool:
+    """Reuses SQLite connections across requests and threads.
+
+    At most `size` connections are checked out at once; acquire waits up to
+    DB_POOL_TIMEOUT for one to be released. Idle connections are kept in a
+    LIFO queue so the most recently used (and warmest) one is handed out
+    first. A connection that sat idle longer than DB_HEALTHCHECK_INTERVAL is
+    pinged before reuse and replaced if it fails.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = BoundedSemaphore(size)
+        self._closed = False
+
+    def _connect(self):
+        # Plain connections unless profiling or the slow-query log needs timings
+        timed = app.config['PROFILING_ENABLED'] or app.config['SLOW_QUERY_THRESHOLD_MS']
+        conn = sqlite3.connect(str(self.path),
+                               timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                               check_same_thread=False,
+                               factory=ProfiledConnection if timed else sqlite3.Connection,
+                               cached_statements=app.config['DB_STATEMENT_CACHE_SIZE'])
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers run alongside a writer; NORMAL is durable in WAL mode
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+        conn.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")
+        conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=app.config['DB_POOL_TIMEOUT']):
+            raise RuntimeError('All database connections are busy, try again shortly')
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if (time.monotonic() - last_used > app.config['DB_HEALTHCHECK_INTERVAL']
+                        and not self._healthy(conn)):
+                    self._discard(conn)
+                    continue
+                return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            # Same as closing the connection: uncommitted work is discarded
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        else:
+            if self._closed or self._idle.qsize() >= self.size:
+                self._discard(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+            self._discard(conn)
+
+db_pool = ConnectionPool(DB_PATH, app.config['DB_POOL_SIZE'])
+atexit.register(db_pool.close)
+
 # Database Context Manager
 @contextmanager
 def db_connection():
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = db_pool.acquire()
     try:
         yield conn
     except Exception:
         conn.rollback()
         raise
     finally:
-        conn.close()
+        db_pool.release(conn)
 
 # Initialize Database
+VERSIONED_TABLES = ('products', 'customers', 'movements', 'inventory')
+# (fts table, source table, indexed columns, tokenizer); batch codes keep their dashes
+SEARCH_INDEXES = (
+    ('products_fts', 'products', ('name', 'family', 'category'), 'unicode61 remove_diacritics 2'),
+    ('customers_fts', 'customers', ('name', 'ville', 'ice'), 'unicode61 remove_diacritics 2'),
+    ('batches_fts', 'movements', ('batch', 'sub_batch'), "unicode61 tokenchars '-'"),
+)
+
 def init_db():
     with db_connection() as conn:
         cursor = conn.cursor()
@@ -107,9 +842,13 @@ def init_db():
             batch TEXT NOT NULL,
             sub_batch TEXT NOT NULL,
             dpj TEXT NOT NULL,
+            note_id INTEGER,
             FOREIGN KEY (product_id) REFERENCES products (id),
             FOREIGN KEY (customer_id) REFERENCES customers (id)
         )''')
+        # Databases that predate delivery notes
+        if 'note_id' not in {row['name'] for row in conn.execute('PRAGMA table_info(movements)')}:
+            cursor.execute('ALTER TABLE movements ADD COLUMN note_id INTEGER')
         
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS inventory (
@@ -141,6 +880,266 @@ def init_db():
             ice TEXT,
             observations TEXT
         )''')
+        # The first customers definition wins on a fresh database; add the
+        # columns the client pages and the search index use
+        customer_columns = {row['name'] for row in conn.execute('PRAGMA table_info(customers)')}
+        for column in ('ville', 'pays', 'telephone', 'gsm', 'rc', 'cnss', 'patente', 'ice', 'observations'):
+            if column not in customer_columns:
+                cursor.execute(f'ALTER TABLE customers ADD COLUMN {column} TEXT')
+
+        # Alerts already sent, so they are only mailed again after clearing
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_alerts (
+            alert_type TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            raised_at TEXT NOT NULL,
+            PRIMARY KEY (alert_type, product_id)
+        )''')
+
+        # Emails that could not be delivered after retries
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mail_dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject TEXT NOT NULL,
+            recipients TEXT NOT NULL,
+            body TEXT,
+            html TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            failed_at TEXT NOT NULL
+        )''')
+
+        # Stock per lot, maintained alongside inventory by the movement routes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            batch TEXT NOT NULL,
+            sub_batch TEXT NOT NULL,
+            best_before TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (product_id, batch, sub_batch, best_before),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS movement_lots (
+            movement_id INTEGER NOT NULL,
+            lot_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            FOREIGN KEY (movement_id) REFERENCES movements (id),
+            FOREIGN KEY (lot_id) REFERENCES lots (id)
+        )''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_lots_best_before ON lots (best_before)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_lots_product ON lots (product_id, best_before)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movement_lots_movement ON movement_lots (movement_id)')
+
+        # Dashboard stock counters, kept current by triggers on inventory
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dashboard_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            threshold INTEGER NOT NULL,
+            out_of_stock INTEGER NOT NULL DEFAULT 0,
+            low_stock INTEGER NOT NULL DEFAULT 0,
+            in_stock INTEGER NOT NULL DEFAULT 0
+        )''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_inventory_insert AFTER INSERT ON inventory
+        BEGIN
+            UPDATE dashboard_counters SET
+                out_of_stock = out_of_stock + (NEW.quantity = 0),
+                low_stock = low_stock + (NEW.quantity > 0 AND NEW.quantity < threshold),
+                in_stock = in_stock + (NEW.quantity >= threshold)
+            WHERE id = 1;
+        END''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_inventory_update AFTER UPDATE OF quantity ON inventory
+        BEGIN
+            UPDATE dashboard_counters SET
+                out_of_stock = out_of_stock - (OLD.quantity = 0) + (NEW.quantity = 0),
+                low_stock = low_stock - (OLD.quantity > 0 AND OLD.quantity < threshold)
+                                      + (NEW.quantity > 0 AND NEW.quantity < threshold),
+                in_stock = in_stock - (OLD.quantity >= threshold) + (NEW.quantity >= threshold)
+            WHERE id = 1;
+        END''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_inventory_delete AFTER DELETE ON inventory
+        BEGIN
+            UPDATE dashboard_counters SET
+                out_of_stock = out_of_stock - (OLD.quantity = 0),
+                low_stock = low_stock - (OLD.quantity > 0 AND OLD.quantity < threshold),
+                in_stock = in_stock - (OLD.quantity >= threshold)
+            WHERE id = 1;
+        END''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_quantity ON inventory (quantity)')
+
+        # Per-table change counters, used for the API's ETags
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )''')
+        for table in VERSIONED_TABLES:
+            cursor.execute('INSERT OR IGNORE INTO table_versions (table_name) VALUES (?)', (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+                END''')
+
+        # Secondary indexes for the movements listing, dashboard and client pages
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movements_date ON movements (date)')
+        # Covers the per-product ledger sums of reconcile_inventory; it starts
+        # with product_id, so it replaces the plain index on that column
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_movements_product_balance ON movements (product_id, movement_type, quantity)
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_movements_product')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movements_customer ON movements (customer_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movements_type ON movements (movement_type)')
+
+        # Full-text search indexes over their source tables, kept in sync by triggers
+        existing_tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for fts_table, source, columns, tokenize in SEARCH_INDEXES:
+            column_list = ', '.join(columns)
+            new_values = ', '.join(f'NEW.{column}' for column in columns)
+            old_values = ', '.join(f'OLD.{column}' for column in columns)
+            cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                {column_list}, content='{source}', content_rowid='id',
+                tokenize="{tokenize}", prefix='2 3'
+            )''')
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_insert AFTER INSERT ON {source}
+            BEGIN
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END''')
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_delete AFTER DELETE ON {source}
+            BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+            END''')
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_update AFTER UPDATE OF {column_list} ON {source}
+            BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END''')
+            if fts_table not in existing_tables:
+                cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+        # Daily closing balances for point-in-time inventory (see take_snapshots)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_snapshots (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (day, product_id)
+        ) WITHOUT ROWID''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lot_snapshots (
+            day TEXT NOT NULL,
+            lot_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (day, lot_id)
+        ) WITHOUT ROWID''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_days (
+            kind TEXT NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (kind, day)
+        ) WITHOUT ROWID''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_state (
+            kind TEXT PRIMARY KEY,
+            through TEXT NOT NULL
+        )''')
+
+        # Closed years moved to their own files (see archive_year), and the
+        # balances and client totals they carry into the hot partition
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archives (
+            year INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            movements INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS opening_stock (
+            product_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS opening_lots (
+            lot_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            FOREIGN KEY (lot_id) REFERENCES lots (id)
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS opening_client_totals (
+            customer_id INTEGER PRIMARY KEY,
+            total_entry INTEGER NOT NULL DEFAULT 0,
+            total_exit INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (customer_id) REFERENCES customers (id)
+        )''')
+
+        # Inventory reconciliation runs, the drift each found, and products
+        # whose movements were deleted since the last run
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            high_water_mark INTEGER NOT NULL,
+            checked INTEGER NOT NULL,
+            drifted INTEGER NOT NULL,
+            repaired INTEGER NOT NULL,
+            duration_ms REAL NOT NULL
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_drift (
+            run_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            recorded INTEGER,
+            expected INTEGER NOT NULL,
+            PRIMARY KEY (run_id, product_id)
+        ) WITHOUT ROWID''')
+        cursor.execute('CREATE TABLE IF NOT EXISTS reconcile_dirty (product_id INTEGER PRIMARY KEY)')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reconcile_movements_delete AFTER DELETE ON movements
+        BEGIN
+            INSERT OR IGNORE INTO reconcile_dirty (product_id) VALUES (OLD.product_id);
+        END''')
+
+        # Delivery notes: one header per multi-line order, its lines being
+        # the movements that carry its id (see MovementWriter.submit_note)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            number TEXT NOT NULL,
+            movement_type TEXT NOT NULL,
+            customer_id INTEGER,
+            date TEXT NOT NULL,
+            created_by INTEGER,
+            FOREIGN KEY (customer_id) REFERENCES customers (id),
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )''')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_delivery_notes_number ON delivery_notes (number)')
+        # Single-line movements have no note, so only note lines are indexed
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movements_note ON movements (note_id) WHERE note_id IS NOT NULL')
+        # Archives are upgraded here once, not on every attach
+        for archive in conn.execute('SELECT path FROM archives').fetchall():
+            if (ARCHIVE_DIR / archive['path']).exists():
+                upgrade_archive(ARCHIVE_DIR / archive['path'])
+
+        # Backfill lots for databases that predate them
+        if (conn.execute('SELECT 1 FROM movements LIMIT 1').fetchone()
+                and not conn.execute('SELECT 1 FROM movement_lots LIMIT 1').fetchone()):
+            rebuild_lots(conn)
+
         # Check if initial data needs to be added
         if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0:
             # Initial admin user
@@ -171,203 +1170,1950 @@ def init_db():
             SELECT id, 0 FROM products
             ''')
         
+        # Recount once at startup; this also picks up a changed LOW_STOCK_THRESHOLD
+        recount_dashboard_counters(conn)
+        
         conn.commit()
 
+def recount_dashboard_counters(conn):
+    conn.execute('''
+    INSERT OR REPLACE INTO dashboard_counters (id, threshold, out_of_stock, low_stock, in_stock)
+    SELECT 1, ?,
+        COUNT(CASE WHEN quantity = 0 THEN 1 END),
+        COUNT(CASE WHEN quantity > 0 AND quantity < ? THEN 1 END),
+        COUNT(CASE WHEN quantity >= ? THEN 1 END)
+    FROM inventory
+    ''', (app.config['LOW_STOCK_THRESHOLD'],) * 3)
+
 # Excel Log Functions
-def init_excel_log():
-    if not EXCEL_LOG_PATH.exists():
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Mouvements"
-        headers = [
-            "ID", "Date", "Produit", "Famille", "Catégorie", "Type",
-            "Quantité", "Client", "Lot", "Sous-lot", "DPJ", "DLC", "État"
-        ]
-        ws.append(headers)
-        wb.save(str(EXCEL_LOG_PATH))
-
-def update_excel_log(movement):
-    try:
-        # Create a temporary copy of the file
-        temp_path = EXCEL_LOG_PATH.with_name(f"temp_{EXCEL_LOG_PATH.name}")
-        
-        # If Excel file is locked, create a new workbook
-        if not EXCEL_LOG_PATH.exists() or not os.access(EXCEL_LOG_PATH, os.W_OK):
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Mouvements"
-            headers = [
-                "ID", "Date", "Produit", "Famille", "Catégorie", "Type",
-                "Quantité", "Client", "Lot", "Sous-lot", "DPJ", "DLC", "État"
-            ]
-            ws.append(headers)
-        else:
-            # Try to load the existing file
-            try:
-                wb = load_workbook(str(EXCEL_LOG_PATH))
-                ws = wb.active
-            except:
-                # If loading fails, create new workbook
-                wb = Workbook()
-                ws = wb.active
-                ws.title = "Mouvements"
-                headers = [
-                    "ID", "Date", "Produit", "Famille", "Catégorie", "Type",
-                    "Quantité", "Client", "Lot", "Sous-lot", "DPJ", "DLC", "État"
-                ]
-                ws.append(headers)
-        
-        # Determine status
-        status = "Bon"
-        if get_alert_status(movement['best_before']) == 'danger':
-            status = "Expiré"
-        elif get_alert_status(movement['best_before']) == 'warning':
-            status = "Bientôt"
-        
-        # Add the movement data
-        ws.append([
+EXCEL_LOG_HEADERS = [
+    "ID", "Date", "Produit", "Famille", "Catégorie", "Type",
+    "Quantité", "Client", "Lot", "Sous-lot", "DPJ", "DLC", "État"
+]
+EXCEL_MAX_ROWS = 1048576
+
+def excel_log_row(movement):
+    return [
         movement['id'],
         movement['date'][:16],
-        movement.get('product_name', ''),
-        movement.get('family', ''),
-        movement.get('category', ''),
+        movement['product_name'] or '',
+        movement['family'] or '',
+        movement['category'] or '',
         movement['movement_type'],
         movement['quantity'],
-        movement.get('customer_name', ''),
+        movement['customer_name'] or '',
         movement['batch'],
         movement['sub_batch'],
         movement['dpj'],  # This will be the manually entered value
         movement['best_before'][:10],
-        status
-        ])
+        EXPIRY_STATUS_LABELS[movement['expiry_status']]
+    ]
+
+class ExcelLogWriter:
+    """Background writer for the movements log.
+
+    Rows are appended to monthly CSV files in EXCEL_LOG_DIR and the xlsx file
+    is rebuilt from them every EXCEL_LOG_COMPACT_INTERVAL seconds. The id of
+    the last flushed movement is kept in EXCEL_LOG_STATE_PATH, and each flush
+    reads everything after it from the movements table, so rows missed by a
+    crash are replayed on the next start.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.last_id = 0
+        self.dirty = False
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        EXCEL_LOG_DIR.mkdir(exist_ok=True)
+        try:
+            self.last_id = int(EXCEL_LOG_STATE_PATH.read_text().strip() or 0)
+        except (OSError, ValueError):
+            self.last_id = 0
+        # Rebuild the xlsx on the first pass if it is missing or behind
+        self.dirty = not EXCEL_LOG_PATH.exists() or self.last_id == 0
+        self.thread = Thread(target=self._run, name='excel-log-writer', daemon=True)
+        self.thread.start()
+        # Replay anything committed after the last flush
+        self.notify()
+
+    def notify(self, movement_id=None):
+        self.queue.put(movement_id)
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.queue.put(self._STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        compact_interval = app.config['EXCEL_LOG_COMPACT_INTERVAL']
+        next_compaction = time.monotonic() + compact_interval
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=max(0, next_compaction - time.monotonic()))
+                stopping = item is self._STOP
+                # Coalesce everything queued meanwhile into one flush
+                while not stopping:
+                    try:
+                        stopping = self.queue.get_nowait() is self._STOP
+                    except queue.Empty:
+                        break
+                self.flush()
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"Error updating Excel log: {str(e)}")
+
+            if stopping or time.monotonic() >= next_compaction:
+                try:
+                    if self.dirty:
+                        self.compact()
+                except Exception as e:
+                    print(f"Error compacting Excel log: {str(e)}")
+                next_compaction = time.monotonic() + compact_interval
+
+    @profiled('excel_log')
+    def flush(self):
+        batch_size = app.config['EXCEL_LOG_BATCH_SIZE']
+        with db_connection() as conn:
+            while True:
+                rows = conn.execute(movements_query() + '''
+                AND m.id > ?
+                ORDER BY m.id
+                LIMIT ?
+                ''', expiry_status_params() + [self.last_id, batch_size]).fetchall()
+                if not rows:
+                    break
+                self._append(rows)
+                self.last_id = rows[-1]['id']
+                self._save_state()
+                self.dirty = True
+
+    def _append(self, rows):
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['date'][:7], []).append(excel_log_row(row))
+
+        for month, month_rows in by_month.items():
+            path = EXCEL_LOG_DIR / f"movements_{month}.csv"
+            is_new = not path.exists()
+            with open(path, 'a', newline='', encoding='utf-8-sig') as f:
+                writer = csv.writer(f)
+                if is_new:
+                    writer.writerow(EXCEL_LOG_HEADERS)
+                writer.writerows(month_rows)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _save_state(self):
+        temp_path = EXCEL_LOG_STATE_PATH.with_name(f"temp_{EXCEL_LOG_STATE_PATH.name}")
+        temp_path.write_text(str(self.last_id))
+        os.replace(str(temp_path), str(EXCEL_LOG_STATE_PATH))
+
+    def compact(self):
+        temp_path = EXCEL_LOG_PATH.with_name(f"temp_{EXCEL_LOG_PATH.name}")
+        wb = xlsxwriter.Workbook(str(temp_path), {'constant_memory': True})
+        ws = wb.add_worksheet("Mouvements")
+        ws.write_row(0, 0, EXCEL_LOG_HEADERS)
+        row_num, sheet_num, last_written = 1, 1, 0
+
+        for path in sorted(EXCEL_LOG_DIR.glob("movements_*.csv")):
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    movement_id = int(row[0])
+                    # Rows re-appended after a crash between write and state save
+                    if movement_id <= last_written:
+                        continue
+                    if row_num >= EXCEL_MAX_ROWS:
+                        sheet_num += 1
+                        ws = wb.add_worksheet(f"Mouvements ({sheet_num})")
+                        ws.write_row(0, 0, EXCEL_LOG_HEADERS)
+                        row_num = 1
+                    row[0] = movement_id
+                    row[6] = int(row[6])
+                    ws.write_row(row_num, 0, row)
+                    row_num += 1
+                    last_written = movement_id
+
+        wb.close()
+        # Fails if the file is open in Excel; keep dirty and retry later
+        os.replace(str(temp_path), str(EXCEL_LOG_PATH))
+        self.dirty = False
+
+excel_log_writer = ExcelLogWriter()
+
+def init_excel_log():
+    excel_log_writer.start()
+    atexit.register(excel_log_writer.stop)
+
+@profiled('excel_log')
+def update_excel_log(movement_id):
+    # The writer reads the committed row itself; this never blocks the request
+    excel_log_writer.notify(movement_id)
+
+def calculate_dates(category, movement_type, product_name, dpj_date=None):
+    # If dpj_date is provided, parse it, otherwise use current date
+    if dpj_date:
+        try:
+            # Parse DD/MM/YYYY format
+            day, month, year = map(int, dpj_date.split('/'))
+            date = datetime(year, month, day)
+        except ValueError:
+            date = datetime.now()
+    else:
+        date = datetime.now()
+    
+    year_short = date.strftime('%y')
+    
+    # Calculate Julian day (1-365)
+    julian_day = date.timetuple().tm_yday
+    
+    # Determine product code
+    product_code = 'X'  # Default code
+    if 'poulet' in product_name.lower():
+        product_code = 'P'
+    elif 'dinde' in product_name.lower():
+        product_code = 'D'
+    
+    # Sub-batch format: AA-JJJ-C
+    sub_batch = f"{year_short}-{julian_day:03d}-{product_code}"
+    
+    # Get current week number
+    week_number = date.isocalendar()[1]
+    
+    # Batch format: AA+C+SS-SS2
+    batch = f"{year_short}{product_code}{week_number}-{week_number+1}"
+    
+    # Calculate best before date based on category
+    if category == 'MSM':
+        bbd = date + timedelta(days=30*12)  # 12 months
+    elif category == 'Offal':
+        bbd = date + timedelta(days=30*9)  # 9 months
+    else:  # Whole or Cut products (18 months)
+        bbd = date + timedelta(days=30*18)  # 18 months
+    
+    return {
+        'best_before': bbd.isoformat(),
+        'batch': batch,
+        'sub_batch': sub_batch,
+    }
+
+EXPIRY_STATUS_LABELS = {'danger': 'Expiré', 'warning': 'Bientôt', 'success': 'Bon'}
+
+def expiry_status_sql(column='m.best_before'):
+    """SQL CASE giving 'danger', 'warning' or 'success' for a best-before column.
+
+    Evaluated by SQLite against one fixed now per query, so a result set is
+    classified without a Python call per row. best_before is stored as an ISO
+    string, so plain string comparisons give the right ordering. Its two
+    placeholders take expiry_status_params(), ahead of any later parameter.
+    """
+    return (f"CASE WHEN {column} < ? THEN 'danger' "
+            f"WHEN {column} < ? THEN 'warning' "
+            f"ELSE 'success' END")
+
+def expiry_status_params(now=None):
+    now = now or datetime.now()
+    # Warning while fewer than EXPIRING_SOON_DAYS + 1 whole days are left
+    soon = now + timedelta(days=app.config['EXPIRING_SOON_DAYS'] + 1)
+    return [now.isoformat(), soon.isoformat()]
+
+# Lot Functions
+class LotShortfall(Exception):
+    """An exit asked for more than the product's lots hold; nothing was allocated."""
+
+    def __init__(self, product_id, missing):
+        super().__init__(f"Lots of product {product_id} are short by {missing}")
+        self.product_id = product_id
+        self.missing = missing
+
+def apply_movement_to_lots(conn, movement_id, product_id, movement_type, quantity, dates):
+    """Updates lot stock for a new movement and records which lots it used.
+
+    Entries add to their own lot. Exits take from the lot matching their
+    batch codes first, then from the product's other lots first-expired-first-out.
+    An exit the lots cannot cover raises LotShortfall before anything is
+    written, so lots never silently fall behind inventory; callers reject
+    the movement.
+    """
+    lot_key = (product_id, dates['batch'], dates['sub_batch'], dates['best_before'])
+    if movement_type == 'Entry':
+        conn.execute('''
+        INSERT INTO lots (product_id, batch, sub_batch, best_before, quantity)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(product_id, batch, sub_batch, best_before) DO UPDATE SET
+        quantity = quantity + excluded.quantity
+        ''', (*lot_key, quantity))
+        lot = conn.execute('''
+        SELECT id FROM lots WHERE product_id = ? AND batch = ? AND sub_batch = ? AND best_before = ?
+        ''', lot_key).fetchone()
+        allocations = [(movement_id, lot['id'], quantity)]
+    else:
+        candidates = conn.execute('''
+        SELECT id, quantity FROM lots
+        WHERE product_id = ? AND quantity > 0
+        ORDER BY (batch = ? AND sub_batch = ? AND best_before = ?) DESC, best_before ASC, id ASC
+        ''', lot_key).fetchall()
+        allocations = []
+        remaining = quantity
+        for lot in candidates:
+            if remaining <= 0:
+                break
+            taken = min(remaining, lot['quantity'])
+            allocations.append((movement_id, lot['id'], -taken))
+            remaining -= taken
+        if remaining > 0:
+            raise LotShortfall(product_id, remaining)
+        conn.executemany('UPDATE lots SET quantity = quantity + ? WHERE id = ?',
+                         [(delta, lot_id) for _, lot_id, delta in allocations])
+
+    conn.executemany('''
+    INSERT INTO movement_lots (movement_id, lot_id, quantity) VALUES (?, ?, ?)
+    ''', allocations)
+
+def revert_movement_lots(conn, movement_id):
+    """Gives back what a movement took from (or added to) its lots.
+
+    Returns False when a lot no longer holds what an entry put in it, as
+    later exits took that stock; the caller must then roll back, since
+    other lots of the movement may already have been updated.
+    """
+    allocated = conn.execute('SELECT COUNT(DISTINCT lot_id) FROM movement_lots WHERE movement_id = ?',
+                             (movement_id,)).fetchone()[0]
+    reverted = conn.execute('''
+    UPDATE lots SET quantity = quantity - (
+        SELECT SUM(ml.quantity) FROM movement_lots ml
+        WHERE ml.movement_id = ? AND ml.lot_id = lots.id
+    )
+    WHERE id IN (SELECT lot_id FROM movement_lots WHERE movement_id = ?)
+    AND quantity >= (
+        SELECT SUM(ml.quantity) FROM movement_lots ml
+        WHERE ml.movement_id = ? AND ml.lot_id = lots.id
+    )
+    ''', (movement_id, movement_id, movement_id)).rowcount
+    if reverted < allocated:
+        return False
+    conn.execute('DELETE FROM movement_lots WHERE movement_id = ?', (movement_id,))
+    return True
+
+def rebuild_lots(conn):
+    """Replays the movements ledger into lots and movement_lots.
+
+    Runs in memory with the same allocation rules as apply_movement_to_lots,
+    so it is used once to backfill databases created before lots existed.
+    Only the lot balances are held in memory; allocations are written out in
+    chunks as the ledger is read.
+    """
+    if conn.execute('SELECT 1 FROM archives LIMIT 1').fetchone():
+        # Archived movements keep the lot ids they were allocated to
+        raise RuntimeError('Les lots ne peuvent plus être reconstruits une fois des exercices archivés')
+    conn.execute('DELETE FROM movement_lots')
+    conn.execute('DELETE FROM lots')
+    # Lot ids are reassigned, so lot snapshots are taken again from scratch
+    conn.execute('DELETE FROM lot_snapshots')
+    conn.execute("DELETE FROM snapshot_days WHERE kind = 'lot'")
+    conn.execute("DELETE FROM snapshot_state WHERE kind = 'lot'")
+    lots = {}        # (product_id, batch, sub_batch, best_before) -> [lot_id, quantity]
+    on_hand = {}     # product_id -> heap of (best_before, lot_id, key), first to expire on top
+    queued = set()   # keys currently in an on_hand heap
+    allocations = []
+
+    def flush_allocations():
+        conn.executemany('''
+        INSERT INTO movement_lots (movement_id, lot_id, quantity) VALUES (?, ?, ?)
+        ''', allocations)
+        allocations.clear()
+
+    def take(movement_id, key, remaining):
+        taken = min(remaining, lots[key][1])
+        lots[key][1] -= taken
+        allocations.append((movement_id, lots[key][0], -taken))
+        return remaining - taken
+
+    movements = conn.execute('''
+    SELECT id, product_id, movement_type, quantity, batch, sub_batch, best_before
+    FROM movements ORDER BY id
+    ''')
+    for m in movements:
+        key = (m['product_id'], m['batch'], m['sub_batch'], m['best_before'])
+        if m['movement_type'] == 'Entry':
+            if key not in lots:
+                lots[key] = [len(lots) + 1, 0]
+                conn.execute('''
+                INSERT INTO lots (id, product_id, batch, sub_batch, best_before, quantity)
+                VALUES (?, ?, ?, ?, ?, 0)
+                ''', (lots[key][0], *key))
+            lots[key][1] += m['quantity']
+            if key not in queued:
+                heapq.heappush(on_hand.setdefault(m['product_id'], []), (key[3], lots[key][0], key))
+                queued.add(key)
+            allocations.append((m['id'], lots[key][0], m['quantity']))
+        else:
+            remaining = m['quantity']
+            if key in lots and lots[key][1] > 0:
+                remaining = take(m['id'], key, remaining)
+            heap = on_hand.get(m['product_id'], [])
+            while heap:
+                candidate = heap[0][2]
+                if lots[candidate][1] > 0:
+                    if remaining <= 0:
+                        break
+                    remaining = take(m['id'], candidate, remaining)
+                if lots[candidate][1] <= 0:
+                    heapq.heappop(heap)
+                    queued.discard(candidate)
+
+        if len(allocations) >= 50000:
+            flush_allocations()
+
+    flush_allocations()
+    conn.executemany('UPDATE lots SET quantity = ? WHERE id = ?',
+                     [(quantity, lot_id) for lot_id, quantity in lots.values()])
+
+# Movement Writes
+class MovementRejected(Exception):
+    """A submission that cannot be recorded as a whole; none of its lines were written."""
+
+class MovementWriter:
+    """Serializes movement writes through one thread and group-commits them.
+
+    Requests submit their movements and wait. The writer takes everything
+    queued meanwhile, up to MOVEMENT_WRITER_BATCH submissions, and records
+    it in one BEGIN IMMEDIATE transaction, each submission in its own
+    savepoint so a rejected one leaves the rest of the group intact. Exits
+    take their stock with a conditional UPDATE ... WHERE quantity >= ?, so
+    the check and the decrement cannot be split by another write. When the
+    database stays locked past the busy timeout (an import or an archive
+    holding it), the whole group is retried with exponential backoff.
+    A delivery note is a single submission, so its header and lines are
+    committed together or rejected together. Deletions go through the same
+    queue and give their stock back under the same conditional updates.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = Thread(target=self._run, name='movement-writer', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            # Queued after any pending submission, so those are written first
+            self.queue.put(self._STOP)
+            self.thread.join(timeout)
+
+    def submit(self, lines):
+        """Records lines of (product_id, quantity, movement_type, customer_id, dpj) as one unit.
+
+        Returns the new movement ids, in line order, once committed. Raises
+        MovementRejected when a line cannot be recorded, in which case no
+        line is.
+        """
+        return self._submit({'lines': list(lines), 'note': None})['ids']
+
+    def submit_note(self, movement_type, customer_id, lines, created_by=None):
+        """Records lines of (product_id, quantity, dpj) as one delivery note.
+
+        The header and all its lines are written together or not at all.
+        Returns (note_id, number).
+        """
+        submission = self._submit({
+            'lines': [(product_id, quantity, movement_type, customer_id, dpj)
+                      for product_id, quantity, dpj in lines],
+            'note': {'movement_type': movement_type, 'customer_id': customer_id, 'created_by': created_by},
+        })
+        return submission['note']['id'], submission['note']['number']
+
+    def submit_delete(self, movement_id):
+        """Deletes a hot movement and reverses its stock and lot allocations.
+
+        Returns the deleted movement. Raises MovementRejected when it is not
+        in the hot table (already deleted, or archived), or when later exits
+        already took the stock an entry brought in.
+        """
+        return self._submit({'delete': movement_id, 'note': None})['movement']
+
+    def _submit(self, submission):
+        self.start()
+        submission.update({'done': Event(), 'ids': None, 'error': None})
+        self.queue.put(submission)
+        if not submission['done'].wait(app.config['MOVEMENT_WRITER_TIMEOUT']):
+            raise RuntimeError('Enregistrement toujours en attente, vérifiez les mouvements avant de le refaire')
+        if submission['error']:
+            raise submission['error']
+        return submission
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            group = [item]
+            while len(group) < app.config['MOVEMENT_WRITER_BATCH']:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                group.append(item)
+            self._write(group)
+
+    def _write(self, group):
+        retries = app.config['MOVEMENT_WRITER_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                with db_connection() as conn:
+                    self._commit(conn, group)
+                break
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == retries:
+                    error = e
+                else:
+                    time.sleep(app.config['MOVEMENT_WRITER_BACKOFF'] * 2 ** attempt)
+                    continue
+            except Exception as e:
+                error = e
+            for submission in group:
+                submission['error'], submission['ids'] = error, None
+            break
+        for submission in group:
+            submission['done'].set()
+
+    def _commit(self, conn, group):
+        conn.execute('BEGIN IMMEDIATE')
+        now = datetime.now().isoformat()
+        for submission in group:
+            conn.execute('SAVEPOINT submission')
+            try:
+                submission['ids'] = self._record(conn, submission, now)
+                submission['error'] = None
+            except (MovementRejected, sqlite3.IntegrityError) as e:
+                conn.execute('ROLLBACK TO submission')
+                submission['ids'] = None
+                submission['error'] = e if isinstance(e, MovementRejected) else MovementRejected(str(e))
+            conn.execute('RELEASE submission')
+        conn.commit()
+
+    def _record(self, conn, submission, now):
+        if 'delete' in submission:
+            return self._delete(conn, submission)
+        lines = submission['lines']
+        if not lines:
+            raise MovementRejected('Invalid movement')
+        totals = {}
+        for product_id, quantity, movement_type, _, _ in lines:
+            if movement_type not in ('Entry', 'Exit') or quantity <= 0:
+                raise MovementRejected('Invalid movement')
+            totals[product_id, movement_type] = totals.get((product_id, movement_type), 0) + quantity
+        products = {}
+        for chunk in chunked(sorted({product_id for product_id, _ in totals})):
+            products.update((row['id'], row) for row in conn.execute(
+                f"SELECT * FROM products WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+        if any(product_id not in products for product_id, _ in totals):
+            raise MovementRejected('Product not found')
+        
+        # One stock update per product and type, however many lines share it;
+        # entries go first, so a submission may ship what it also receives
+        conn.executemany('''
+        INSERT INTO inventory (product_id, quantity)
+        VALUES (?, ?)
+        ON CONFLICT(product_id) DO UPDATE SET
+        quantity = quantity + excluded.quantity
+        ''', [(product_id, quantity) for (product_id, movement_type), quantity in totals.items()
+              if movement_type == 'Entry'])
+        for (product_id, movement_type), quantity in totals.items():
+            if movement_type == 'Exit' and not conn.execute('''
+                UPDATE inventory SET quantity = quantity - ?
+                WHERE product_id = ? AND quantity >= ?
+                ''', (quantity, product_id, quantity)).rowcount:
+                raise MovementRejected(f"Insufficient stock ({products[product_id]['name']})")
+        
+        note = submission['note']
+        if note:
+            note['number'] = self._next_note_number(conn, now)
+            note['id'] = conn.execute('''
+            INSERT INTO delivery_notes (number, movement_type, customer_id, date, created_by)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (note['number'], note['movement_type'], note['customer_id'], now, note['created_by'])).lastrowid
+        
+        movement_ids = []
+        for product_id, quantity, movement_type, customer_id, dpj in lines:
+            product = products[product_id]
+            # Generate batch information using DPJ date
+            dates = calculate_dates(product['category'], movement_type, product['name'], dpj)
+            movement_id = conn.execute('''
+            INSERT INTO movements (
+                product_id, quantity, customer_id, movement_type, 
+                date, best_before, batch, sub_batch, dpj, note_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                product['id'], quantity, customer_id, movement_type,
+                now, dates['best_before'], dates['batch'], dates['sub_batch'], dpj,
+                note['id'] if note else None
+            )).lastrowid
+            try:
+                apply_movement_to_lots(conn, movement_id, product['id'], movement_type, quantity, dates)
+            except LotShortfall:
+                raise MovementRejected(f"Insufficient stock in lots ({product['name']})")
+            movement_ids.append(movement_id)
+        return movement_ids
+
+    @staticmethod
+    def _delete(conn, submission):
+        # Read under the write lock, so a second delete of the same movement finds nothing
+        movement = conn.execute('SELECT * FROM movements WHERE id = ?', (submission['delete'],)).fetchone()
+        if not movement:
+            raise MovementRejected('Movement not found')
+        if movement['movement_type'] == 'Entry':
+            # Same guard as exits: stock an entry brought in may have shipped since
+            if not conn.execute('''
+                UPDATE inventory SET quantity = quantity - ?
+                WHERE product_id = ? AND quantity >= ?
+                ''', (movement['quantity'], movement['product_id'], movement['quantity'])).rowcount:
+                raise MovementRejected('Le stock de cette entrée a déjà été sorti, le mouvement ne peut plus être supprimé')
+        else:
+            conn.execute('UPDATE inventory SET quantity = quantity + ? WHERE product_id = ?',
+                         (movement['quantity'], movement['product_id']))
+        if not revert_movement_lots(conn, movement['id']):
+            raise MovementRejected('Le stock de ce lot a déjà été sorti, le mouvement ne peut plus être supprimé')
+        conn.execute('DELETE FROM movements WHERE id = ?', (movement['id'],))
+        invalidate_snapshots(conn, movement['date'][:10])
+        submission['movement'] = movement
+        return [movement['id']]
+
+    @staticmethod
+    def _next_note_number(conn, now):
+        """BL-<year>-<sequence>, the sequence restarting each year.
+
+        Read off idx_delivery_notes_number; the writer is the only one
+        numbering notes, so two cannot pick the same number.
+        """
+        prefix = f"BL-{now[:4]}-"
+        # '.' sorts right after '-', so this range holds exactly this year's numbers
+        last = conn.execute('SELECT MAX(number) FROM delivery_notes WHERE number >= ? AND number < ?',
+                            (prefix, prefix[:-1] + '.')).fetchone()[0]
+        return f"{prefix}{int(last[len(prefix):]) + 1 if last else 1:06d}"
+
+movement_writer = MovementWriter()
+
+# Stock Snapshots
+SNAPSHOT_KINDS = {
+    # kind: (snapshot table, key column, opening balances table,
+    #        (key, delta) per movement in one partition dated in [:start, :end))
+    'product': ('stock_snapshots', 'product_id', 'opening_stock', '''
+        SELECT product_id AS key, CASE WHEN movement_type = 'Entry' THEN quantity ELSE -quantity END AS delta
+        FROM {db}.movements WHERE date >= :start AND date < :end'''),
+    'lot': ('lot_snapshots', 'lot_id', 'opening_lots', '''
+        SELECT ml.lot_id AS key, ml.quantity AS delta
+        FROM {db}.movements m JOIN {db}.movement_lots ml ON ml.movement_id = m.id
+        WHERE m.date >= :start AND m.date < :end'''),
+}
+snapshot_lock = Lock()
+
+def day_after(day):
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def is_snapshot_day(kind, day):
+    # Lots have many more rows, so by default they are only kept for month ends
+    return kind == 'product' or app.config['SNAPSHOT_LOTS_DAILY'] or day_after(day).endswith('-01')
+
+def balance_deltas(conn, kind, start, end, schemas=('main',)):
+    """(key, change) pairs over the movements dated in [start, end) in the given partitions."""
+    deltas = union_partitions(schemas, SNAPSHOT_KINDS[kind][3])
+    return conn.execute(f'SELECT key, SUM(delta) FROM ({deltas}) GROUP BY key',
+                        {'start': start, 'end': end}).fetchall()
+
+def take_snapshots(conn, kind, until=None):
+    """Stores closing balances for each day after the last one processed, up to `until`.
+
+    Days are handled one write transaction at a time, each adding that day's
+    movements to the previous balances, so a catch-up reads every movement
+    once. Only nonzero balances are stored, and a day without movements gets
+    no snapshot at all: the previous one plus an empty delta gives the same
+    answer. Snapshots left behind inside the archived years resume from the
+    opening balances instead, so the archives are never read. Returns the
+    number of snapshots written.
+    """
+    table, key, opening_table, _ = SNAPSHOT_KINDS[kind]
+    until = until or (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    balances, loaded_through = None, None
+    written = 0
+
+    with snapshot_lock:
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT through FROM snapshot_state WHERE kind = ?', (kind,)).fetchone()
+                boundary = archive_boundary(conn)
+                opening = bool(boundary) and (not row or row['through'] < boundary)
+                if opening:
+                    start = day_after(boundary)
+                elif row:
+                    start = day_after(row['through'])
+                else:
+                    first = conn.execute('SELECT MIN(date) FROM movements').fetchone()[0]
+                    if not first:
+                        break
+                    start = first[:10]
+                if start > until:
+                    break
+
+                end = start
+                while not is_snapshot_day(kind, end) and end < until:
+                    end = day_after(end)
+                if not is_snapshot_day(kind, end):
+                    break
+
+                # Reload unless this loop wrote the previous day itself
+                if opening:
+                    balances = dict(conn.execute(f'SELECT {key}, quantity FROM {opening_table}').fetchall())
+                elif balances is None or loaded_through != (row and row['through']):
+                    balances = dict(conn.execute(f'''
+                    SELECT {key}, quantity FROM {table}
+                    WHERE day = (SELECT MAX(day) FROM snapshot_days WHERE kind = ?)
+                    ''', (kind,)).fetchall())
+
+                deltas = balance_deltas(conn, kind, start, day_after(end))
+                for k, delta in deltas:
+                    balances[k] = balances.get(k, 0) + delta
+                # A fresh start must be written even without deltas: it is
+                # what later runs reload
+                if deltas or not row or opening:
+                    conn.executemany(f'INSERT OR REPLACE INTO {table} (day, {key}, quantity) VALUES (?, ?, ?)',
+                                     [(end, k, quantity) for k, quantity in balances.items() if quantity])
+                    conn.execute('INSERT OR REPLACE INTO snapshot_days (kind, day) VALUES (?, ?)', (kind, end))
+                    written += 1
+                conn.execute('INSERT OR REPLACE INTO snapshot_state (kind, through) VALUES (?, ?)', (kind, end))
+                conn.commit()
+                loaded_through = end
+            except Exception:
+                conn.rollback()
+                raise
+        conn.rollback()
+    return written
+
+def take_all_snapshots(conn, until=None):
+    return {kind: take_snapshots(conn, kind, until) for kind in SNAPSHOT_KINDS}
+
+def invalidate_snapshots(conn, day):
+    """Drops snapshots from `day` on, in the caller's transaction, after a past movement changed.
+
+    Until the scheduler rebuilds them, balances for those days come from the
+    last remaining snapshot plus a longer delta.
+    """
+    for kind, (table, *_) in SNAPSHOT_KINDS.items():
+        conn.execute(f'DELETE FROM {table} WHERE day >= ?', (day,))
+        conn.execute('DELETE FROM snapshot_days WHERE kind = ? AND day >= ?', (kind, day))
+        # Resume from the last snapshot kept: lot snapshots are not daily, so
+        # the days just before `day` may not be covered by one
+        remaining = conn.execute('SELECT MAX(day) FROM snapshot_days WHERE kind = ?', (kind,)).fetchone()[0]
+        if remaining:
+            conn.execute('UPDATE snapshot_state SET through = ? WHERE kind = ? AND through >= ?',
+                         (remaining, kind, day))
+        else:
+            conn.execute('DELETE FROM snapshot_state WHERE kind = ?', (kind,))
+
+def balances_as_of(conn, kind, day):
+    """{key: quantity} at the close of `day` (YYYY-MM-DD).
+
+    Reads the nearest snapshot on or before that day, or the opening
+    balances when none is kept after the last archived year, and adds the
+    movements since, which is a range scan on idx_movements_date. Only days
+    inside the archived years attach and read the archives.
+    """
+    table, key, opening_table, _ = SNAPSHOT_KINDS[kind]
+    boundary = archive_boundary(conn)
+    # Attached up front: ATTACH is not allowed inside the read transaction
+    schemas = movement_schemas(conn, None, day_after(day)) if boundary and day < boundary else ('main',)
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        # One read snapshot, so a concurrent invalidation cannot split the answer
+        conn.execute('BEGIN')
+    try:
+        snapshot = conn.execute('SELECT MAX(day) FROM snapshot_days WHERE kind = ? AND day <= ?',
+                                (kind, day)).fetchone()[0]
+        if boundary and day >= boundary and (not snapshot or snapshot < boundary):
+            balances = dict(conn.execute(f'SELECT {key}, quantity FROM {opening_table}').fetchall())
+            start = day_after(boundary)
+        elif snapshot:
+            balances = dict(conn.execute(f'SELECT {key}, quantity FROM {table} WHERE day = ?',
+                                         (snapshot,)).fetchall())
+            start = day_after(snapshot)
+        else:
+            balances, start = {}, ''
+        for k, delta in balance_deltas(conn, kind, start, day_after(day), schemas):
+            balances[k] = balances.get(k, 0) + delta
+    finally:
+        if own_transaction:
+            conn.rollback()
+    return balances
+
+def inventory_as_of(conn, day=None):
+    """Inventory rows at the close of `day`, or the live inventory when day is None."""
+    rows = conn.execute('''
+    SELECT p.id, p.name, p.family, p.category, 
+           COALESCE(i.quantity, 0) as quantity
+    FROM products p
+    LEFT JOIN inventory i ON p.id = i.product_id
+    ORDER BY p.name
+    ''').fetchall()
+    if day is None:
+        return rows
+    balances = balances_as_of(conn, 'product', day)
+    return [dict(row, quantity=balances.get(row['id'], 0)) for row in rows]
+
+def lots_as_of(conn, day=None):
+    """Lots with stock at the close of `day`, or now when day is None."""
+    query = '''
+    SELECT l.id, l.product_id, p.name, p.family, p.category,
+           l.batch, l.sub_batch, l.best_before, l.quantity
+    FROM lots l JOIN products p ON p.id = l.product_id
+    '''
+    if day is None:
+        return conn.execute(query + ' WHERE l.quantity > 0 ORDER BY p.name, l.best_before').fetchall()
+    balances = {lot_id: quantity for lot_id, quantity in balances_as_of(conn, 'lot', day).items() if quantity}
+    lots = []
+    for ids in chunked(balances):
+        rows = conn.execute(query + f" WHERE l.id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        lots.extend(dict(row, quantity=balances[row['id']]) for row in rows)
+    return sorted(lots, key=lambda lot: (lot['name'], lot['best_before']))
+
+class SnapshotScheduler:
+    """Brings the stock snapshots up to yesterday every SNAPSHOT_INTERVAL seconds (0 disables it)."""
+
+    def __init__(self):
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        if not app.config['SNAPSHOT_INTERVAL'] or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, name='snapshot-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                with db_connection() as conn:
+                    take_all_snapshots(conn)
+            except Exception as e:
+                print(f"Error taking stock snapshots: {str(e)}")
+            if self.stop_event.wait(app.config['SNAPSHOT_INTERVAL']):
+                break
+
+snapshot_scheduler = SnapshotScheduler()
+
+@app.cli.command('take-snapshots')
+def take_snapshots_command():
+    """Write any missing daily stock snapshots up to yesterday."""
+    with db_connection() as conn:
+        for kind, written in take_all_snapshots(conn).items():
+            click.echo(f'{kind}: {written} snapshot(s) written')
+
+# Yearly Archives
+# Movement columns in table order, so every partition unions the same way
+MOVEMENT_COLUMNS = ('id', 'product_id', 'quantity', 'customer_id', 'movement_type',
+                    'date', 'best_before', 'batch', 'sub_batch', 'dpj', 'note_id')
+
+def archive_schema():
+    """Statements creating an archive file, formatted with {db}.
+
+    Archives stand alone: no foreign keys into the hot database, and their
+    own batch index so the batch filter reaches archived movements.
+    """
+    fts_table, _, columns, tokenize = next(index for index in SEARCH_INDEXES if index[1] == 'movements')
+    return (
+        '''CREATE TABLE {db}.movements (
+            id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            customer_id INTEGER,
+            movement_type TEXT NOT NULL,
+            date TEXT NOT NULL,
+            best_before TEXT NOT NULL,
+            batch TEXT NOT NULL,
+            sub_batch TEXT NOT NULL,
+            dpj TEXT NOT NULL,
+            note_id INTEGER
+        )''',
+        '''CREATE TABLE {db}.movement_lots (
+            movement_id INTEGER NOT NULL,
+            lot_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL
+        )''',
+        'CREATE INDEX {db}.idx_movements_date ON movements (date)',
+        'CREATE INDEX {db}.idx_movements_product ON movements (product_id)',
+        'CREATE INDEX {db}.idx_movements_customer ON movements (customer_id)',
+        'CREATE INDEX {db}.idx_movements_note ON movements (note_id) WHERE note_id IS NOT NULL',
+        'CREATE INDEX {db}.idx_movement_lots_movement ON movement_lots (movement_id)',
+        f'''CREATE VIRTUAL TABLE {{db}}.{fts_table} USING fts5(
+            {', '.join(columns)}, content='movements', content_rowid='id',
+            tokenize="{tokenize}", prefix='2 3'
+        )''',
+        f"INSERT INTO {{db}}.{fts_table} ({fts_table}) VALUES ('rebuild')",
+    )
+
+def archive_boundary(conn):
+    """Last day held by the archives (YYYY-12-31), or None before any year is archived.
+
+    The hot movements table only holds movements after it.
+    """
+    year = conn.execute('SELECT MAX(year) FROM archives').fetchone()[0]
+    return f'{year}-12-31' if year else None
+
+def attach_archives(conn, archives):
+    """Attaches each (year, path) archive as schema archive_<year>, unless it already is.
+
+    Attachments stay with the pooled connection for later queries. Must be
+    called outside a transaction.
+    """
+    attached = {row['name'] for row in conn.execute('PRAGMA database_list')}
+    wanted = {f"archive_{archive['year']}" for archive in archives}
+    for archive in archives:
+        schema = f"archive_{archive['year']}"
+        if schema in attached:
+            continue
+        path = ARCHIVE_DIR / archive['path']
+        # ATTACH would silently create an empty file
+        if not path.exists():
+            raise RuntimeError(f"Archive {archive['year']} introuvable: {path}")
+        try:
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (str(path),))
+        except sqlite3.OperationalError as e:
+            if 'too many attached' not in str(e):
+                raise
+            # SQLite allows 10 attachments by default: drop those not needed here
+            for name in attached - wanted - {'main', 'temp'}:
+                conn.execute(f'DETACH DATABASE {name}')
+            attached &= wanted | {'main', 'temp'}
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (str(path),))
+        attached.add(schema)
+
+def upgrade_archive(path):
+    """Adds note_id to an archive written before delivery notes (see init_db)."""
+    archive = sqlite3.connect(str(path), isolation_level=None,
+                              timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+    try:
+        # Under the write lock, so two processes starting together upgrade it once
+        archive.execute('BEGIN IMMEDIATE')
+        if 'note_id' not in {row[1] for row in archive.execute('PRAGMA table_info(movements)')}:
+            archive.execute('ALTER TABLE movements ADD COLUMN note_id INTEGER')
+            archive.execute('CREATE INDEX idx_movements_note ON movements (note_id) WHERE note_id IS NOT NULL')
+        archive.execute('COMMIT')
+    finally:
+        archive.close()
+
+def movement_schemas(conn, date_from=None, date_to=None):
+    """Partitions holding the movements dated in [date_from, date_to), attached.
+
+    None leaves that end open. 'main' (the hot partition) always comes first,
+    followed by the archived years the range overlaps, so default views,
+    which pass no dates and use ('main',) directly, never open an archive.
+    """
+    archives = [archive for archive in conn.execute('SELECT year, path FROM archives ORDER BY year DESC')
+                if (not date_from or date_from < f"{archive['year'] + 1}-01-01")
+                and (not date_to or date_to > f"{archive['year']}-01-01")]
+    attach_archives(conn, archives)
+    return ['main'] + [f"archive_{archive['year']}" for archive in archives]
+
+def union_partitions(schemas, sql):
+    """`sql` once per schema (as {db}), joined with UNION ALL."""
+    return ' UNION ALL '.join(sql.format(db=schema) for schema in schemas)
+
+def movement_source(schemas=('main',)):
+    """FROM target for movements across the given partitions."""
+    if list(schemas) == ['main']:
+        return 'movements'
+    return '(' + union_partitions(schemas, f"SELECT {', '.join(MOVEMENT_COLUMNS)} FROM {{db}}.movements") + ')'
+
+def find_movement(conn, movement_id):
+    """A movement with its product and customer names, or None.
+
+    Looks in the hot table, then in the archives whose id range covers it;
+    archived_year is NULL for a hot movement.
+    """
+    archives = conn.execute('SELECT year, path FROM archives WHERE ? BETWEEN first_id AND last_id',
+                            (movement_id,)).fetchall()
+    attach_archives(conn, archives)
+    for schema, year in [('main', None)] + [(f"archive_{a['year']}", a['year']) for a in archives]:
+        movement = conn.execute(f'''
+        SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name,
+               ? as archived_year
+        FROM {schema}.movements m
+        LEFT JOIN products p ON m.product_id = p.id
+        LEFT JOIN customers c ON m.customer_id = c.id
+        WHERE m.id = ?
+        ''', (year, movement_id)).fetchone()
+        if movement:
+            return movement
+    return None
+
+def archive_year(year):
+    """Moves a closed year's movements into ARCHIVE_DIR/movements_<year>.db.
+
+    Years are archived oldest first, so the hot table always starts on
+    1 January after archive_boundary. The file is written and checked before
+    anything leaves the hot database; one transaction then deletes the
+    year's movements and lot allocations, adds them to the opening balances
+    (stock per product and per lot, totals per client) and registers the
+    archive. A crash in between leaves an unregistered file that the next
+    run overwrites. Returns the number of movements archived.
+    """
+    if year >= datetime.now().year:
+        raise ValueError(f"L'exercice {year} n'est pas clôturé")
+    start, end = f'{year}-01-01', f'{year + 1}-01-01'
+    path = ARCHIVE_DIR / f"movements_{year}.db"
+    temp_path = path.with_name(f"temp_{path.name}")
+    columns = ', '.join(MOVEMENT_COLUMNS)
+
+    with db_connection() as conn:
+        if conn.execute('SELECT 1 FROM archives WHERE year = ?', (year,)).fetchone():
+            raise ValueError(f"L'exercice {year} est déjà archivé")
+        if conn.execute('SELECT 1 FROM movements WHERE date < ? LIMIT 1', (start,)).fetchone():
+            raise ValueError(f"Archivez d'abord les exercices antérieurs à {year}")
+        # Snapshots up to the year end, so lookups inside it start from a nearby one
+        take_all_snapshots(conn, until=f'{year}-12-31')
+
+        ARCHIVE_DIR.mkdir(exist_ok=True)
+        if temp_path.exists():
+            temp_path.unlink()
+        conn.execute('ATTACH DATABASE ? AS archive_new', (str(temp_path),))
+        try:
+            conn.execute('BEGIN')
+            for statement in archive_schema()[:-1]:
+                conn.execute(statement.format(db='archive_new'))
+            conn.execute(f'''
+            INSERT INTO archive_new.movements ({columns})
+            SELECT {columns} FROM main.movements WHERE date >= ? AND date < ? ORDER BY id
+            ''', (start, end))
+            conn.execute('''
+            INSERT INTO archive_new.movement_lots (movement_id, lot_id, quantity)
+            SELECT ml.movement_id, ml.lot_id, ml.quantity
+            FROM archive_new.movements m JOIN main.movement_lots ml ON ml.movement_id = m.id
+            ''')
+            conn.execute(archive_schema()[-1].format(db='archive_new'))
+            conn.commit()
+            copied = tuple(conn.execute('SELECT COUNT(*), MIN(id), MAX(id) FROM archive_new.movements').fetchone())
+            check = conn.execute('PRAGMA archive_new.integrity_check').fetchone()[0]
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute('DETACH DATABASE archive_new')
+        if not copied[0] or check != 'ok':
+            temp_path.unlink()
+            if not copied[0]:
+                raise ValueError(f"Aucun mouvement à archiver pour {year}")
+            raise RuntimeError(f"Contrôle d'intégrité de l'archive échoué: {check}")
+        os.replace(str(temp_path), str(path))
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            hot = tuple(conn.execute('SELECT COUNT(*), MIN(id), MAX(id) FROM movements WHERE date >= ? AND date < ?',
+                                     (start, end)).fetchone())
+            if hot != copied:
+                raise RuntimeError(f"Les mouvements de {year} ont changé pendant l'archivage, relancez l'archivage")
+
+            conn.execute('''
+            INSERT INTO opening_stock (product_id, quantity)
+            SELECT product_id, SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE -quantity END)
+            FROM movements WHERE date >= ? AND date < ?
+            GROUP BY product_id
+            ON CONFLICT(product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', (start, end))
+            conn.execute('''
+            INSERT INTO opening_lots (lot_id, quantity)
+            SELECT ml.lot_id, SUM(ml.quantity)
+            FROM movements m JOIN movement_lots ml ON ml.movement_id = m.id
+            WHERE m.date >= ? AND m.date < ?
+            GROUP BY ml.lot_id
+            ON CONFLICT(lot_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', (start, end))
+            conn.execute('DELETE FROM opening_stock WHERE quantity = 0')
+            conn.execute('DELETE FROM opening_lots WHERE quantity = 0')
+            conn.execute('''
+            INSERT INTO opening_client_totals (customer_id, total_entry, total_exit)
+            SELECT customer_id,
+                   SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE 0 END),
+                   SUM(CASE WHEN movement_type = 'Exit' THEN quantity ELSE 0 END)
+            FROM movements WHERE date >= ? AND date < ? AND customer_id IS NOT NULL
+            GROUP BY customer_id
+            ON CONFLICT(customer_id) DO UPDATE SET
+                total_entry = total_entry + excluded.total_entry,
+                total_exit = total_exit + excluded.total_exit
+            ''', (start, end))
+
+            conn.execute('''
+            DELETE FROM movement_lots
+            WHERE movement_id IN (SELECT id FROM movements WHERE date >= ? AND date < ?)
+            ''', (start, end))
+            conn.execute('DELETE FROM movements WHERE date >= ? AND date < ?', (start, end))
+            conn.execute('''
+            INSERT INTO archives (year, path, first_id, last_id, movements, archived_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (year, path.name, copied[1], copied[2], copied[0], datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            path.unlink()
+            raise
+    return copied[0]
+
+@app.cli.command('archive-year')
+@click.argument('year', type=int)
+def archive_year_command(year):
+    """Move the movements of closed year YEAR into their own archive file."""
+    try:
+        archived = archive_year(year)
+    except (ValueError, RuntimeError) as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1)
+    click.echo(f'{archived} mouvements archivés dans {ARCHIVE_DIR / f"movements_{year}.db"}')
+
+# Inventory Reconciliation
+def ledger_balances(conn, product_ids=None):
+    """{product_id: quantity} according to the ledger: opening stock plus hot movements.
+
+    One aggregated pass over idx_movements_product_balance, which covers the
+    sum, restricted to product_ids when given.
+    """
+    balances = dict(conn.execute('SELECT product_id, quantity FROM opening_stock').fetchall())
+    query = '''
+    SELECT product_id, SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE -quantity END)
+    FROM movements
+    '''
+    if product_ids is None:
+        chunks = [conn.execute(query + ' GROUP BY product_id')]
+    else:
+        chunks = (conn.execute(query + f" WHERE product_id IN ({','.join('?' * len(ids))}) GROUP BY product_id", ids)
+                  for ids in chunked(product_ids))
+    for rows in chunks:
+        for product_id, delta in rows:
+            balances[product_id] = balances.get(product_id, 0) + delta
+    return balances
+
+def reconcile_inventory(conn, full=False, repair=False):
+    """Checks inventory against the ledger and returns the run as a dict.
+
+    A full run compares every product. An incremental run only checks the
+    products with movements after the previous run's high-water mark, those
+    with movements deleted since (reconcile_dirty, filled by a trigger) and
+    those with no inventory row; it is a full run when there is no previous
+    one. The run holds the write lock, so the ledger and inventory are read
+    at the same point and a repair cannot race a new movement. Each
+    difference is kept in reconcile_drift; with repair, inventory is set to
+    the ledger's figure and the dashboard counters follow through their
+    triggers. Drift reported but not repaired is only checked again by a
+    full run or after the product changes, so it is not mailed every run.
+    """
+    started = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # sqlite_sequence, not MAX(id): deleting the newest movement must not move it back
+        high_water_mark = conn.execute('''
+        SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'movements'), 0)
+        ''').fetchone()[0]
+        last = conn.execute('SELECT high_water_mark FROM reconcile_runs ORDER BY id DESC LIMIT 1').fetchone()
+        full = full or last is None
+        if full:
+            product_ids = [row[0] for row in conn.execute('SELECT id FROM products ORDER BY id')]
+            recorded = dict(conn.execute('SELECT product_id, quantity FROM inventory').fetchall())
+            expected = ledger_balances(conn)
+        else:
+            product_ids = sorted(row[0] for row in conn.execute('''
+            SELECT product_id FROM movements WHERE id > ?
+            UNION SELECT product_id FROM reconcile_dirty
+            UNION SELECT id FROM products WHERE id NOT IN (SELECT product_id FROM inventory)
+            ''', (last['high_water_mark'],)))
+            recorded = {}
+            for ids in chunked(product_ids):
+                recorded.update(conn.execute(f'''
+                SELECT product_id, quantity FROM inventory
+                WHERE product_id IN ({','.join('?' * len(ids))})
+                ''', ids).fetchall())
+            expected = ledger_balances(conn, product_ids)
+
+        # recorded is None when the inventory row is missing altogether
+        drift = [(product_id, recorded.get(product_id), expected.get(product_id, 0))
+                 for product_id in product_ids
+                 if recorded.get(product_id) != expected.get(product_id, 0)]
+        run_id = conn.execute('''
+        INSERT INTO reconcile_runs (started_at, mode, high_water_mark, checked, drifted, repaired, duration_ms)
+        VALUES (?, ?, ?, ?, ?, ?, 0)
+        ''', (datetime.now().isoformat(), 'full' if full else 'incremental', high_water_mark,
+              len(product_ids), len(drift), len(drift) if repair else 0)).lastrowid
+        conn.executemany('''
+        INSERT INTO reconcile_drift (run_id, product_id, recorded, expected) VALUES (?, ?, ?, ?)
+        ''', [(run_id, *row) for row in drift])
+        if repair:
+            conn.executemany('''
+            INSERT INTO inventory (product_id, quantity) VALUES (?, ?)
+            ON CONFLICT(product_id) DO UPDATE SET quantity = excluded.quantity
+            ''', [(product_id, quantity) for product_id, _, quantity in drift])
+        conn.execute('DELETE FROM reconcile_dirty')
+
+        conn.execute('''
+        DELETE FROM reconcile_drift WHERE run_id <= (SELECT COALESCE(MAX(id), 0) - ? FROM reconcile_runs)
+        ''', (app.config['RECONCILE_KEEP_RUNS'],))
+        conn.execute('DELETE FROM reconcile_runs WHERE id <= (SELECT MAX(id) - ? FROM reconcile_runs)',
+                     (app.config['RECONCILE_KEEP_RUNS'],))
+        duration_ms = (time.perf_counter() - started) * 1000
+        conn.execute('UPDATE reconcile_runs SET duration_ms = ? WHERE id = ?', (duration_ms, run_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if repair and drift:
+        alert_engine.notify(product_id for product_id, _, _ in drift)
+    return {'id': run_id, 'mode': 'full' if full else 'incremental', 'checked': len(product_ids),
+            'drift': drift, 'repaired': repair, 'duration_ms': duration_ms}
+
+def reconcile_drift_rows(conn, run_id):
+    return conn.execute('''
+    SELECT d.product_id, p.name, d.recorded, d.expected
+    FROM reconcile_drift d LEFT JOIN products p ON p.id = d.product_id
+    WHERE d.run_id = ?
+    ORDER BY p.name
+    ''', (run_id,)).fetchall()
+
+class ReconciliationScheduler:
+    """Runs an incremental reconcile_inventory() every RECONCILE_INTERVAL seconds (0 disables it).
+
+    Every RECONCILE_FULL_INTERVAL seconds the run is a full one instead.
+    Drift is mailed to ADMINS, and only repaired with RECONCILE_AUTO_REPAIR.
+    """
+
+    def __init__(self):
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        if not app.config['RECONCILE_INTERVAL'] or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, name='inventory-reconciliation', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join(timeout)
+
+    def _run(self):
+        next_full = time.monotonic() + app.config['RECONCILE_FULL_INTERVAL']
+        while not self.stop_event.wait(app.config['RECONCILE_INTERVAL']):
+            full = time.monotonic() >= next_full
+            try:
+                with db_connection() as conn:
+                    run = reconcile_inventory(conn, full=full, repair=app.config['RECONCILE_AUTO_REPAIR'])
+                    if run['drift']:
+                        self.report(run, reconcile_drift_rows(conn, run['id']))
+                if full:
+                    next_full = time.monotonic() + app.config['RECONCILE_FULL_INTERVAL']
+            except Exception as e:
+                print(f"Error reconciling inventory: {str(e)}")
+
+    def report(self, run, rows):
+        action = 'repaired' if run['repaired'] else 'not repaired'
+        text_body = f"Inventory differs from the movements ledger ({action}):\n\n" + \
+                    "\n".join(f"{row['name']}: {'missing' if row['recorded'] is None else row['recorded']} "
+                              f"recorded, {row['expected']} expected" for row in rows)
+        send_email(f"Inventory Drift ({len(rows)} products)", app.config['ADMINS'], text_body)
+
+reconciliation_scheduler = ReconciliationScheduler()
+
+@app.cli.command('reconcile-inventory')
+@click.option('--full', is_flag=True, help='Check every product, not only those changed since the last run.')
+@click.option('--repair', is_flag=True, help='Set inventory to the ledger figure where they differ.')
+def reconcile_inventory_command(full, repair):
+    """Compare inventory with the movements ledger and report or repair drift."""
+    with db_connection() as conn:
+        run = reconcile_inventory(conn, full=full, repair=repair)
+        for row in reconcile_drift_rows(conn, run['id']):
+            recorded = 'absent' if row['recorded'] is None else row['recorded']
+            click.echo(f"{row['name']}: {recorded} en stock, {row['expected']} selon les mouvements")
+    click.echo(f"{run['mode']}: {run['checked']} produit(s) vérifié(s), {len(run['drift'])} écart(s)"
+               f"{' corrigé(s)' if repair else ''} en {run['duration_ms']:.0f} ms")
+    if run['drift'] and not repair:
+        raise SystemExit(1)
+
+# Profile Pictures
+# Stored pictures are named <sha256 of content>.<ext>, thumbnails <sha256>_<size>.jpg
+AVATAR_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+AVATAR_NAME_RE = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+
+def avatar_path(name, size=None):
+    if size is None:
+        return AVATAR_DIR / name
+    return AVATAR_DIR / f"{name.split('.')[0]}_{size}.jpg"
+
+def store_avatar(stream):
+    """Saves an uploaded picture under the hash of its content and returns its name.
+
+    The upload is copied in chunks and hashed on the way, and abandoned as
+    soon as it passes AVATAR_MAX_BYTES. The same picture uploaded twice is
+    stored once. Raises ValueError for oversized or unreadable files.
+    """
+    limit = app.config['AVATAR_MAX_BYTES']
+    digest = hashlib.sha256()
+    size = 0
+    temp_path = AVATAR_DIR / f"temp_{uuid.uuid4().hex}"
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"Photo trop volumineuse ({limit // (1024 * 1024)} Mo au plus)")
+                digest.update(chunk)
+                f.write(chunk)
+        try:
+            with PILImage.open(temp_path) as image:
+                image_format = image.format
+                image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            image_format = None
+        if image_format not in AVATAR_FORMATS:
+            raise ValueError('Format de photo non reconnu (JPEG, PNG, GIF ou WebP)')
+
+        name = f"{digest.hexdigest()}.{AVATAR_FORMATS[image_format]}"
+        if not avatar_path(name).exists():
+            os.replace(str(temp_path), str(avatar_path(name)))
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    thumbnail_worker.enqueue(name)
+    return name
+
+class ThumbnailWorker:
+    """Generates the AVATAR_SIZES thumbnails of stored pictures in the background.
+
+    Each thumbnail is made once: those already on disk are skipped, and on
+    start any picture missing one (after a crash, or a new size) is queued
+    again. Until a thumbnail exists, /avatars serves the original instead.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = Thread(target=self._run, name='thumbnail-worker', daemon=True)
+            self.thread.start()
+        for path in AVATAR_DIR.iterdir():
+            if AVATAR_NAME_RE.match(path.name) and self.missing(path.name):
+                self.queue.put(path.name)
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.queue.put(self._STOP)
+            self.thread.join(timeout)
+
+    def enqueue(self, name):
+        self.start()
+        if self.missing(name):
+            self.queue.put(name)
+
+    @staticmethod
+    def missing(name):
+        return {size: pixels for size, pixels in app.config['AVATAR_SIZES'].items()
+                if not avatar_path(name, size).exists()}
+
+    def _run(self):
+        while True:
+            name = self.queue.get()
+            if name is self._STOP:
+                break
+            try:
+                self.generate(name)
+            except Exception as e:
+                print(f"Error generating thumbnails for {name}: {str(e)}")
+
+    def generate(self, name):
+        missing = self.missing(name)
+        if not missing or not avatar_path(name).exists():
+            return
+        with PILImage.open(avatar_path(name)) as image:
+            image = ImageOps.exif_transpose(image)
+            # JPEG has no alpha: flatten transparent pictures onto white
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGBA')
+                background = PILImage.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            for size, pixels in missing.items():
+                # Square, cropped to the centre, as avatars are shown in circles
+                thumbnail = ImageOps.fit(image, (pixels, pixels), PILImage.Resampling.LANCZOS)
+                path = avatar_path(name, size)
+                temp_path = path.with_name(f"temp_{uuid.uuid4().hex}_{path.name}")
+                thumbnail.save(temp_path, 'JPEG', quality=85, optimize=True)
+                os.replace(str(temp_path), str(path))
+
+thumbnail_worker = ThumbnailWorker()
+
+@app.cli.command('import-profile-pictures')
+def import_profile_pictures_command():
+    """Move pictures uploaded under static/profile_pics into the avatar store."""
+    imported = 0
+    with db_connection() as conn:
+        profiles = conn.execute('''
+        SELECT user_id, profile_picture FROM user_profiles WHERE profile_picture LIKE 'profile_pics/%'
+        ''').fetchall()
+        for profile in profiles:
+            path = Path(app.root_path) / 'static' / profile['profile_picture']
+            if not path.exists():
+                click.echo(f"{profile['profile_picture']}: introuvable", err=True)
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    name = store_avatar(f)
+            except ValueError as e:
+                click.echo(f"{profile['profile_picture']}: {e}", err=True)
+                continue
+            conn.execute('UPDATE user_profiles SET profile_picture = ? WHERE user_id = ?',
+                         (name, profile['user_id']))
+            imported += 1
+        conn.commit()
+    click.echo(f'{imported} photo(s) importée(s)')
+
+# Backup Functions
+backup_lock = Lock()
+
+def backup_db():
+    """Takes an online backup of DB_PATH and returns the path of the .db.gz file.
+
+    The source connection pins one WAL read snapshot for the whole copy, so
+    the page-stepped backup never restarts and writers are not blocked. The
+    archives registered in that snapshot are saved next to it (see
+    backup_archive_path). Every copy is integrity-checked before it is
+    compressed and older backups are pruned.
+    """
+    if not backup_lock.acquire(blocking=False):
+        raise RuntimeError('Une sauvegarde est déjà en cours')
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_path = BACKUP_DIR / f"frozen_backup_{timestamp}.db.gz"
+    temp_paths = []
+    try:
+        source = sqlite3.connect(str(DB_PATH), isolation_level=None,
+                                 timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+        try:
+            source.execute("BEGIN")
+            archives = source.execute("SELECT year, path FROM archives").fetchall()
+            temp_paths.append(compressed_copy(source, backup_path))
+            source.execute("ROLLBACK")
+        finally:
+            source.close()
+        
+        # Archives are only appended to by archive_year, which registers them last
+        for year, path in archives:
+            if not (ARCHIVE_DIR / path).exists():
+                raise RuntimeError(f"Archive {year} introuvable: {ARCHIVE_DIR / path}")
+            source = sqlite3.connect(str(ARCHIVE_DIR / path),
+                                     timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+            try:
+                temp_paths.append(compressed_copy(source, backup_archive_path(backup_path, year)))
+            finally:
+                source.close()
+        
+        # The main file last, so a listed backup always has its archives
+        for temp_path in reversed(temp_paths):
+            os.replace(str(temp_path), str(temp_path.with_name(temp_path.name[len('temp_'):])))
+        apply_backup_retention()
+        return str(backup_path)
+    finally:
+        for path in temp_paths:
+            if path.exists():
+                path.unlink()
+        backup_lock.release()
+
+def compressed_copy(source, gz_path):
+    """Backs up the open `source` database into a temp_ .gz beside gz_path and returns its path."""
+    temp_path = gz_path.with_name(f"temp_{gz_path.name[:-len('.gz')]}")
+    temp_gz_path = gz_path.with_name(f"temp_{gz_path.name}")
+    try:
+        dest = sqlite3.connect(str(temp_path))
+        try:
+            source.backup(dest, pages=app.config['BACKUP_PAGES_PER_STEP'],
+                          sleep=app.config['BACKUP_STEP_SLEEP'])
+            result = dest.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            dest.close()
+        if result != 'ok':
+            raise RuntimeError(f'Contrôle d\'intégrité échoué ({gz_path.name}): {result}')
+        
+        with open(temp_path, 'rb') as src, gzip.open(temp_gz_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return temp_gz_path
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+def backup_archive_path(backup_path, year):
+    """frozen_backup_<time>.db[.gz] -> frozen_backup_<time>_archive_<year>.db[.gz]"""
+    stem, _, suffix = backup_path.name.partition('.db')
+    return backup_path.with_name(f"{stem}_archive_{year}.db{suffix}")
+
+def list_backups():
+    """Returns (taken_at, path) for every backup, newest first."""
+    backups = []
+    for path in BACKUP_DIR.glob("frozen_backup_*.db*"):
+        if '_archive_' in path.name:
+            continue
+        try:
+            taken_at = datetime.strptime(path.name[len("frozen_backup_"):][:15], "%Y%m%d_%H%M%S")
+        except ValueError:
+            continue
+        backups.append((taken_at, path))
+    return sorted(backups, reverse=True)
+
+def apply_backup_retention():
+    """Keeps the newest backup of each of the last N hours, days and ISO weeks."""
+    keep = set()
+    buckets = [
+        (app.config['BACKUP_KEEP_HOURLY'], lambda t: t.strftime('%Y%m%d%H')),
+        (app.config['BACKUP_KEEP_DAILY'], lambda t: t.strftime('%Y%m%d')),
+        (app.config['BACKUP_KEEP_WEEKLY'], lambda t: t.isocalendar()[:2]),
+    ]
+    backups = list_backups()
+    for limit, bucket_of in buckets:
+        seen = []
+        for taken_at, path in backups:
+            bucket = bucket_of(taken_at)
+            if bucket in seen:
+                continue
+            if len(seen) >= limit:
+                break
+            seen.append(bucket)
+            keep.add(path)
+    
+    for _, path in backups:
+        if path not in keep:
+            for archive_path in BACKUP_DIR.glob(backup_archive_path(path, '*').name):
+                archive_path.unlink()
+            path.unlink()
+
+def restore_db(backup_path):
+    """Replaces the contents of DB_PATH with a backup (.db or .db.gz), and its archives.
+
+    Every file of the backup is unpacked and checked before anything is
+    overwritten. An archive missing from the backup (taken before archives
+    were saved) keeps the file already in ARCHIVE_DIR, if there is one.
+    """
+    backup_path = Path(backup_path)
+    temp_path = unpacked_copy(backup_path)
+    archive_temps = []
+    try:
+        source = sqlite3.connect(str(temp_path))
+        try:
+            # Backups taken before archiving existed have no archives table
+            archives = source.execute("SELECT year, path FROM archives").fetchall() \
+                if source.execute("SELECT 1 FROM sqlite_master WHERE name = 'archives'").fetchone() else []
+            for year, path in archives:
+                archive_backup = backup_archive_path(backup_path, year)
+                if archive_backup.exists():
+                    archive_temps.append((unpacked_copy(archive_backup), ARCHIVE_DIR / path))
+                elif not (ARCHIVE_DIR / path).exists():
+                    raise RuntimeError(f"Archive {year} absente de la sauvegarde: {archive_backup}")
+            
+            ARCHIVE_DIR.mkdir(exist_ok=True)
+            for archive_temp, archive_path in archive_temps:
+                os.replace(str(archive_temp), str(archive_path))
+            dest = sqlite3.connect(str(DB_PATH), timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+            try:
+                source.backup(dest)
+            finally:
+                dest.close()
+        finally:
+            source.close()
+    finally:
+        for path in [temp_path] + [archive_temp for archive_temp, _ in archive_temps]:
+            if path.exists():
+                path.unlink()
 
-        # Save to temporary file first
-        wb.save(str(temp_path))
-        
-        # Rename temporary file to original (atomic operation)
-        if EXCEL_LOG_PATH.exists():
-            os.remove(str(EXCEL_LOG_PATH))
-        os.rename(str(temp_path), str(EXCEL_LOG_PATH))
-        
+def unpacked_copy(backup_path):
+    """Decompresses a backup file into BACKUP_DIR, checks it and returns the copy's path."""
+    temp_path = BACKUP_DIR / f"temp_restore_{uuid.uuid4().hex}.db"
+    try:
+        if backup_path.suffix == '.gz':
+            with gzip.open(backup_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        else:
+            shutil.copyfile(str(backup_path), str(temp_path))
+        conn = sqlite3.connect(str(temp_path))
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise RuntimeError(f'Contrôle d\'intégrité échoué ({backup_path.name}): {result}')
+        return temp_path
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+class BackupScheduler:
+    """Runs backup_db() every BACKUP_INTERVAL seconds (0 disables it).
+
+    A run is skipped when a backup newer than the interval already exists, so
+    several app processes sharing DATA_DIR do not all take one.
+    """
+
+    def __init__(self):
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        if not app.config['BACKUP_INTERVAL'] or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join(timeout)
+
+    def _run(self):
+        interval = app.config['BACKUP_INTERVAL']
+        while not self.stop_event.wait(60):
+            backups = list_backups()
+            if backups and (datetime.now() - backups[0][0]).total_seconds() < interval:
+                continue
+            run_backup_job()
+
+def run_backup_job():
+    try:
+        backup_db()
     except Exception as e:
-        print(f"Error updating Excel log: {str(e)}")
+        print(f"Error backing up database: {str(e)}")
 
-def calculate_dates(category, movement_type, product_name, dpj_date=None):
-    # If dpj_date is provided, parse it, otherwise use current date
-    if dpj_date:
-        try:
-            # Parse DD/MM/YYYY format
-            day, month, year = map(int, dpj_date.split('/'))
-            date = datetime(year, month, day)
-        except ValueError:
-            date = datetime.now()
-    else:
-        date = datetime.now()
-    
-    year_short = date.strftime('%y')
-    
-    # Calculate Julian day (1-365)
-    julian_day = date.timetuple().tm_yday
-    
-    # Determine product code
-    product_code = 'X'  # Default code
-    if 'poulet' in product_name.lower():
-        product_code = 'P'
-    elif 'dinde' in product_name.lower():
-        product_code = 'D'
-    
-    # Sub-batch format: AA-JJJ-C
-    sub_batch = f"{year_short}-{julian_day:03d}-{product_code}"
-    
-    # Get current week number
-    week_number = date.isocalendar()[1]
-    
-    # Batch format: AA+C+SS-SS2
-    batch = f"{year_short}{product_code}{week_number}-{week_number+1}"
-    
-    # Calculate best before date based on category
-    if category == 'MSM':
-        bbd = date + timedelta(days=30*12)  # 12 months
-    elif category == 'Offal':
-        bbd = date + timedelta(days=30*9)  # 9 months
-    else:  # Whole or Cut products (18 months)
-        bbd = date + timedelta(days=30*18)  # 18 months
-    
-    return {
-        'best_before': bbd.isoformat(),
-        'batch': batch,
-        'sub_batch': sub_batch,
-    }
+backup_scheduler = BackupScheduler()
 
-def get_alert_status(best_before_date):
-    if isinstance(best_before_date, str):
-        best_before_date = datetime.fromisoformat(best_before_date)
-    
-    delta = (best_before_date - datetime.now()).days
-    
-    if delta < 0:
-        return 'danger'
-    elif delta <= 30:
-        return 'warning'
-    else:
-        return 'success'
+@app.cli.command('backup-db')
+def backup_db_command():
+    """Take a compressed, integrity-checked backup now."""
+    click.echo(backup_db())
 
-def backup_db():
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = BACKUP_DIR / f"frozen_backup_{timestamp}.db"
-    shutil.copy2(str(DB_PATH), str(backup_path))
-    return str(backup_path)
+@app.cli.command('restore-db')
+@click.argument('backup_file')
+def restore_db_command(backup_file):
+    """Restore the database from BACKUP_FILE. Stop the app first."""
+    restore_db(backup_file)
+    click.echo(f'Restored {DB_PATH} from {backup_file}')
 
 # Email Functions
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailQueue:
+    """Bounded outbound mail queue drained by a small worker pool.
+
+    Each worker takes up to MAIL_BATCH_SIZE queued messages and sends them over
+    a single SMTP connection. A failing message is retried with exponential
+    backoff on a fresh connection; after MAIL_MAX_RETRIES attempts, or when
+    the queue is full, it is stored in mail_dead_letters instead.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue = None
+        self.threads = []
+        self.lock = Lock()
+        self.stats = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'rejected': 0,
+                      'batches': 0, 'max_depth': 0}
+
+    def start(self):
+        if self.threads:
+            return
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        for i in range(app.config['MAIL_WORKERS']):
+            thread = Thread(target=self._run, name=f'mail-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=10):
+        for _ in self.threads:
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def put(self, msg):
+        try:
+            self.queue.put_nowait((msg, 0))
+        except queue.Full:
+            self._count('rejected')
+            self.dead_letter(msg, 'Mail queue full')
+            return False
+        with self.lock:
+            self.stats['queued'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        return True
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, depth=self.queue.qsize() if self.queue else 0,
+                        capacity=app.config['MAIL_QUEUE_SIZE'])
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            while len(batch) < app.config['MAIL_BATCH_SIZE']:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                print(f"Error sending email: {str(e)}")
+
+    def _deliver(self, batch):
+        self._count('batches')
+        pending = list(batch)
+        while pending:
+            try:
+                with app.app_context(), mail.connect() as smtp:
+                    while pending:
+                        smtp.send(pending[0][0])
+                        pending.pop(0)
+                        self._count('sent')
+            except Exception as e:
+                msg, attempts = pending.pop(0)
+                attempts += 1
+                if attempts >= app.config['MAIL_MAX_RETRIES']:
+                    self._count('failed')
+                    self.dead_letter(msg, str(e), attempts)
+                    continue
+                self._count('retried')
+                pending.insert(0, (msg, attempts))
+                time.sleep(app.config['MAIL_RETRY_BACKOFF'] * 2 ** (attempts - 1))
+
+    def dead_letter(self, msg, error, attempts=0):
+        try:
+            with db_connection() as conn:
+                conn.execute('''
+                INSERT INTO mail_dead_letters (subject, recipients, body, html, error, attempts, failed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (msg.subject, ','.join(msg.recipients), msg.body, msg.html,
+                      error, attempts, datetime.now().isoformat()))
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error storing undelivered email: {str(e)}")
+
+mail_queue = MailQueue()
 
 def send_email(subject, recipients, text_body, html_body=None):
     msg = Message(subject, recipients=recipients)
     msg.body = text_body
     if html_body:
         msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    return mail_queue.put(msg)
 
-def check_inventory_alerts():
-    with db_connection() as conn:
-        # Low stock alert
-        low_stock = conn.execute('''
-        SELECT p.name, i.quantity 
+def chunked(items, size=500):
+    # Keeps IN (...) lists under SQLite's bound-parameter limit
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def check_inventory_alerts(conn, product_ids):
+    """Returns the low-stock and expiring rows for the given products."""
+    now = datetime.now()
+    low_stock, expiring = [], []
+    for ids in chunked(product_ids):
+        placeholders = ','.join('?' * len(ids))
+        low_stock += conn.execute(f'''
+        SELECT p.id, p.name, i.quantity 
         FROM inventory i
         JOIN products p ON i.product_id = p.id
-        WHERE i.quantity < ?
-        ''', (app.config['LOW_STOCK_THRESHOLD'],)).fetchall()
-        
-        if low_stock:
-            subject = f"Low Stock Alert ({len(low_stock)} items)"
-            text_body = "The following items are low on stock:\n\n" + \
-                       "\n".join([f"{item['name']}: {item['quantity']} remaining" for item in low_stock])
-            html_body = render_template('email/low_stock_alert.html', 
-                                      items=low_stock,
-                                      threshold=app.config['LOW_STOCK_THRESHOLD'])
-            send_email(subject, app.config['ADMINS'], text_body, html_body)
-        
-        # Expiring soon alert
-        expiring = conn.execute('''
-        SELECT p.name, m.best_before, 
-               julianday(m.best_before) - julianday('now') as days_left
-        FROM movements m
-        JOIN products p ON m.product_id = p.id
-        WHERE m.best_before > datetime('now') 
-          AND julianday(m.best_before) - julianday('now') <= ?
-        GROUP BY m.product_id
-        ''', (app.config['EXPIRING_SOON_DAYS'],)).fetchall()
+        WHERE i.quantity < ? AND i.product_id IN ({placeholders})
+        ''', [app.config['LOW_STOCK_THRESHOLD'], *ids]).fetchall()
         
-        if expiring:
-            subject = f"Expiring Products Alert ({len(expiring)} items)"
-            text_body = "The following products will expire soon:\n\n" + \
-                       "\n".join([f"{item['name']}: {item['best_before'][:10]} ({int(item['days_left'])} days)" for item in expiring])
-            html_body = render_template('email/expiring_alert.html', 
-                                      items=expiring,
-                                      days=app.config['EXPIRING_SOON_DAYS'])
-            send_email(subject, app.config['ADMINS'], text_body, html_body)
+        expiring += conn.execute(f'''
+        SELECT p.id, p.name, MIN(l.best_before) as best_before, 
+               julianday(MIN(l.best_before)) - julianday(?) as days_left
+        FROM lots l
+        JOIN products p ON l.product_id = p.id
+        WHERE l.quantity > 0 AND l.best_before > ? AND l.best_before <= ?
+          AND l.product_id IN ({placeholders})
+        GROUP BY l.product_id
+        ''', [now.isoformat(), now.isoformat(),
+              (now + timedelta(days=app.config['EXPIRING_SOON_DAYS'])).isoformat(), *ids]).fetchall()
+    return low_stock, expiring
+
+class InventoryAlertEngine:
+    """Evaluates stock alerts off the request path.
+
+    Movements only report the products they touched. Every
+    ALERT_DIGEST_INTERVAL seconds those products are re-checked against the
+    active_alerts table, and only alerts that were not already active are
+    mailed, as one digest per alert type. Products that recover are cleared
+    so they can alert again later. Expiry also changes with time alone, so
+    every product is re-checked each ALERT_SWEEP_INTERVAL seconds.
+
+    New alerts are only recorded as active once their digest has been
+    handed to the mail queue; if it was not (shutdown, a send error), they
+    are raised again on a later run.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+        self.base_url = 'http://localhost/'
+        self.next_sweep = 0
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, name='inventory-alerts', daemon=True)
+        self.thread.start()
+
+    def notify(self, product_ids):
+        if has_request_context():
+            # Kept for the _external links in the email templates
+            self.base_url = request.host_url
+        with self.lock:
+            self.pending.update(int(product_id) for product_id in product_ids)
+
+    def stop(self, timeout=10):
+        if self.thread and self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            stopping = self.stop_event.wait(app.config['ALERT_DIGEST_INTERVAL'])
+            try:
+                self.run_once(send=not stopping)
+            except Exception as e:
+                print(f"Error checking inventory alerts: {str(e)}")
+            if stopping:
+                break
+
+    def run_once(self, send=True):
+        with self.lock:
+            product_ids, self.pending = self.pending, set()
+
+        with db_connection() as conn:
+            if time.monotonic() >= self.next_sweep:
+                product_ids = {row['id'] for row in conn.execute('SELECT id FROM products')}
+                self.next_sweep = time.monotonic() + app.config['ALERT_SWEEP_INTERVAL']
+            if not product_ids:
+                return
+
+            low_stock, expiring = check_inventory_alerts(conn, product_ids)
+            raised_low, cleared_low = self._transition(conn, 'low_stock', product_ids, low_stock)
+            raised_expiring, cleared_expiring = self._transition(conn, 'expiring', product_ids, expiring)
+
+        if send:
+            try:
+                self.send_digest(raised_low, raised_expiring)
+            except Exception:
+                # Nothing was recorded: check these products again next time
+                with self.lock:
+                    self.pending.update(product_ids)
+                raise
+        else:
+            raised_low, raised_expiring = [], []
+
+        with db_connection() as conn:
+            self._record(conn, 'low_stock', raised_low, cleared_low)
+            self._record(conn, 'expiring', raised_expiring, cleared_expiring)
+            conn.commit()
+
+    def _transition(self, conn, alert_type, product_ids, current):
+        """(newly raised rows, cleared product ids) for product_ids, against active_alerts."""
+        active = set()
+        for ids in chunked(product_ids):
+            active.update(row['product_id'] for row in conn.execute(f'''
+            SELECT product_id FROM active_alerts
+            WHERE alert_type = ? AND product_id IN ({','.join('?' * len(ids))})
+            ''', [alert_type, *ids]))
+
+        current_ids = {row['id'] for row in current}
+        return [row for row in current if row['id'] not in active], active - current_ids
+
+    def _record(self, conn, alert_type, raised, cleared):
+        conn.executemany('''
+        INSERT OR IGNORE INTO active_alerts (alert_type, product_id, raised_at) VALUES (?, ?, ?)
+        ''', [(alert_type, row['id'], datetime.now().isoformat()) for row in raised])
+        conn.executemany('''
+        DELETE FROM active_alerts WHERE alert_type = ? AND product_id = ?
+        ''', [(alert_type, product_id) for product_id in cleared])
+
+    def send_digest(self, low_stock, expiring):
+        with app.test_request_context(base_url=self.base_url):
+            if low_stock:
+                subject = f"Low Stock Alert ({len(low_stock)} items)"
+                text_body = "The following items are low on stock:\n\n" + \
+                           "\n".join([f"{item['name']}: {item['quantity']} remaining" for item in low_stock])
+                html_body = render_template('email/low_stock_alert.html', 
+                                          items=low_stock,
+                                          threshold=app.config['LOW_STOCK_THRESHOLD'])
+                send_email(subject, app.config['ADMINS'], text_body, html_body)
+            
+            if expiring:
+                subject = f"Expiring Products Alert ({len(expiring)} items)"
+                text_body = "The following products will expire soon:\n\n" + \
+                           "\n".join([f"{item['name']}: {item['best_before'][:10]} ({int(item['days_left'])} days)" for item in expiring])
+                html_body = render_template('email/expiring_alert.html', 
+                                          items=expiring,
+                                          days=app.config['EXPIRING_SOON_DAYS'])
+                send_email(subject, app.config['ADMINS'], text_body, html_body)
+
+alert_engine = InventoryAlertEngine()
 
 # Authentication Decorators
 def login_required(f):
@@ -397,11 +3143,6 @@ def manager_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Initialize systems
-with app.app_context():
-    init_db()
-    init_excel_log()
-
 # Routes
 @app.route('/')
 @login_required
@@ -438,16 +3179,61 @@ def logout():
 @app.route('/inventory')
 @login_required
 def inventory_report():
+    # ?as_of=YYYY-MM-DD gives the stock at the close of that day
+    as_of = request.args.get('as_of', '') if parse_date_arg(request.args.get('as_of')) else ''
+    show_lots = bool(request.args.get('lots'))
     with db_connection() as conn:
-        inventory = conn.execute('''
-        SELECT p.id, p.name, p.family, p.category, 
-               COALESCE(i.quantity, 0) as quantity
-        FROM products p
-        LEFT JOIN inventory i ON p.id = i.product_id
-        ORDER BY p.name
-        ''').fetchall()
+        inventory = inventory_as_of(conn, as_of or None)
+        lots = lots_as_of(conn, as_of or None) if show_lots else []
+    
+    return render_template('inventory.html', inventory=inventory, lots=lots,
+                           as_of=as_of, show_lots=show_lots)
+
+INVENTORY_EXPORT_HEADERS = ["Produit", "Famille", "Catégorie", "Quantité"]
+LOT_EXPORT_HEADERS = ["Produit", "Famille", "Catégorie", "N° Lot", "Sous-Lot", "DLC", "Quantité"]
+
+@app.route('/export_inventory')
+@login_required
+def export_inventory():
+    """Exports the inventory, or its lots with ?lots=1, at ?as_of=YYYY-MM-DD or now."""
+    as_of = request.args.get('as_of', '') if parse_date_arg(request.args.get('as_of')) else ''
+    show_lots = bool(request.args.get('lots'))
+    with db_connection() as conn:
+        if show_lots:
+            headers = LOT_EXPORT_HEADERS
+            rows = [[lot['name'], lot['family'], lot['category'], lot['batch'], lot['sub_batch'],
+                     lot['best_before'][:10], lot['quantity']]
+                    for lot in lots_as_of(conn, as_of or None)]
+        else:
+            headers = INVENTORY_EXPORT_HEADERS
+            rows = [[item['name'], item['family'], item['category'], item['quantity']]
+                    for item in inventory_as_of(conn, as_of or None)]
+    filename = f"{'lots' if show_lots else 'inventaire'}_{as_of or datetime.now().strftime('%Y-%m-%d')}"
+    
+    if request.args.get('format') == 'csv':
+        buffer = io.StringIO()
+        buffer.write('\ufeff')  # BOM so Excel detects UTF-8
+        writer = csv.writer(buffer)
+        writer.writerow(headers)
+        writer.writerows(rows)
+        return Response(buffer.getvalue(), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
     
-    return render_template('inventory.html', inventory=inventory)
+    output = io.BytesIO()
+    wb = xlsxwriter.Workbook(output, {'in_memory': True})
+    ws = wb.add_worksheet("Lots" if show_lots else "Inventaire")
+    ws.write_row(0, 0, headers)
+    for row_num, row in enumerate(rows, 1):
+        ws.write_row(row_num, 0, row)
+    wb.close()
+    output.seek(0)
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f"{filename}.xlsx",
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
 
 @app.route('/profile')
 @login_required
@@ -461,23 +3247,61 @@ def view_profile():
         ''', (session['user_id'],)).fetchone()
     return render_template('profile.html', profile=profile, user_id=session['user_id'])
 
+def profile_picture_upload():
+    """Stores this request's profile_picture upload, if any, and returns its name.
+
+    Oversized requests are refused from Content-Length, before the body is
+    parsed. Raises ValueError, like store_avatar.
+    """
+    # Leaves room for the other form fields and the multipart framing
+    if (request.content_length or 0) > app.config['AVATAR_MAX_BYTES'] + 64 * 1024:
+        raise ValueError(f"Photo trop volumineuse ({app.config['AVATAR_MAX_BYTES'] // (1024 * 1024)} Mo au plus)")
+    file = request.files.get('profile_picture')
+    if not file or file.filename == '':
+        return None
+    return store_avatar(file.stream)
+
+@app.template_global()
+def avatar_url(profile_picture, size='medium'):
+    # Pictures uploaded before the avatar store are still under static/
+    if profile_picture.startswith('profile_pics/'):
+        return url_for('static', filename=profile_picture)
+    return url_for('avatar', size=size, name=profile_picture)
+
+@app.route('/avatars/<size>/<name>')
+@login_required
+def avatar(size, name):
+    if not AVATAR_NAME_RE.match(name) or (size != 'original' and size not in app.config['AVATAR_SIZES']):
+        abort(404)
+    # A name is the hash of its content, so the file behind a URL never changes
+    path = avatar_path(name, None if size == 'original' else size)
+    immutable = path.exists()
+    if not immutable:
+        # Thumbnail not generated yet: stand in with the original, briefly
+        path = avatar_path(name)
+        if not path.exists():
+            abort(404)
+        thumbnail_worker.enqueue(name)
+    response = send_file(str(path), max_age=app.config['AVATAR_CACHE_MAX_AGE'] if immutable else 60,
+                         conditional=True)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = immutable
+    return response
+
 @app.route('/profile/edit', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     if request.method == 'POST':
+        # Handle file upload first, so an oversized body is refused unread
+        try:
+            profile_picture = profile_picture_upload()
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_profile'))
         full_name = request.form.get('full_name')
         email = request.form.get('email')
         
-        # Handle file upload
-        profile_picture = None
-        if 'profile_picture' in request.files:
-            file = request.files['profile_picture']
-            if file.filename != '':
-                filename = secure_filename(file.filename)
-                profile_pic_path = os.path.join(app.root_path, 'static', 'profile_pics', filename)
-                file.save(profile_pic_path)
-                profile_picture = f'profile_pics/{filename}'
-        
         with db_connection() as conn:
             try:
                 conn.execute('''
@@ -507,20 +3331,16 @@ def edit_profile():
 @admin_required  # Only admins can access this route
 def admin_edit_profile(user_id):
     if request.method == 'POST':
+        # Handle file upload first, so an oversized body is refused unread
+        try:
+            profile_picture = profile_picture_upload()
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('admin_edit_profile', user_id=user_id))
         full_name = request.form.get('full_name')
         email = request.form.get('email')
         role = request.form.get('role')
         
-        # Handle file upload
-        profile_picture = None
-        if 'profile_picture' in request.files:
-            file = request.files['profile_picture']
-            if file.filename != '':
-                filename = secure_filename(file.filename)
-                profile_pic_path = os.path.join(app.root_path, 'static', 'profile_pics', filename)
-                file.save(profile_pic_path)
-                profile_picture = f'profile_pics/{filename}'
-        
         with db_connection() as conn:
             try:
                 # Update user profile
@@ -570,51 +3390,72 @@ def admin_view_profile(user_id):
     return render_template('admin_view_profile.html', profile=profile, user_id=user_id)
     
     return render_template('admin_view_profile.html', profile=profile)
+
+# Dashboard Routes
+_dashboard_cache = {'expires': 0, 'data': None}
+_dashboard_lock = Lock()
+
+def dashboard_data():
+    """Returns the dashboard queries, cached in-process for DASHBOARD_CACHE_TTL seconds.
+
+    The stock totals come from dashboard_counters and recent movements from
+    idx_movements_date, so those cost the same whatever the history size. The
+    critical and expiring lists still grow with the number of products they
+    list: they are range scans on idx_inventory_quantity and the on-hand lots.
+    """
+    with _dashboard_lock:
+        if time.monotonic() < _dashboard_cache['expires']:
+            return _dashboard_cache['data']
+        
+        with db_connection() as conn:
+            # Critical inventory (range scan on idx_inventory_quantity)
+            critical = conn.execute('''
+            SELECT p.name, p.family, p.category, i.quantity
+            FROM inventory i
+            JOIN products p ON i.product_id = p.id
+            WHERE i.quantity < ?
+            ORDER BY i.quantity ASC
+            ''', (app.config['LOW_STOCK_THRESHOLD'],)).fetchall()
+            
+            # Expiring soon (lots still on hand only)
+            now = datetime.now()
+            expiring = conn.execute('''
+            SELECT p.name, p.family, p.category, 
+                   MIN(l.best_before) as best_before, 
+                   julianday(MIN(l.best_before)) - julianday(?) as days_left
+            FROM lots l
+            JOIN products p ON l.product_id = p.id
+            WHERE l.quantity > 0 AND l.best_before > ? AND l.best_before <= ?
+            GROUP BY l.product_id
+            ORDER BY days_left ASC
+            ''', (now.isoformat(), now.isoformat(),
+                  (now + timedelta(days=app.config['EXPIRING_SOON_DAYS'])).isoformat())).fetchall()
+            
+            # Recent movements
+            recent_movements = conn.execute('''
+            SELECT m.date, p.name, m.quantity, m.movement_type, 
+                   c.name as customer_name
+            FROM movements m
+            JOIN products p ON m.product_id = p.id
+            LEFT JOIN customers c ON m.customer_id = c.id
+            ORDER BY m.date DESC, m.id DESC
+            LIMIT 10
+            ''').fetchall()
+            
+            # Inventory summary (maintained by the trg_dashboard_inventory_* triggers)
+            inventory_summary = conn.execute('''
+            SELECT out_of_stock, low_stock, in_stock
+            FROM dashboard_counters WHERE id = 1
+            ''').fetchone()
+        
+        _dashboard_cache['data'] = (critical, expiring, recent_movements, inventory_summary)
+        _dashboard_cache['expires'] = time.monotonic() + app.config['DASHBOARD_CACHE_TTL']
+        return _dashboard_cache['data']
+
 @app.route('/dashboard')
 @manager_required
 def dashboard():
-    with db_connection() as conn:
-        # Critical inventory
-        critical = conn.execute('''
-        SELECT p.name, p.family, p.category, i.quantity
-        FROM inventory i
-        JOIN products p ON i.product_id = p.id
-        WHERE i.quantity < ?
-        ORDER BY i.quantity ASC
-        ''', (app.config['LOW_STOCK_THRESHOLD'],)).fetchall()
-        
-        # Expiring soon
-        expiring = conn.execute('''
-        SELECT p.name, p.family, p.category, 
-               m.best_before, 
-               julianday(m.best_before) - julianday('now') as days_left
-        FROM movements m
-        JOIN products p ON m.product_id = p.id
-        WHERE m.best_before > datetime('now') 
-          AND julianday(m.best_before) - julianday('now') <= ?
-        GROUP BY m.product_id
-        ORDER BY days_left ASC
-        ''', (app.config['EXPIRING_SOON_DAYS'],)).fetchall()
-        
-        # Recent movements
-        recent_movements = conn.execute('''
-        SELECT m.date, p.name, m.quantity, m.movement_type, 
-               c.name as customer_name
-        FROM movements m
-        JOIN products p ON m.product_id = p.id
-        LEFT JOIN customers c ON m.customer_id = c.id
-        ORDER BY m.date DESC
-        LIMIT 10
-        ''').fetchall()
-        
-        # Inventory summary
-        inventory_summary = conn.execute('''
-        SELECT 
-            COUNT(CASE WHEN quantity = 0 THEN 1 END) as out_of_stock,
-            COUNT(CASE WHEN quantity > 0 AND quantity < ? THEN 1 END) as low_stock,
-            COUNT(CASE WHEN quantity >= ? THEN 1 END) as in_stock
-        FROM inventory
-        ''', (app.config['LOW_STOCK_THRESHOLD'], app.config['LOW_STOCK_THRESHOLD'])).fetchone()
+    critical, expiring, recent_movements, inventory_summary = dashboard_data()
     
     return render_template('dashboard.html',
                          critical=critical,
@@ -625,207 +3466,587 @@ def dashboard():
                          expiring_days=app.config['EXPIRING_SOON_DAYS'])
 
 # Movement Routes
-@app.route('/movements')
-@login_required
-def movements():
-    product_filter = request.args.get('product', '')
-    date_from = request.args.get('date_from', '')
-    date_to = request.args.get('date_to', '')
-    movement_type = request.args.get('movement_type', '')
-    
-    with db_connection() as conn:
-        query = '''
-        SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name
-        FROM movements m
+def parse_date_arg(value):
+    # Filters come from <input type="date"> as YYYY-MM-DD; ignore anything else
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def encode_cursor(row):
+    return f"{row['date']}|{row['id']}"
+
+def decode_cursor(cursor):
+    try:
+        date, movement_id = cursor.rsplit('|', 1)
+        return date, int(movement_id)
+    except (AttributeError, ValueError):
+        return None
+
+def movements_query(schemas=('main',)):
+    """Movement listing SELECT; its parameters start with expiry_status_params()."""
+    return f'''
+        SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name,
+               {expiry_status_sql()} as expiry_status
+        FROM {movement_source(schemas)} m
         LEFT JOIN products p ON m.product_id = p.id
         LEFT JOIN customers c ON m.customer_id = c.id
         WHERE 1=1
         '''
+
+# Search
+def fts_query(text, column=None):
+    """Turns user input into an FTS5 query where every word is a prefix.
+
+    Returns None when the input has nothing searchable in it.
+    """
+    terms = [term.replace('"', '""') for term in text.split() if any(ch.isalnum() for ch in term)]
+    if not terms:
+        return None
+    query = ' '.join(f'"{term}"*' for term in terms)
+    return f'{column} : ({query})' if column else query
+
+def search_products(conn, text, limit=10):
+    query = fts_query(text)
+    if not query:
+        return []
+    return conn.execute('''
+    WITH hits AS (
+        SELECT rowid, rank FROM products_fts WHERE products_fts MATCH ? ORDER BY rank LIMIT ?
+    )
+    SELECT p.id, p.name, p.family, p.category
+    FROM hits JOIN products p ON p.id = hits.rowid
+    ORDER BY hits.rank
+    ''', (query, limit)).fetchall()
+
+def search_customers(conn, text, limit=10):
+    query = fts_query(text)
+    if not query:
+        return []
+    return conn.execute('''
+    WITH hits AS (
+        SELECT rowid, rank FROM customers_fts WHERE customers_fts MATCH ? ORDER BY rank LIMIT ?
+    )
+    SELECT c.id, c.name, c.ville, c.ice
+    FROM hits JOIN customers c ON c.id = hits.rowid
+    ORDER BY hits.rank
+    ''', (query, limit)).fetchall()
+
+def search_batches(conn, text, limit=10, scan=5000):
+    """Distinct batch codes among the newest `scan` matching movements."""
+    query = fts_query(text)
+    if not query:
+        return []
+    return conn.execute('''
+    WITH hits AS (
+        SELECT rowid FROM batches_fts WHERE batches_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+    )
+    SELECT m.batch, m.sub_batch, p.name AS product_name,
+           COUNT(*) AS movements, MAX(m.date) AS last_date
+    FROM hits
+    JOIN movements m ON m.id = hits.rowid
+    JOIN products p ON p.id = m.product_id
+    GROUP BY m.batch, m.sub_batch, m.product_id
+    ORDER BY last_date DESC
+    LIMIT ?
+    ''', (query, scan, limit)).fetchall()
+
+def movement_filters(conn, args):
+    """Reads the /movements filters and returns (filters, schemas, where_sql, params).
+
+    schemas are the partitions to read: only the hot one unless a date
+    filter is given, in which case the archived years it reaches are
+    attached and read too.
+    """
+    filters = {
+        'product': args.get('product', ''),
+        'batch': args.get('batch', ''),
+        'date_from': args.get('date_from', ''),
+        'date_to': args.get('date_to', ''),
+        'movement_type': args.get('movement_type', '')
+    }
+    date_from = filters['date_from'] if parse_date_arg(filters['date_from']) else None
+    date_to = (parse_date_arg(filters['date_to']) + timedelta(days=1)).strftime('%Y-%m-%d') \
+        if parse_date_arg(filters['date_to']) else None
+    schemas = movement_schemas(conn, date_from, date_to) if date_from or date_to else ['main']
+    query = ''
+    params = []
+    
+    # Word-prefix matches through the search indexes instead of LIKE '%...%' scans
+    if fts_query(filters['product']):
+        query += ' AND m.product_id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)'
+        params.append(fts_query(filters['product'], 'name'))
+    
+    # Each partition has its own batch index
+    if fts_query(filters['batch']):
+        query += ' AND m.id IN (' + union_partitions(
+            schemas, 'SELECT rowid FROM {db}.batches_fts WHERE batches_fts MATCH ?') + ')'
+        params.extend([fts_query(filters['batch'])] * len(schemas))
+    
+    # Compare the stored ISO strings directly so idx_movements_date is used
+    if date_from:
+        query += ' AND m.date >= ?'
+        params.append(date_from)
         
-        params = []
+    if date_to:
+        query += ' AND m.date < ?'
+        params.append(date_to)
         
-        if product_filter:
-            query += ' AND p.name LIKE ?'
-            params.append(f'%{product_filter}%')
-            
-        if date_from:
-            query += ' AND date(m.date) >= ?'
-            params.append(date_from)
-            
-        if date_to:
-            query += ' AND date(m.date) <= ?'
-            params.append(date_to)
-            
-        if movement_type:
-            query += ' AND m.movement_type = ?'
-            params.append(movement_type)
+    if filters['movement_type']:
+        query += ' AND m.movement_type = ?'
+        params.append(filters['movement_type'])
+    
+    return filters, schemas, query, params
+
+@app.route('/movements')
+@login_required
+def movements():
+    per_page = min(max(request.args.get('per_page', app.config['MOVEMENTS_PER_PAGE'], type=int), 1),
+                   app.config['MOVEMENTS_MAX_PER_PAGE'])
+    cursor = decode_cursor(request.args.get('cursor'))
+    
+    with db_connection() as conn:
+        current_filters, schemas, where, params = movement_filters(conn, request.args)
+        query = movements_query(schemas) + where
+        params = expiry_status_params() + params
+        
+        # Keyset pagination: continue after the last (date, id) of the previous page
+        if cursor:
+            query += ' AND m.date <= ? AND (m.date < ? OR m.id < ?)'
+            params.extend([cursor[0], cursor[0], cursor[1]])
             
-        query += ' ORDER BY m.date DESC'
+        query += ' ORDER BY m.date DESC, m.id DESC LIMIT ?'
+        params.append(per_page + 1)
+        
+        movements = conn.execute(query, params).fetchall()
+        archived_through = archive_boundary(conn)
+    
+    next_cursor = encode_cursor(movements[per_page - 1]) if len(movements) > per_page else None
+    
+    return render_template('movements.html', 
+                         movements=movements[:per_page], 
+                         status_labels=EXPIRY_STATUS_LABELS,
+                         next_cursor=next_cursor,
+                         is_first_page=cursor is None,
+                         archived_through=archived_through,
+                         current_filters=dict(current_filters, per_page=per_page))
+
+@app.route('/export_movements')
+@login_required
+def export_movements():
+    """Streams the filtered movements as CSV or XLSX without loading them all."""
+    def filtered_rows(conn):
+        _, schemas, where, params = movement_filters(conn, request.args)
+        return conn.execute(movements_query(schemas) + where + ' ORDER BY m.date DESC, m.id DESC',
+                            expiry_status_params() + params)
+    
+    export_format = request.args.get('format', 'xlsx')
+    filename = f"mouvements_{datetime.now().strftime('%Y%m%d_%H%M')}"
+    
+    if export_format == 'csv':
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            buffer.write('\ufeff')  # BOM so Excel detects UTF-8
+            writer.writerow(EXCEL_LOG_HEADERS)
+            with db_connection() as conn:
+                rows = filtered_rows(conn)
+                while True:
+                    batch = rows.fetchmany(1000)
+                    if not batch:
+                        break
+                    writer.writerows(excel_log_row(row) for row in batch)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        
+        return Response(stream_with_context(generate()), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+    
+    # constant_memory flushes each row to disk, and the workbook itself is
+    # assembled in a temporary file rather than in RAM
+    output = tempfile.TemporaryFile()
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True})
+    ws = wb.add_worksheet("Mouvements")
+    ws.write_row(0, 0, EXCEL_LOG_HEADERS)
+    row_num, sheet_num = 1, 1
+    with db_connection() as conn:
+        rows = filtered_rows(conn)
+        while True:
+            batch = rows.fetchmany(1000)
+            if not batch:
+                break
+            for row in batch:
+                if row_num >= EXCEL_MAX_ROWS:
+                    sheet_num += 1
+                    ws = wb.add_worksheet(f"Mouvements ({sheet_num})")
+                    ws.write_row(0, 0, EXCEL_LOG_HEADERS)
+                    row_num = 1
+                ws.write_row(row_num, 0, excel_log_row(row))
+                row_num += 1
+    wb.close()
+    output.seek(0)
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f"{filename}.xlsx",
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+@app.route('/add_movement', methods=['GET', 'POST'])
+@manager_required
+def add_movement():
+    if request.method == 'POST':
+        try:
+            product_id = int(request.form['product_id'])
+            # Written by movement_writer, grouped with concurrent submissions
+            movement_id, = movement_writer.submit([(
+                product_id,
+                int(request.form['quantity']),
+                request.form['movement_type'],
+                request.form.get('customer_id') or None,
+                request.form['dpj'],  # Manually entered DPJ
+            )])
+        except MovementRejected as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('add_movement'))
+        except Exception as e:
+            flash(f'Error: {str(e)}', 'danger')
+            return redirect(url_for('add_movement'))
+        
+        update_excel_log(movement_id)
+        alert_engine.notify([product_id])
+        flash('Movement recorded successfully', 'success')
+        return redirect(url_for('view_receipt', movement_id=movement_id))
+    
+    # Products and customers are picked through /autocomplete
+    return render_template('add_movement.html')
+
+@app.route('/autocomplete')
+@login_required
+def autocomplete():
+    kind = request.args.get('kind', 'product')
+    text = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    
+    with db_connection() as conn:
+        if kind == 'product':
+            items = [{'id': row['id'], 'label': row['name'],
+                      'detail': f"{row['family']} - {row['category']}",
+                      'family': row['family'], 'category': row['category']}
+                     for row in search_products(conn, text, limit)]
+        elif kind == 'customer':
+            items = [{'id': row['id'], 'label': row['name'],
+                      'detail': ' · '.join(value for value in (row['ville'], row['ice']) if value)}
+                     for row in search_customers(conn, text, limit)]
+        elif kind == 'batch':
+            items = [{'id': None, 'label': f"{row['batch']} {row['sub_batch']}",
+                      'detail': f"{row['product_name']} · {row['movements']} mouvement(s)"}
+                     for row in search_batches(conn, text, limit)]
+        else:
+            return api_error(f'Unknown kind: {kind}')
+    
+    response = Response(json.dumps(items, separators=(',', ':'), ensure_ascii=False),
+                        mimetype='application/json')
+    response.cache_control.private = True
+    return response
+
+@app.route('/search')
+@login_required
+def search():
+    text = request.args.get('q', '').strip()
+    with db_connection() as conn:
+        products = search_products(conn, text, 20)
+        customers = search_customers(conn, text, 20)
+        batches = search_batches(conn, text, 20)
+    return render_template('search.html', q=text,
+                           products=products, customers=customers, batches=batches)
+
+
+# Bulk Import
+IMPORT_COLUMNS = {
+    'product': ('product', 'produit', 'product_id'),
+    'quantity': ('quantity', 'quantité', 'quantite', 'qté', 'qte'),
+    'movement_type': ('movement_type', 'type'),
+    'customer': ('customer', 'client', 'customer_id'),
+    'dpj': ('dpj',),
+}
+IMPORT_TYPES = {'entry': 'Entry', 'entrée': 'Entry', 'entree': 'Entry',
+                'exit': 'Exit', 'sortie': 'Exit'}
+
+def read_import_rows(stream, filename):
+    """Yields (line_number, {column: value}) from an uploaded CSV or XLSX file."""
+    if filename.lower().endswith('.xlsx'):
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, None) or []
+            for line_number, values in enumerate(rows, start=2):
+                yield line_number, dict(zip(header, values))
+        finally:
+            wb.close()
+        return
+    
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for line_number, row in enumerate(csv.DictReader(text, dialect=dialect), start=2):
+        yield line_number, row
+
+def import_movements(conn, rows):
+    """Validates and inserts movements in one transaction.
+
+    rows is an iterable of (line_number, {column: value}). Returns
+    (movement_ids, errors); when errors is non-empty nothing is written.
+    """
+    products = conn.execute('SELECT * FROM products').fetchall()
+    product_map = {str(p['id']): p for p in products}
+    product_map.update((p['name'].strip().lower(), p) for p in products)
+    customers = conn.execute('SELECT id, name FROM customers').fetchall()
+    customer_map = {str(c['id']): c['id'] for c in customers}
+    customer_map.update((c['name'].strip().lower(), c['id']) for c in customers)
+    
+    dates_cache = {}
+    movements, errors = [], []
+    now = datetime.now().isoformat()
+    
+    for line_number, raw in rows:
+        row = {}
+        for key, value in raw.items():
+            if key is None:
+                continue
+            key = str(key).strip().lower()
+            for column, aliases in IMPORT_COLUMNS.items():
+                if key in aliases:
+                    row[column] = '' if value is None else str(value).strip()
+        if not any(row.values()):
+            continue
+        
+        product = product_map.get(row.get('product', '').lower())
+        if not product:
+            errors.append((line_number, f"Produit inconnu: {row.get('product', '')}"))
+            continue
+        movement_type = IMPORT_TYPES.get(row.get('movement_type', '').lower())
+        if not movement_type:
+            errors.append((line_number, f"Type invalide: {row.get('movement_type', '')}"))
+            continue
+        try:
+            quantity = int(float(row.get('quantity', '')))
+            if quantity <= 0:
+                raise ValueError
+        except ValueError:
+            errors.append((line_number, f"Quantité invalide: {row.get('quantity', '')}"))
+            continue
+        customer_id = None
+        if row.get('customer'):
+            customer_id = customer_map.get(row['customer'].lower())
+            if customer_id is None:
+                errors.append((line_number, f"Client inconnu: {row['customer']}"))
+                continue
+        dpj = row.get('dpj', '')
+        # openpyxl returns dates as "YYYY-MM-DD HH:MM:SS"
+        if len(dpj) >= 10 and dpj[4] == '-':
+            try:
+                dpj = datetime.strptime(dpj[:10], '%Y-%m-%d').strftime('%d/%m/%Y')
+            except ValueError:
+                errors.append((line_number, f"DPJ invalide: {dpj}"))
+                continue
         
-        movements = conn.execute(query, params).fetchall()
-        products = conn.execute('SELECT DISTINCT name FROM products ORDER BY name').fetchall()
+        key = (product['id'], movement_type, dpj)
+        if key not in dates_cache:
+            dates_cache[key] = calculate_dates(product['category'], movement_type, product['name'], dpj)
+        movements.append((line_number, product['id'], quantity, customer_id, movement_type, dpj,
+                          dates_cache[key]))
     
-    return render_template('movements.html', 
-                         movements=movements, 
-                         get_alert_status=get_alert_status,
-                         products=products,
-                         current_filters={
-                             'product': product_filter,
-                             'date_from': date_from,
-                             'date_to': date_to,
-                             'movement_type': movement_type
-                         })
+    if not movements and not errors:
+        errors.append((0, 'Aucun mouvement trouvé dans le fichier'))
+    if errors:
+        return [], errors
+    
+    # Take the write lock up front so the stock check and the writes see the same state
+    conn.execute('BEGIN IMMEDIATE')
+    
+    entries, exits = {}, {}
+    for _, product_id, quantity, _, movement_type, _, _ in movements:
+        totals = entries if movement_type == 'Entry' else exits
+        totals[product_id] = totals.get(product_id, 0) + quantity
+    
+    stock = {}
+    for ids in chunked(exits):
+        stock.update(conn.execute(f'''
+        SELECT product_id, quantity FROM inventory
+        WHERE product_id IN ({','.join('?' * len(ids))})
+        ''', ids).fetchall())
+    # Checked in file order, as lots are allocated below: an exit can only
+    # draw on entries listed above it
+    for line_number, product_id, quantity, _, movement_type, _, _ in movements:
+        available = stock.get(product_id, 0)
+        if movement_type == 'Entry':
+            stock[product_id] = available + quantity
+        elif available < quantity:
+            name = next(p['name'] for p in products if p['id'] == product_id)
+            errors.append((line_number, f"Stock insuffisant pour {name}: {available} disponible(s), {quantity} demandé(s)"))
+        else:
+            stock[product_id] = available - quantity
+    if errors:
+        conn.rollback()
+        return [], errors
+    
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM movements').fetchone()[0]
+    conn.executemany('''
+    INSERT INTO movements (
+        product_id, quantity, customer_id, movement_type, 
+        date, best_before, batch, sub_batch, dpj
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(product_id, quantity, customer_id, movement_type, now,
+           dates['best_before'], dates['batch'], dates['sub_batch'], dpj)
+          for _, product_id, quantity, customer_id, movement_type, dpj, dates in movements])
+    movement_ids = [row[0] for row in conn.execute(
+        'SELECT id FROM movements WHERE id > ? ORDER BY id', (last_id,))]
+    
+    # Lots are allocated in file order, so exits draw on entries listed above them
+    for movement_id, (line_number, product_id, quantity, _, movement_type, _, dates) in zip(movement_ids, movements):
+        try:
+            apply_movement_to_lots(conn, movement_id, product_id, movement_type, quantity, dates)
+        except LotShortfall as e:
+            name = next(p['name'] for p in products if p['id'] == product_id)
+            errors.append((line_number, f"Stock des lots insuffisant pour {name}: {e.missing} manquant(s)"))
+    if errors:
+        conn.rollback()
+        return [], errors
+    
+    conn.executemany('''
+    INSERT INTO inventory (product_id, quantity)
+    VALUES (?, ?)
+    ON CONFLICT(product_id) DO UPDATE SET
+    quantity = quantity + excluded.quantity
+    ''', [(product_id, entries.get(product_id, 0) - exits.get(product_id, 0))
+          for product_id in set(entries) | set(exits)])
+    
+    conn.commit()
+    return movement_ids, []
 
-@app.route('/add_movement', methods=['GET', 'POST'])
+def run_movement_import(stream, filename):
+    with db_connection() as conn:
+        movement_ids, errors = import_movements(conn, read_import_rows(stream, filename))
+    if movement_ids:
+        update_excel_log(movement_ids[-1])
+        with db_connection() as conn:
+            alert_engine.notify(row[0] for row in conn.execute(
+                'SELECT DISTINCT product_id FROM movements WHERE id >= ?', (movement_ids[0],)))
+    return movement_ids, errors
+
+@app.route('/import_movements', methods=['GET', 'POST'])
 @manager_required
-def add_movement():
+def import_movements_view():
+    errors = []
     if request.method == 'POST':
-        try:
-            with db_connection() as conn:
-                product_id = request.form['product_id']
-                quantity = int(request.form['quantity'])
-                movement_type = request.form['movement_type']
-                customer_id = request.form.get('customer_id') or None
-                dpj = request.form['dpj']  # Get manually entered DPJ
-                
-                product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-                if not product:
-                    flash('Product not found', 'danger')
-                    return redirect(url_for('add_movement'))
-                
-                if movement_type == 'Exit':
-                    current_stock = conn.execute('''
-                    SELECT COALESCE(quantity, 0) as quantity 
-                    FROM inventory WHERE product_id = ?
-                    ''', (product_id,)).fetchone()
-                    
-                    if current_stock['quantity'] < quantity:
-                        flash('Insufficient stock', 'danger')
-                        return redirect(url_for('add_movement'))
-                
-                # Generate batch information using DPJ date
-                dates = calculate_dates(product['category'], movement_type, product['name'], dpj)
-                
-                cursor = conn.execute('''
-                INSERT INTO movements (
-                    product_id, quantity, customer_id, movement_type, 
-                    date, best_before, batch, sub_batch, dpj
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    product_id, quantity, customer_id, movement_type,
-                    datetime.now().isoformat(), dates['best_before'], 
-                    dates['batch'], dates['sub_batch'], dpj
-                ))
-                
-                # Update inventory
-                if movement_type == 'Entry':
-                    conn.execute('''
-                    INSERT INTO inventory (product_id, quantity)
-                    VALUES (?, ?)
-                    ON CONFLICT(product_id) DO UPDATE SET
-                    quantity = quantity + excluded.quantity
-                    ''', (product_id, quantity))
-                else:
-                    conn.execute('''
-                    UPDATE inventory SET quantity = quantity - ?
-                    WHERE product_id = ?
-                    ''', (quantity, product_id))
-                
-                movement_id = cursor.lastrowid
-                movement = conn.execute('''
-                SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name
-                FROM movements m
-                LEFT JOIN products p ON m.product_id = p.id
-                LEFT JOIN customers c ON m.customer_id = c.id
-                WHERE m.id = ?
-                ''', (movement_id,)).fetchone()
-                
-                conn.commit()
-                update_excel_log(dict(movement))
-                check_inventory_alerts()
-                flash('Movement recorded successfully', 'success')
-                return redirect(url_for('view_receipt', movement_id=movement_id))
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            flash('Aucun fichier sélectionné', 'danger')
+            return redirect(url_for('import_movements_view'))
         
+        try:
+            movement_ids, errors = run_movement_import(file.stream, file.filename)
         except Exception as e:
             flash(f'Error: {str(e)}', 'danger')
-            return redirect(url_for('add_movement'))
-    
-    with db_connection() as conn:
-        products = conn.execute('SELECT * FROM products').fetchall()
-        customers = conn.execute('SELECT * FROM customers ORDER BY name').fetchall()
+            return redirect(url_for('import_movements_view'))
+        
+        if movement_ids:
+            flash(f'{len(movement_ids)} mouvements importés', 'success')
+            return redirect(url_for('movements'))
+        flash('Import annulé: aucun mouvement enregistré', 'danger')
     
-    return render_template('add_movement.html', products=products, customers=customers)
+    return render_template('import_movements.html', errors=errors)
 
+@app.cli.command('import-movements')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_movements_command(path):
+    """Import movements from a CSV or XLSX file in one transaction."""
+    with open(path, 'rb') as f:
+        movement_ids, errors = run_movement_import(f, path)
+    for line_number, message in errors:
+        click.echo(f'Ligne {line_number}: {message}' if line_number else message, err=True)
+    if errors:
+        raise SystemExit(1)
+    click.echo(f'{len(movement_ids)} mouvements importés')
 
 @app.route('/receipt/<int:movement_id>')
 @login_required
 def view_receipt(movement_id):
     with db_connection() as conn:
-        movement = conn.execute('''
-        SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name
-        FROM movements m
-        LEFT JOIN products p ON m.product_id = p.id
-        LEFT JOIN customers c ON m.customer_id = c.id
-        WHERE m.id = ?
-        ''', (movement_id,)).fetchone()
+        movement = find_movement(conn, movement_id)
     
     return render_template('movement_receipt.html', movement=movement)
 
-@app.route('/print_receipt/<int:movement_id>')
-@login_required
-def print_receipt(movement_id):
-    with db_connection() as conn:
-        movement = conn.execute('''
-        SELECT m.*, p.name as product_name, p.family, p.category, c.name as customer_name
-        FROM movements m
-        LEFT JOIN products p ON m.product_id = p.id
-        LEFT JOIN customers c ON m.customer_id = c.id
-        WHERE m.id = ?
-        ''', (movement_id,)).fetchone()
+# PDF styles, built once and shared by receipts and client statements
+_pdf_styles = getSampleStyleSheet()
+PDF_TITLE_STYLE = ParagraphStyle(
+    'Title',
+    parent=_pdf_styles['Heading1'],
+    alignment=1,
+    spaceAfter=20,
+    fontSize=16,
+    textColor=colors.HexColor('#2c3e50')
+)
+PDF_HEADER_STYLE = ParagraphStyle(
+    'Header',
+    parent=_pdf_styles['Heading2'],
+    fontSize=12,
+    textColor=colors.white,
+    backColor=colors.HexColor('#4472C4'),
+    spaceAfter=10
+)
+PDF_NORMAL_STYLE = _pdf_styles['Normal']
+PDF_FOOTER_STYLE = ParagraphStyle(name='Footer', alignment=1, fontSize=8)
+PDF_FOOTER_RIGHT_STYLE = ParagraphStyle(name='Footer', alignment=2, fontSize=8)
+PDF_DETAILS_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'LEFT'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
+])
+PDF_LOGO = Image(str(LOGO_PATH), width=1.5*inch, height=0.75*inch) if LOGO_PATH.exists() else None
+
+RECEIPT_FIELDS = ('id', 'date', 'movement_type', 'product_name', 'family', 'category', 'quantity',
+                  'batch', 'sub_batch', 'dpj', 'best_before', 'customer_name')
+
+def receipt_hash(movement):
+    content = '\x1f'.join(str(movement[field]) for field in RECEIPT_FIELDS)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
 
-    # Create PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter, 
+@profiled('pdf')
+def build_receipt_pdf(movement, path):
+    doc = SimpleDocTemplate(str(path), pagesize=letter, 
                           rightMargin=inch/2, leftMargin=inch/2,
                           topMargin=inch/2, bottomMargin=inch/2)
     elements = []
     
-    # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'Title',
-        parent=styles['Heading1'],
-        alignment=1,
-        spaceAfter=20,
-        fontSize=16,
-        textColor=colors.HexColor('#2c3e50')
-    )
-    header_style = ParagraphStyle(
-        'Header',
-        parent=styles['Heading2'],
-        fontSize=12,
-        textColor=colors.white,
-        backColor=colors.HexColor('#4472C4'),
-        spaceAfter=10
-    )
-    normal_style = styles['Normal']
-    
     # Add logo if exists
-    if LOGO_PATH.exists():
-        logo = Image(str(LOGO_PATH), width=1.5*inch, height=0.75*inch)
-        elements.append(logo)
+    if PDF_LOGO:
+        elements.append(PDF_LOGO)
     
     # Title and info
-    elements.append(Paragraph(f"<b>CONDIFRI MAROC</b>", title_style))
-    elements.append(Paragraph(f"Movement Receipt", title_style))
+    elements.append(Paragraph(f"<b>CONDIFRI MAROC</b>", PDF_TITLE_STYLE))
+    elements.append(Paragraph(f"Movement Receipt", PDF_TITLE_STYLE))
     elements.append(Spacer(1, 0.2*inch))
-    elements.append(Paragraph(f"<b>Receipt #:</b> {movement['id']}", normal_style))
-    elements.append(Paragraph(f"<b>Date:</b> {movement['date'][:16]}", normal_style))
-    elements.append(Paragraph(f"<b>Type:</b> {movement['movement_type']}", normal_style))
+    elements.append(Paragraph(f"<b>Receipt #:</b> {movement['id']}", PDF_NORMAL_STYLE))
+    elements.append(Paragraph(f"<b>Date:</b> {movement['date'][:16]}", PDF_NORMAL_STYLE))
+    elements.append(Paragraph(f"<b>Type:</b> {movement['movement_type']}", PDF_NORMAL_STYLE))
     elements.append(Spacer(1, 0.3*inch))
     
     # Movement details
-    elements.append(Paragraph("Movement Details", header_style))
+    elements.append(Paragraph("Movement Details", PDF_HEADER_STYLE))
     
     table_data = [
         ["Product", movement['product_name']],
@@ -839,37 +4060,484 @@ def print_receipt(movement_id):
     ]
     
     details_table = Table(table_data, colWidths=[2*inch, 3*inch])
-    details_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'LEFT'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
-    ]))
+    details_table.setStyle(PDF_DETAILS_TABLE_STYLE)
     elements.append(details_table)
     
     if movement['customer_name']:
         elements.append(Spacer(1, 0.2*inch))
-        elements.append(Paragraph(f"<b>Customer:</b> {movement['customer_name']}", normal_style))
+        elements.append(Paragraph(f"<b>Customer:</b> {movement['customer_name']}", PDF_NORMAL_STYLE))
     
     # Footer
     elements.append(Spacer(1, 0.3*inch))
-    elements.append(Paragraph("Condifri Maroc - Frozen Stock Management System", 
-                            ParagraphStyle(name='Footer', alignment=1, fontSize=8)))
+    elements.append(Paragraph("Condifri Maroc - Frozen Stock Management System", PDF_FOOTER_STYLE))
     
     # Build PDF
     doc.build(elements)
-    buffer.seek(0)
+
+# Bytes held by RECEIPT_CACHE_DIR: counted once on first use, then kept up
+# to date as files are added and removed, so a miss does not rescan the cache
+_receipt_cache = {'bytes': None}
+_receipt_cache_lock = Lock()
+
+def cached_pdf_files():
+    """(mtime, size, path) of the finished PDFs in the cache.
+
+    Files still being written (temp_*) are left out, and files removed
+    while the directory is read are skipped.
+    """
+    files = []
+    for entry in os.scandir(RECEIPT_CACHE_DIR):
+        if not entry.name.endswith('.pdf') or entry.name.startswith('temp_'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    return files
+
+def remove_cached_pdf(path):
+    try:
+        size = os.stat(path).st_size
+        os.remove(path)
+    except OSError:
+        return
+    with _receipt_cache_lock:
+        if _receipt_cache['bytes'] is not None:
+            _receipt_cache['bytes'] -= size
+
+def evict_receipt_cache(added):
+    """Counts a newly cached file and trims the cache once it passes RECEIPT_CACHE_MAX_BYTES."""
+    with _receipt_cache_lock:
+        if _receipt_cache['bytes'] is None:
+            _receipt_cache['bytes'] = sum(size for _, size, _ in cached_pdf_files())
+        else:
+            try:
+                _receipt_cache['bytes'] += os.stat(added).st_size
+            except FileNotFoundError:
+                return
+        if _receipt_cache['bytes'] <= app.config['RECEIPT_CACHE_MAX_BYTES']:
+            return
+        # Over the limit: rescan, which also corrects any drift in the count
+        entries = sorted(cached_pdf_files())
+        _receipt_cache['bytes'] = sum(size for _, size, _ in entries)
+    # Least recently served first; hits refresh the file's mtime. The file
+    # just added is about to be served, so it is never the one dropped
+    for _, size, path in entries:
+        if _receipt_cache['bytes'] <= app.config['RECEIPT_CACHE_MAX_BYTES']:
+            break
+        if path != str(added):
+            remove_cached_pdf(path)
+
+def cached_pdf(name, content_hash, build):
+    """The cached <name>_<content_hash>.pdf, opened for reading; build(path) makes it on a miss.
+
+    The file is handed back open, so another request evicting or
+    invalidating it before it is sent does not break the download. One
+    removed between its build and the open is rebuilt once. Copies of name
+    under an older hash are dropped when it is rebuilt.
+    """
+    pdf_path = RECEIPT_CACHE_DIR / f"{name}_{content_hash}.pdf"
+    for _ in range(2):
+        try:
+            pdf = open(pdf_path, 'rb')
+        except FileNotFoundError:
+            build_cached_pdf(name, pdf_path, build)
+            continue
+        try:
+            os.utime(pdf_path)
+        except FileNotFoundError:
+            pass
+        return pdf
+    return open(pdf_path, 'rb')
+
+def build_cached_pdf(name, pdf_path, build):
+    for path in RECEIPT_CACHE_DIR.glob(f"{name}_*.pdf"):
+        remove_cached_pdf(path)
+    temp_path = pdf_path.with_name(f"temp_{uuid.uuid4().hex}_{pdf_path.name}")
+    try:
+        build(temp_path)
+        os.replace(str(temp_path), str(pdf_path))
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    evict_receipt_cache(pdf_path)
+
+def invalidate_receipt(movement_id):
+    for path in RECEIPT_CACHE_DIR.glob(f"receipt_{movement_id}_*.pdf"):
+        remove_cached_pdf(path)
+
+@app.route('/print_receipt/<int:movement_id>')
+@login_required
+def print_receipt(movement_id):
+    with db_connection() as conn:
+        movement = find_movement(conn, movement_id)
     
-    return send_file(
-        buffer,
+    if not movement:
+        flash('Movement not found', 'danger')
+        return redirect(url_for('movements'))
+    
+    # Receipts never change unless the movement (or a name it shows) does,
+    # so the PDF is cached under a hash of its content
+    content_hash = receipt_hash(movement)
+    pdf = cached_pdf(f"receipt_{movement_id}", content_hash,
+                     lambda path: build_receipt_pdf(movement, path))
+    
+    response = send_file(
+        pdf,
         as_attachment=True,
         download_name=f"movement_receipt_{movement['id']}.pdf",
-        mimetype='application/pdf'
+        mimetype='application/pdf',
+        etag=content_hash,
+        last_modified=datetime.fromisoformat(movement['date']),
+        max_age=app.config['RECEIPT_CACHE_MAX_AGE'],
+        conditional=True
+    )
+    # Sent from the open file, so send_file cannot size it itself
+    if response.status_code == 200:
+        response.content_length = os.fstat(pdf.fileno()).st_size
+    # Receipts carry customer details: browsers may cache them, proxies may not
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+# Delivery Notes
+def find_delivery_note(conn, note_id):
+    """(note, lines) for a delivery note, or (None, []).
+
+    Lines are read through idx_movements_note, in the partition holding the
+    note's date, so notes of archived years still print.
+    """
+    note = conn.execute('''
+    SELECT n.*, c.name as customer_name, u.username as created_by_name
+    FROM delivery_notes n
+    LEFT JOIN customers c ON n.customer_id = c.id
+    LEFT JOIN users u ON n.created_by = u.id
+    WHERE n.id = ?
+    ''', (note_id,)).fetchone()
+    if not note:
+        return None, []
+    schemas = movement_schemas(conn, note['date'][:10], day_after(note['date'][:10]))
+    lines = conn.execute(f'''
+    SELECT m.id, m.quantity, m.batch, m.sub_batch, m.dpj, m.best_before,
+           p.name as product_name, p.family, p.category
+    FROM {movement_source(schemas)} m
+    LEFT JOIN products p ON m.product_id = p.id
+    WHERE m.note_id = ?
+    ORDER BY m.id
+    ''', (note_id,)).fetchall()
+    return note, lines
+
+@app.route('/delivery_notes')
+@login_required
+def delivery_notes():
+    number = request.args.get('number', '').strip().upper()
+    with db_connection() as conn:
+        if number:
+            # Exact number first, then any number starting with it; both are
+            # ranges on idx_delivery_notes_number
+            note = conn.execute('SELECT id FROM delivery_notes WHERE number = ?', (number,)).fetchone()
+            if note:
+                return redirect(url_for('view_delivery_note', note_id=note['id']))
+            where, params = 'WHERE n.number >= ? AND n.number < ?', [number, number + '\uffff']
+        else:
+            where, params = '', []
+        notes = [dict(note) for note in conn.execute(f'''
+        SELECT n.*, c.name as customer_name
+        FROM delivery_notes n
+        LEFT JOIN customers c ON n.customer_id = c.id
+        {where}
+        ORDER BY n.id DESC
+        LIMIT ?
+        ''', params + [app.config['MOVEMENTS_PER_PAGE']])]
+        if notes:
+            # Lines live in the partitions of their notes' dates, as in find_delivery_note
+            dates = [note['date'][:10] for note in notes]
+            schemas = movement_schemas(conn, min(dates), day_after(max(dates)))
+            note_ids = [note['id'] for note in notes]
+            totals = {row['note_id']: row for row in conn.execute(f'''
+            SELECT note_id, COUNT(*) as line_count, SUM(quantity) as total_quantity
+            FROM {movement_source(schemas)} m
+            WHERE m.note_id IN ({','.join('?' * len(note_ids))})
+            GROUP BY note_id
+            ''', note_ids)}
+            for note in notes:
+                row = totals.get(note['id'])
+                note['line_count'] = row['line_count'] if row else 0
+                note['total_quantity'] = row['total_quantity'] if row else 0
+    return render_template('delivery_notes.html', notes=notes, number=number)
+
+@app.route('/add_delivery_note', methods=['GET', 'POST'])
+@manager_required
+def add_delivery_note():
+    if request.method == 'POST':
+        movement_type = request.form.get('movement_type', 'Exit')
+        customer_id = request.form.get('customer_id') or None
+        try:
+            lines = []
+            for product_id, quantity, dpj in zip(request.form.getlist('product_id'),
+                                                 request.form.getlist('quantity'),
+                                                 request.form.getlist('dpj')):
+                if not product_id and not quantity:
+                    continue  # Rows left blank
+                if not product_id:
+                    raise ValueError('Choisissez un produit dans la liste pour chaque ligne')
+                # DPJ comes from a date input (YYYY-MM-DD); movements store DD/MM/YYYY
+                dpj = datetime.strptime(dpj, '%Y-%m-%d').strftime('%d/%m/%Y') if dpj else ''
+                lines.append((int(product_id), int(quantity), dpj))
+            if not lines:
+                raise ValueError('Le bon ne contient aucune ligne')
+            if len(lines) > app.config['DELIVERY_NOTE_MAX_LINES']:
+                raise ValueError(f"Un bon est limité à {app.config['DELIVERY_NOTE_MAX_LINES']} lignes")
+            if movement_type == 'Exit' and not customer_id:
+                raise ValueError('Choisissez un client pour un bon de sortie')
+            note_id, number = movement_writer.submit_note(movement_type, customer_id, lines,
+                                                          created_by=session['user_id'])
+        except MovementRejected as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('add_delivery_note'))
+        except Exception as e:
+            flash(f'Error: {str(e)}', 'danger')
+            return redirect(url_for('add_delivery_note'))
+
+        with db_connection() as conn:
+            movement_ids = [row['id'] for row in conn.execute('SELECT id FROM movements WHERE note_id = ?', (note_id,))]
+        for movement_id in movement_ids:
+            update_excel_log(movement_id)
+        alert_engine.notify(sorted({product_id for product_id, _, _ in lines}))
+        flash(f'Bon {number} enregistré ({len(lines)} lignes)', 'success')
+        return redirect(url_for('view_delivery_note', note_id=note_id))
+
+    return render_template('add_delivery_note.html', max_lines=app.config['DELIVERY_NOTE_MAX_LINES'])
+
+@app.route('/delivery_note/<int:note_id>')
+@login_required
+def view_delivery_note(note_id):
+    with db_connection() as conn:
+        note, lines = find_delivery_note(conn, note_id)
+
+    if not note:
+        flash('Bon introuvable', 'danger')
+        return redirect(url_for('delivery_notes'))
+    return render_template('delivery_note.html', note=note, lines=lines)
+
+DELIVERY_NOTE_FIELDS = ('id', 'quantity', 'batch', 'sub_batch', 'dpj', 'best_before',
+                        'product_name', 'family', 'category')
+PDF_NOTE_HEADER = ["#", "Product", "Family", "Category", "Batch", "Sub-batch", "Best Before", "Qty"]
+PDF_NOTE_COL_WIDTHS = [0.4*inch, 1.6*inch, 0.8*inch, 0.8*inch, 1.1*inch, 1.0*inch, 0.9*inch, 0.6*inch]
+
+def delivery_note_hash(note, lines):
+    content = '\x1f'.join([note['number'], note['date'], str(note['customer_name'])] +
+                          [str(line[field]) for line in lines for field in DELIVERY_NOTE_FIELDS])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+@profiled('pdf')
+def build_delivery_note_pdf(note, lines, path):
+    doc = SimpleDocTemplate(str(path), pagesize=letter,
+                          rightMargin=inch/2, leftMargin=inch/2,
+                          topMargin=inch/2, bottomMargin=inch/2)
+    elements = []
+
+    if PDF_LOGO:
+        elements.append(PDF_LOGO)
+
+    elements.append(Paragraph("<b>CONDIFRI MAROC</b>", PDF_TITLE_STYLE))
+    elements.append(Paragraph("Delivery Note", PDF_TITLE_STYLE))
+    elements.append(Spacer(1, 0.2*inch))
+    elements.append(Paragraph(f"<b>Note #:</b> {note['number']}", PDF_NORMAL_STYLE))
+    elements.append(Paragraph(f"<b>Date:</b> {note['date'][:16]}", PDF_NORMAL_STYLE))
+    elements.append(Paragraph(f"<b>Type:</b> {note['movement_type']}", PDF_NORMAL_STYLE))
+    if note['customer_name']:
+        elements.append(Paragraph(f"<b>Customer:</b> {note['customer_name']}", PDF_NORMAL_STYLE))
+    elements.append(Spacer(1, 0.3*inch))
+
+    elements.append(Paragraph("Lines", PDF_HEADER_STYLE))
+    table_data = [PDF_NOTE_HEADER]
+    for index, line in enumerate(lines, 1):
+        table_data.append([
+            str(index),
+            line['product_name'],
+            line['family'],
+            line['category'],
+            line['batch'],
+            line['sub_batch'],
+            line['best_before'][:10],
+            str(line['quantity'])
+        ])
+    table_data.append(["", "Total", "", "", "", "", "", str(sum(line['quantity'] for line in lines))])
+    lines_table = Table(table_data, colWidths=PDF_NOTE_COL_WIDTHS, repeatRows=1)
+    lines_table.setStyle(PDF_MOVEMENTS_TABLE_STYLE)
+    elements.append(lines_table)
+
+    # Footer
+    elements.append(Spacer(1, 0.3*inch))
+    elements.append(Paragraph("Condifri Maroc - Frozen Stock Management System", PDF_FOOTER_STYLE))
+
+    doc.build(elements)
+
+@app.route('/print_delivery_note/<int:note_id>')
+@login_required
+def print_delivery_note(note_id):
+    with db_connection() as conn:
+        note, lines = find_delivery_note(conn, note_id)
+
+    if not note:
+        flash('Bon introuvable', 'danger')
+        return redirect(url_for('delivery_notes'))
+
+    # One PDF for the whole note, cached like single receipts; deleting a
+    # line changes the hash, so a stale copy is never served
+    content_hash = delivery_note_hash(note, lines)
+    pdf = cached_pdf(f"note_{note_id}", content_hash,
+                     lambda path: build_delivery_note_pdf(note, lines, path))
+
+    response = send_file(
+        pdf,
+        as_attachment=True,
+        download_name=f"{note['number']}.pdf",
+        mimetype='application/pdf',
+        etag=content_hash,
+        last_modified=datetime.fromisoformat(note['date']),
+        max_age=app.config['RECEIPT_CACHE_MAX_AGE'],
+        conditional=True
     )
+    if response.status_code == 200:
+        response.content_length = os.fstat(pdf.fileno()).st_size
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+# JSON API
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return api_error('Authentication required', 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_error(message, status=400):
+    return Response(json.dumps({'error': message}, separators=(',', ':')),
+                    status=status, mimetype='application/json')
+
+def api_fields(allowed):
+    """Parses ?fields=a,b into a list of columns, or raises ValueError."""
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields or list(allowed)
+
+def api_limit():
+    return min(max(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int), 1),
+               app.config['API_MAX_PAGE_SIZE'])
+
+def api_response(tables, build):
+    """Returns build()'s payload as compact JSON with an ETag.
+
+    The ETag combines the request URL, today's date (expiry status depends on
+    it) and the change counters of the tables the resource reads. A client
+    sending a matching If-None-Match gets a 304 without build() running.
+    """
+    placeholders = ','.join('?' * len(tables))
+    with db_connection() as conn:
+        versions = conn.execute(f'''
+        SELECT table_name, version FROM table_versions
+        WHERE table_name IN ({placeholders}) ORDER BY table_name
+        ''', tables).fetchall()
+    state = ';'.join(f"{row['table_name']}={row['version']}" for row in versions)
+    etag = hashlib.sha1(f"{request.full_path}|{datetime.now().date()}|{state}".encode()).hexdigest()[:20]
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            payload = build()
+        except ValueError as e:
+            return api_error(str(e))
+        response = Response(json.dumps(payload, separators=(',', ':'), ensure_ascii=False),
+                            mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def api_page(rows, fields, limit, cursor_of):
+    data = [{field: row[field] for field in fields} for row in rows[:limit]]
+    next_cursor = cursor_of(rows[limit - 1]) if len(rows) > limit else None
+    return {'data': data, 'next_cursor': next_cursor}
+
+API_INVENTORY_FIELDS = ('id', 'name', 'family', 'category', 'quantity')
+API_PRODUCT_FIELDS = ('id', 'name', 'family', 'category')
+API_CUSTOMER_FIELDS = ('id', 'name', 'ville', 'pays', 'telephone', 'gsm',
+                       'rc', 'cnss', 'patente', 'ice', 'observations')
+API_MOVEMENT_FIELDS = ('id', 'date', 'product_id', 'product_name', 'family', 'category',
+                       'movement_type', 'quantity', 'customer_id', 'customer_name',
+                       'batch', 'sub_batch', 'dpj', 'best_before', 'expiry_status')
+
+@app.route('/api/v1/inventory')
+@api_login_required
+def api_inventory():
+    def build():
+        fields, limit = api_fields(API_INVENTORY_FIELDS), api_limit()
+        after = request.args.get('cursor', 0, type=int)
+        with db_connection() as conn:
+            rows = conn.execute('''
+            SELECT p.id, p.name, p.family, p.category, 
+                   COALESCE(i.quantity, 0) as quantity
+            FROM products p
+            LEFT JOIN inventory i ON p.id = i.product_id
+            WHERE p.id > ?
+            ORDER BY p.id
+            LIMIT ?
+            ''', (after, limit + 1)).fetchall()
+        return api_page(rows, fields, limit, lambda row: row['id'])
+    return api_response(('inventory', 'products'), build)
+
+@app.route('/api/v1/products')
+@api_login_required
+def api_products():
+    def build():
+        fields, limit = api_fields(API_PRODUCT_FIELDS), api_limit()
+        after = request.args.get('cursor', 0, type=int)
+        with db_connection() as conn:
+            rows = conn.execute('''
+            SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after, limit + 1)).fetchall()
+        return api_page(rows, fields, limit, lambda row: row['id'])
+    return api_response(('products',), build)
+
+@app.route('/api/v1/customers')
+@api_login_required
+def api_customers():
+    def build():
+        fields, limit = api_fields(API_CUSTOMER_FIELDS), api_limit()
+        after = request.args.get('cursor', 0, type=int)
+        with db_connection() as conn:
+            rows = conn.execute('''
+            SELECT * FROM customers WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after, limit + 1)).fetchall()
+        return api_page(rows, fields, limit, lambda row: row['id'])
+    return api_response(('customers',), build)
+
+@app.route('/api/v1/movements')
+@api_login_required
+def api_movements():
+    def build():
+        fields, limit = api_fields(API_MOVEMENT_FIELDS), api_limit()
+        cursor = decode_cursor(request.args.get('cursor'))
+        with db_connection() as conn:
+            _, schemas, where, params = movement_filters(conn, request.args)
+            query = movements_query(schemas) + where
+            params = expiry_status_params() + params
+            if cursor:
+                query += ' AND m.date <= ? AND (m.date < ? OR m.id < ?)'
+                params.extend([cursor[0], cursor[0], cursor[1]])
+            query += ' ORDER BY m.date DESC, m.id DESC LIMIT ?'
+            params.append(limit + 1)
+            rows = conn.execute(query, params).fetchall()
+        return api_page(rows, fields, limit, encode_cursor)
+    return api_response(('movements', 'products', 'customers'), build)
 
 # Client Routes
 @app.route('/manage_clients')
@@ -966,33 +4634,17 @@ def delete_client(client_id):
 @manager_required
 def delete_movement(movement_id):
     try:
+        movement = movement_writer.submit_delete(movement_id)
+        invalidate_receipt(movement_id)
+        alert_engine.notify([movement['product_id']])
+        flash('Movement deleted successfully', 'success')
+    except MovementRejected as e:
         with db_connection() as conn:
-            # Get movement details first
-            movement = conn.execute('''
-                SELECT * FROM movements WHERE id = ?
-            ''', (movement_id,)).fetchone()
-            
-            if not movement:
-                flash('Movement not found', 'danger')
-                return redirect(url_for('movements'))
-            
-            # Update inventory (reverse the movement)
-            if movement['movement_type'] == 'Entry':
-                conn.execute('''
-                    UPDATE inventory SET quantity = quantity - ?
-                    WHERE product_id = ?
-                ''', (movement['quantity'], movement['product_id']))
-            else:  # Exit movement
-                conn.execute('''
-                    UPDATE inventory SET quantity = quantity + ?
-                    WHERE product_id = ?
-                ''', (movement['quantity'], movement['product_id']))
-            
-            # Delete the movement
-            conn.execute('DELETE FROM movements WHERE id = ?', (movement_id,))
-            conn.commit()
-            
-            flash('Movement deleted successfully', 'success')
+            movement = find_movement(conn, movement_id)
+        if movement and movement['archived_year']:
+            flash('Ce mouvement appartient à un exercice archivé et ne peut plus être supprimé', 'danger')
+        else:
+            flash(str(e), 'danger')
     except Exception as e:
         flash(f'Error deleting movement: {str(e)}', 'danger')
     
@@ -1004,92 +4656,125 @@ def client_details(client_id):
     with db_connection() as conn:
         client = conn.execute('SELECT * FROM customers WHERE id = ?', (client_id,)).fetchone()
         
-        movements = conn.execute('''
-        SELECT m.*, p.name as product_name, p.family, p.category
+        movements = conn.execute(f'''
+        SELECT m.*, p.name as product_name, p.family, p.category,
+               {expiry_status_sql()} as expiry_status
         FROM movements m
         JOIN products p ON m.product_id = p.id
         WHERE m.customer_id = ?
         ORDER BY m.date DESC
-        ''', (client_id,)).fetchall()
+        ''', expiry_status_params() + [client_id]).fetchall()
         
+        # Archived years only count through their opening totals
         totals = conn.execute('''
         SELECT 
             SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE 0 END) as total_entry,
             SUM(CASE WHEN movement_type = 'Exit' THEN quantity ELSE 0 END) as total_exit
         FROM movements WHERE customer_id = ?
         ''', (client_id,)).fetchone()
+        opening = conn.execute('''
+        SELECT total_entry, total_exit FROM opening_client_totals WHERE customer_id = ?
+        ''', (client_id,)).fetchone()
         
         return render_template('client_details.html',
                             client=client,
                             movements=movements,
-                            total_entry=totals['total_entry'] or 0,
-                            total_exit=totals['total_exit'] or 0,
-                            get_alert_status=get_alert_status)
+                            total_entry=(totals['total_entry'] or 0) + (opening['total_entry'] if opening else 0),
+                            total_exit=(totals['total_exit'] or 0) + (opening['total_exit'] if opening else 0),
+                            archived_through=archive_boundary(conn) if opening else None,
+                            status_labels=EXPIRY_STATUS_LABELS)
 
-@app.route('/export_client_pdf/<int:client_id>')
-@login_required
-def export_client_pdf(client_id):
-    with db_connection() as conn:
-        client = conn.execute('SELECT * FROM customers WHERE id = ?', (client_id,)).fetchone()
-        
-        movements = conn.execute('''
-        SELECT m.date, p.name as product_name, m.quantity, 
-               m.movement_type, m.batch, m.sub_batch, m.dpj,
-               m.best_before, p.family, p.category
-        FROM movements m
-        JOIN products p ON m.product_id = p.id
-        WHERE m.customer_id = ?
-        ORDER BY m.date DESC
-        ''', (client_id,)).fetchall()
-        
-        totals = conn.execute('''
-        SELECT 
-            SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE 0 END) as total_entry,
-            SUM(CASE WHEN movement_type = 'Exit' THEN quantity ELSE 0 END) as total_exit
-        FROM movements WHERE customer_id = ?
-        ''', (client_id,)).fetchone()
+PDF_SUMMARY_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
+])
+PDF_MOVEMENTS_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTSIZE', (0, 0), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
+])
+PDF_MOVEMENTS_HEADER = ["Date", "Produit", "Type", "Qté", "Lot", "DLC", "État"]
+PDF_MOVEMENTS_COL_WIDTHS = [1.2*inch, 1.5*inch, 0.6*inch, 0.5*inch, 0.8*inch, 0.8*inch, 0.8*inch]
 
-    # Create PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter, 
+@profiled('pdf')
+def build_client_statement(conn, client, output, date_from='', date_to='', limit=None):
+    """Renders a client statement PDF into output (a path or file object).
+
+    Movements are read from the cursor in chunks and laid out as a series of
+    tables of CLIENT_PDF_CHUNK_ROWS rows, each repeating its header. ReportLab
+    then only ever measures and splits small tables, instead of one table
+    holding the whole history.
+    
+    The default statement (limited, no dates) covers the hot partition and
+    counts the archived years through the client's opening totals; a dated
+    or full-history statement reads the archives it reaches instead.
+    """
+    start = date_from if parse_date_arg(date_from) else None
+    end = (parse_date_arg(date_to) + timedelta(days=1)).strftime('%Y-%m-%d') if parse_date_arg(date_to) else None
+    where = ' WHERE m.customer_id = ?'
+    params = [client['id']]
+    if start:
+        where += ' AND m.date >= ?'
+        params.append(start)
+    if end:
+        where += ' AND m.date < ?'
+        params.append(end)
+    
+    if start or end or not limit:
+        schemas, opening = movement_schemas(conn, start, end), None
+    else:
+        schemas = ['main']
+        opening = conn.execute('''
+        SELECT total_entry, total_exit FROM opening_client_totals WHERE customer_id = ?
+        ''', (client['id'],)).fetchone()
+    
+    totals = conn.execute(f'''
+    SELECT 
+        SUM(CASE WHEN movement_type = 'Entry' THEN quantity ELSE 0 END) as total_entry,
+        SUM(CASE WHEN movement_type = 'Exit' THEN quantity ELSE 0 END) as total_exit
+    FROM {movement_source(schemas)} m''' + where, params).fetchone()
+    total_entry = (totals['total_entry'] or 0) + (opening['total_entry'] if opening else 0)
+    total_exit = (totals['total_exit'] or 0) + (opening['total_exit'] if opening else 0)
+    
+    query = f'''
+    SELECT m.date, p.name as product_name, m.quantity, 
+           m.movement_type, m.batch, m.sub_batch, m.dpj,
+           m.best_before, p.family, p.category,
+           {expiry_status_sql()} as expiry_status
+    FROM {movement_source(schemas)} m
+    JOIN products p ON m.product_id = p.id''' + where + ' ORDER BY m.date DESC, m.id DESC'
+    params = expiry_status_params() + params
+    if limit:
+        query += ' LIMIT ?'
+        params = params + [limit + 1]
+    
+    doc = SimpleDocTemplate(output, pagesize=letter, 
                           rightMargin=inch/2, leftMargin=inch/2,
                           topMargin=inch/2, bottomMargin=inch/2)
     elements = []
     
-    # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'Title',
-        parent=styles['Heading1'],
-        alignment=1,
-        spaceAfter=20,
-        fontSize=16,
-        textColor=colors.HexColor('#2c3e50')
-    )
-    header_style = ParagraphStyle(
-        'Header',
-        parent=styles['Heading2'],
-        fontSize=12,
-        textColor=colors.white,
-        backColor=colors.HexColor('#4472C4'),
-        spaceAfter=10
-    )
-    normal_style = styles['Normal']
-    small_style = styles['Normal']
-    small_style.fontSize = 8
-    
     # Add logo if exists
-    if LOGO_PATH.exists():
-        logo = Image(str(LOGO_PATH), width=1.5*inch, height=0.75*inch)
-        elements.append(logo)
+    if PDF_LOGO:
+        elements.append(PDF_LOGO)
     
     # Title and client info
-    elements.append(Paragraph(f"<b>CONDIFRI MAROC</b>", title_style))
-    elements.append(Paragraph(f"FICHE CLIENT", title_style))
+    elements.append(Paragraph(f"<b>CONDIFRI MAROC</b>", PDF_TITLE_STYLE))
+    elements.append(Paragraph(f"FICHE CLIENT", PDF_TITLE_STYLE))
     elements.append(Spacer(1, 0.2*inch))
     
     # Client Information Section
-    elements.append(Paragraph("INFORMATIONS CLIENT", header_style))
+    elements.append(Paragraph("INFORMATIONS CLIENT", PDF_HEADER_STYLE))
     
     client_data = [
         ["Nom/Raison Sociale:", client['name']],
@@ -1105,54 +4790,46 @@ def export_client_pdf(client_id):
     ]
     
     client_table = Table(client_data, colWidths=[2*inch, 3*inch])
-    client_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'LEFT'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
-    ]))
+    client_table.setStyle(PDF_DETAILS_TABLE_STYLE)
     elements.append(client_table)
     elements.append(Spacer(1, 0.3*inch))
     
     # Summary section
-    elements.append(Paragraph("RÉSUMÉ DES MOUVEMENTS", header_style))
+    elements.append(Paragraph("RÉSUMÉ DES MOUVEMENTS", PDF_HEADER_STYLE))
+    if parse_date_arg(date_from) or parse_date_arg(date_to):
+        elements.append(Paragraph(f"Période: {date_from or '...'} au {date_to or '...'}", PDF_NORMAL_STYLE))
     
     summary_data = [
-        ["Total Entrées:", f"{totals['total_entry'] or 0}"],
-        ["Total Sorties:", f"{totals['total_exit'] or 0}"],
-        ["Solde:", f"{(totals['total_entry'] or 0) - (totals['total_exit'] or 0)}"]
+        ["Total Entrées:", f"{total_entry}"],
+        ["Total Sorties:", f"{total_exit}"],
+        ["Solde:", f"{total_entry - total_exit}"]
     ]
     
     summary_table = Table(summary_data, colWidths=[3*inch, 1*inch])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
-    ]))
+    summary_table.setStyle(PDF_SUMMARY_TABLE_STYLE)
     elements.append(summary_table)
+    if opening:
+        elements.append(Paragraph(f"Totaux incluant les exercices archivés jusqu'au {archive_boundary(conn)}; "
+                                  f"l'historique ne reprend que les mouvements non archivés.", PDF_NORMAL_STYLE))
     elements.append(Spacer(1, 0.3*inch))
     
     # Movements details
-    if movements:
-        elements.append(Paragraph("HISTORIQUE DES MOUVEMENTS", header_style))
+    rows = conn.execute(query, params)
+    chunk_rows = app.config['CLIENT_PDF_CHUNK_ROWS']
+    written = 0
+    truncated = False
+    while True:
+        chunk = rows.fetchmany(chunk_rows)
+        if not chunk:
+            break
+        if limit and written + len(chunk) > limit:
+            chunk = chunk[:limit - written]
+            truncated = True
+        if written == 0:
+            elements.append(Paragraph("HISTORIQUE DES MOUVEMENTS", PDF_HEADER_STYLE))
         
-        table_data = [
-            ["Date", "Produit", "Type", "Qté", "Lot", "DLC", "État"]
-        ]
-        
-        for movement in movements:
-            status = get_alert_status(movement['best_before'])
-            status_text = "Expiré" if status == 'danger' else "Bientôt" if status == 'warning' else "Bon"
-            
+        table_data = [PDF_MOVEMENTS_HEADER]
+        for movement in chunk:
             table_data.append([
                 movement['date'][:16],
                 movement['product_name'],
@@ -1160,42 +4837,179 @@ def export_client_pdf(client_id):
                 str(movement['quantity']),
                 movement['batch'],
                 movement['best_before'][:10],
-                status_text
+                EXPIRY_STATUS_LABELS[movement['expiry_status']]
             ])
         
-        movements_table = Table(table_data, colWidths=[1.2*inch, 1.5*inch, 0.6*inch, 0.5*inch, 0.8*inch, 0.8*inch, 0.8*inch])
-        movements_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTSIZE', (0, 0), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
-        ]))
+        movements_table = Table(table_data, colWidths=PDF_MOVEMENTS_COL_WIDTHS, repeatRows=1)
+        movements_table.setStyle(PDF_MOVEMENTS_TABLE_STYLE)
         elements.append(movements_table)
-    else:
-        elements.append(Paragraph("Aucun mouvement enregistré", normal_style))
+        written += len(chunk)
+        if truncated:
+            break
+    
+    if written == 0:
+        elements.append(Paragraph("Aucun mouvement enregistré", PDF_NORMAL_STYLE))
+    elif truncated:
+        elements.append(Spacer(1, 0.1*inch))
+        elements.append(Paragraph(f"Relevé limité aux {limit} mouvements les plus récents.", PDF_NORMAL_STYLE))
     
     # Footer
     elements.append(Spacer(1, 0.3*inch))
-    elements.append(Paragraph(f"Généré le {datetime.now().strftime('%d/%m/%Y %H:%M')}", 
-                            ParagraphStyle(name='Footer', alignment=2, fontSize=8)))
-    elements.append(Paragraph("Condifri Maroc - Système de Gestion de Stock Congelé", 
-                            ParagraphStyle(name='Footer', alignment=1, fontSize=8)))
+    elements.append(Paragraph(f"Généré le {datetime.now().strftime('%d/%m/%Y %H:%M')}", PDF_FOOTER_RIGHT_STYLE))
+    elements.append(Paragraph("Condifri Maroc - Système de Gestion de Stock Congelé", PDF_FOOTER_STYLE))
     
     # Build PDF
     doc.build(elements)
-    buffer.seek(0)
+
+def client_statement_filename(client):
+    return f"fiche_client_{client['name']}_{datetime.now().strftime('%Y%m%d')}.pdf"
+
+class StatementExporter:
+    """Renders full-history client statements into EXPORT_DIR on a small worker pool.
+
+    A queued job shows up as <job_id>.part until it ends as <job_id>.pdf or
+    <job_id>.error. At most EXPORT_QUEUE_SIZE jobs wait at once, and files
+    older than EXPORT_MAX_AGE are removed whenever a job is submitted.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue = None
+        self.threads = []
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.queue = queue.Queue(app.config['EXPORT_QUEUE_SIZE'])
+            for i in range(app.config['EXPORT_WORKERS']):
+                thread = Thread(target=self._run, name=f'statement-export-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, timeout=10):
+        for _ in self.threads:
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, client_id, date_from, date_to):
+        """Queues a statement and returns its job id, or None when the queue is full."""
+        self.start()
+        self.cleanup()
+        job_id = f"client_{client_id}_{uuid.uuid4().hex}"
+        try:
+            self.queue.put_nowait((job_id, client_id, date_from, date_to))
+        except queue.Full:
+            return None
+        (EXPORT_DIR / f"{job_id}.part").touch()
+        return job_id
+
+    @staticmethod
+    def cleanup():
+        cutoff = time.time() - app.config['EXPORT_MAX_AGE']
+        for entry in os.scandir(EXPORT_DIR):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is self._STOP:
+                break
+            self.render(*job)
+
+    @staticmethod
+    def render(job_id, client_id, date_from, date_to):
+        temp_path = EXPORT_DIR / f"{job_id}.part"
+        try:
+            with db_connection() as conn:
+                client = conn.execute('SELECT * FROM customers WHERE id = ?', (client_id,)).fetchone()
+                if not client:
+                    raise ValueError('Client introuvable')
+                build_client_statement(conn, client, str(temp_path), date_from, date_to)
+            os.replace(str(temp_path), str(EXPORT_DIR / f"{job_id}.pdf"))
+        except Exception as e:
+            (EXPORT_DIR / f"{job_id}.error").write_text(str(e))
+            if temp_path.exists():
+                temp_path.unlink()
+
+statement_exporter = StatementExporter()
+
+@app.route('/export_client_pdf/<int:client_id>')
+@login_required
+def export_client_pdf(client_id):
+    date_from = request.args.get('date_from', '')
+    date_to = request.args.get('date_to', '')
+    
+    with db_connection() as conn:
+        client = conn.execute('SELECT * FROM customers WHERE id = ?', (client_id,)).fetchone()
+        if not client:
+            flash('Client introuvable', 'danger')
+            return redirect(url_for('manage_clients'))
+        
+        # Full history: render in the background and let the user fetch it later
+        if request.args.get('full'):
+            job_id = statement_exporter.submit(client_id, date_from, date_to)
+            if not job_id:
+                flash('Trop d\'exports en cours, réessayez dans quelques instants.', 'warning')
+                return redirect(url_for('client_details', client_id=client_id))
+            flash('Export de l\'historique complet en cours.', 'info')
+            return redirect(url_for('client_details', client_id=client_id, export_job=job_id))
+        
+        limit = min(max(request.args.get('limit', app.config['CLIENT_PDF_MAX_ROWS'], type=int), 1),
+                    app.config['CLIENT_PDF_MAX_ROWS'])
+        # Spooled to disk rather than held in a BytesIO
+        output = tempfile.TemporaryFile()
+        build_client_statement(conn, client, output, date_from, date_to, limit)
     
+    output.seek(0)
     return send_file(
-        buffer,
+        output,
         as_attachment=True,
-        download_name=f"fiche_client_{client['name']}_{datetime.now().strftime('%Y%m%d')}.pdf",
+        download_name=client_statement_filename(client),
         mimetype='application/pdf'
     )
 
+@app.route('/export_client_pdf/<int:client_id>/job/<job_id>')
+@login_required
+def client_pdf_job(client_id, job_id):
+    job_id = secure_filename(job_id)
+    if not job_id.startswith(f"client_{client_id}_"):
+        flash('Export introuvable', 'danger')
+        return redirect(url_for('client_details', client_id=client_id))
+    
+    pdf_path = EXPORT_DIR / f"{job_id}.pdf"
+    error_path = EXPORT_DIR / f"{job_id}.error"
+    if pdf_path.exists():
+        with db_connection() as conn:
+            client = conn.execute('SELECT * FROM customers WHERE id = ?', (client_id,)).fetchone()
+        if not client:
+            flash('Client introuvable', 'danger')
+            return redirect(url_for('manage_clients'))
+        return send_file(
+            str(pdf_path),
+            as_attachment=True,
+            download_name=client_statement_filename(client),
+            mimetype='application/pdf'
+        )
+    if error_path.exists():
+        flash(f'Erreur: {error_path.read_text()}', 'danger')
+    elif (EXPORT_DIR / f"{job_id}.part").exists():
+        flash('Export toujours en cours, réessayez dans quelques instants.', 'info')
+    else:
+        flash('Export introuvable', 'danger')
+    return redirect(url_for('client_details', client_id=client_id, export_job=job_id))
+
 # Product Management Routes
 @app.route('/manage_products')
 @admin_required
@@ -1214,10 +5028,11 @@ def add_product():
         
         with db_connection() as conn:
             try:
-                conn.execute('''
+                product_id = conn.execute('''
                 INSERT INTO products (name, family, category) 
                 VALUES (?, ?, ?)
-                ''', (name, family, category))
+                ''', (name, family, category)).lastrowid
+                conn.execute('INSERT INTO inventory (product_id, quantity) VALUES (?, 0)', (product_id,))
                 conn.commit()
                 flash('Produit ajouté', 'success')
             except sqlite3.Error as e:
@@ -1340,12 +5155,111 @@ def delete_user(user_id):
 @app.route('/backup_db')
 @admin_required
 def create_backup():
-    try:
-        backup_path = backup_db()
-        flash(f'Sauvegarde créée: {backup_path}', 'success')
-    except Exception as e:
-        flash(f'Erreur: {str(e)}', 'danger')
+    if backup_lock.locked():
+        flash('Une sauvegarde est déjà en cours', 'warning')
+    else:
+        Thread(target=run_backup_job, name='backup', daemon=True).start()
+        flash(f'Sauvegarde lancée en arrière-plan dans {BACKUP_DIR}', 'success')
     return redirect(url_for('home'))
 
+@app.route('/admin/reconciliation', methods=['GET', 'POST'])
+@admin_required
+def admin_reconciliation():
+    if request.method == 'POST':
+        try:
+            with db_connection() as conn:
+                run = reconcile_inventory(conn, full=bool(request.form.get('full')),
+                                          repair=bool(request.form.get('repair')))
+        except Exception as e:
+            flash(f'Erreur: {str(e)}', 'danger')
+            return redirect(url_for('admin_reconciliation'))
+        if not run['drift']:
+            flash(f"{run['checked']} produit(s) vérifié(s): aucun écart", 'success')
+        elif run['repaired']:
+            flash(f"{len(run['drift'])} écart(s) corrigé(s)", 'success')
+        else:
+            flash(f"{len(run['drift'])} écart(s) détecté(s)", 'warning')
+        return redirect(url_for('admin_reconciliation', run=run['id']))
+    
+    with db_connection() as conn:
+        runs = conn.execute('SELECT * FROM reconcile_runs ORDER BY id DESC LIMIT 50').fetchall()
+        # Show the requested run, or else the latest one that found drift
+        run_id = request.args.get('run', type=int) or next((run['id'] for run in runs if run['drifted']), None)
+        drift = reconcile_drift_rows(conn, run_id) if run_id else []
+    return render_template('reconciliation.html', runs=runs, run_id=run_id, drift=drift,
+                           interval=app.config['RECONCILE_INTERVAL'],
+                           auto_repair=app.config['RECONCILE_AUTO_REPAIR'])
+
+# Metrics
+@app.route('/metrics')
+def metrics():
+    if not app.config['PROFILING_ENABLED']:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    authorized = session.get('role') == 'admin' or (
+        token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'))
+    if not authorized:
+        return Response('Authentication required\n', status=401, mimetype='text/plain')
+    return Response(profiler.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    return render_template('metrics.html',
+                           enabled=app.config['PROFILING_ENABLED'],
+                           routes=profiler.summary(),
+                           traces=profiler.traces(),
+                           mail=mail_queue.metrics())
+
+@app.route('/admin/metrics/reset', methods=['POST'])
+@admin_required
+def reset_metrics():
+    profiler.reset()
+    flash('Métriques réinitialisées', 'success')
+    return redirect(url_for('admin_metrics'))
+
+@app.route('/admin/slow_queries')
+@admin_required
+def admin_slow_queries():
+    entries = slow_query_log.entries()
+    groups = slow_query_log.summary(entries)
+    if request.args.get('scans'):
+        groups = [group for group in groups if group['full_scan'] or group['temp_sort']]
+    return render_template('slow_queries.html',
+                           threshold=app.config['SLOW_QUERY_THRESHOLD_MS'],
+                           groups=groups,
+                           recent=entries[:50])
+
+@app.route('/admin/metrics/traces/<name>')
+@admin_required
+def download_trace(name):
+    path = PROFILE_DIR / secure_filename(name)
+    if path.suffix != '.prof' or not path.exists():
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=path.name)
+
+# Initialize systems
+with app.app_context():
+    load_asset_manifest()
+    init_db()
+    init_excel_log()
+    movement_writer.start()
+    atexit.register(movement_writer.stop)
+    mail_queue.start()
+    atexit.register(mail_queue.stop)
+    alert_engine.start()
+    atexit.register(alert_engine.stop)
+    backup_scheduler.start()
+    atexit.register(backup_scheduler.stop)
+    snapshot_scheduler.start()
+    atexit.register(snapshot_scheduler.stop)
+    reconciliation_scheduler.start()
+    atexit.register(reconciliation_scheduler.stop)
+    thumbnail_worker.start()
+    atexit.register(thumbnail_worker.stop)
+    statement_exporter.start()
+    atexit.register(statement_exporter.stop)
+    atexit.register(slow_query_log.stop)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
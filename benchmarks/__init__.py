@@ -0,0 +1,19 @@
+"""Benchmarks for the stock management app.
+
+Generate a synthetic database, then time the main routes against it:
+
+    python -m benchmarks generate --scale 1m
+    python -m benchmarks run --scale 1m
+    python -m benchmarks compare before.json after.json
+
+Each scale uses its own data directory (FROZEN_DATA_DIR), so benchmark data
+never touches the real frozen_management_data folder. Runs work on a
+temporary copy of it, so the generated database stays as generated.
+"""
+
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
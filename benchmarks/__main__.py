@@ -0,0 +1,101 @@
+import argparse
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from . import SCALES
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+
+def data_dir_for(args):
+    return Path(args.data_dir or Path.home() / 'frozen_bench' / args.scale)
+
+
+def working_copy(data_dir):
+    """Copies a generated data directory to a temporary one and returns its path.
+
+    Write cases such as add_movement change the database they measure, so
+    every run starts from the generated data rather than the last run's.
+    """
+    copy = Path(tempfile.mkdtemp(prefix='frozen_bench_')) / data_dir.name
+    shutil.copytree(data_dir, copy, ignore=shutil.ignore_patterns('backups', 'exports', 'receipt_cache'))
+    return copy
+
+
+def load_app(data_dir):
+    # app.py reads FROZEN_DATA_DIR at import time
+    os.environ['FROZEN_DATA_DIR'] = str(data_dir)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+    # Keep scheduled backups, snapshots and reconciliation from running in the middle of a measurement
+    app.backup_scheduler.stop()
+    app.snapshot_scheduler.stop()
+    app.reconciliation_scheduler.stop()
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='create a synthetic database')
+    generate.add_argument('--scale', choices=SCALES, default='10k')
+    generate.add_argument('--seed', type=int, default=42)
+    generate.add_argument('--data-dir')
+
+    run = commands.add_parser('run', help='time the main routes')
+    run.add_argument('--scale', choices=SCALES, default='10k')
+    run.add_argument('--data-dir')
+    run.add_argument('--iterations', type=int, default=20)
+    run.add_argument('--routes', nargs='*', help='only run these cases')
+    run.add_argument('--output', help='result file (default: benchmarks/results/<scale>-<time>.json)')
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('before')
+    compare.add_argument('after')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        from .datagen import generate as generate_data
+        app = load_app(data_dir_for(args))
+        started = datetime.now()
+        counts = generate_data(app, SCALES[args.scale], seed=args.seed)
+        print(f"Generated {counts} in {app.DB_PATH} ({(datetime.now() - started).total_seconds():.0f}s)")
+
+    elif args.command == 'run':
+        from .runner import run as run_benchmarks
+        data_dir = data_dir_for(args)
+        if not (data_dir / 'frozen.db').exists():
+            parser.error(f'no database in {data_dir}; run "generate --scale {args.scale}" first')
+        copy = working_copy(data_dir)
+        # Registered before the app's own exit handlers so it runs after they stop
+        atexit.register(shutil.rmtree, copy.parent, ignore_errors=True)
+        app = load_app(copy)
+        report = run_benchmarks(app, iterations=args.iterations, routes=args.routes)
+        report['meta']['scale'] = args.scale
+        report['meta']['data_dir'] = str(data_dir)
+        for name, stats in report['results'].items():
+            print(f"{name:<26}p50 {stats['p50_ms']:>9.1f} ms  p95 {stats['p95_ms']:>9.1f} ms  "
+                  f"p99 {stats['p99_ms']:>9.1f} ms  peak {stats['peak_alloc_kb']:>10.0f} KiB")
+        output = Path(args.output) if args.output else \
+            RESULTS_DIR / f"{args.scale}-{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        print(f'Saved {output}')
+
+    elif args.command == 'compare':
+        from .runner import compare as compare_results
+        before = json.loads(Path(args.before).read_text())
+        after = json.loads(Path(args.after).read_text())
+        print('\n'.join(compare_results(before, after)))
+
+
+if __name__ == '__main__':
+    main()
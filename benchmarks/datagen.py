@@ -0,0 +1,98 @@
+"""Deterministic synthetic data for benchmarks."""
+import random
+from datetime import datetime, timedelta
+
+FAMILIES = ['Poulet', 'Dinde']
+CATEGORIES = ['Whole', 'Cut', 'MSM', 'Offal']
+CUTS = ['Entier', 'Cuisse', 'Filet', 'Aile', 'Pilon', 'Haché', 'Foie', 'Gésier', 'Escalope', 'Manchon']
+VILLES = ['Casablanca', 'Rabat', 'Marrakech', 'Fès', 'Tanger', 'Agadir', 'Meknès', 'Oujda']
+CHUNK_SIZE = 50000
+
+
+def generate(app, movements, seed=42, products=None, customers=None, years=3):
+    """Fills products, customers, movements, inventory, lots and stock snapshots.
+
+    Movements are spread evenly over the last `years` years in id order.
+    Exits are only generated when the product has stock, so inventory never
+    goes negative, and batch codes come from app.calculate_dates() like the
+    add_movement form. Customers are skewed so a few large accounts hold most
+    of the history.
+    """
+    rng = random.Random(seed)
+    n_products = products or max(20, movements // 5000)
+    n_customers = customers or max(10, movements // 200)
+
+    with app.db_connection() as conn:
+        if conn.execute('SELECT 1 FROM movements LIMIT 1').fetchone():
+            raise SystemExit(f'{app.DB_PATH} already has movements; use an empty data directory')
+        conn.execute('PRAGMA synchronous = OFF')
+
+        conn.executemany('INSERT INTO products (name, family, category) VALUES (?, ?, ?)', [
+            (f"{FAMILIES[i % 2]} {CUTS[i % len(CUTS)]} {i:05d}", FAMILIES[i % 2], CATEGORIES[i % len(CATEGORIES)])
+            for i in range(n_products)
+        ])
+        conn.executemany('INSERT INTO customers (name, ville, pays, ice) VALUES (?, ?, ?, ?)', [
+            (f"Client {i:06d}", rng.choice(VILLES), 'Maroc', f"{rng.randrange(10 ** 14, 10 ** 15)}")
+            for i in range(n_customers)
+        ])
+        product_rows = conn.execute('SELECT id, name, category FROM products').fetchall()
+        customer_ids = [row[0] for row in conn.execute('SELECT id FROM customers ORDER BY id')]
+
+        stock = {row['id']: 0 for row in product_rows}
+        dates_cache = {}
+        start = datetime.now() - timedelta(days=365 * years)
+        step = timedelta(days=365 * years) / movements
+        batch = []
+
+        for i in range(movements):
+            date = start + step * i
+            product = product_rows[rng.randrange(len(product_rows))]
+            quantity = rng.randint(1, 50)
+            movement_type = 'Exit' if rng.random() < 0.45 and stock[product['id']] >= quantity else 'Entry'
+            stock[product['id']] += quantity if movement_type == 'Entry' else -quantity
+            if movement_type == 'Exit' or rng.random() < 0.3:
+                customer_id = customer_ids[int(len(customer_ids) * rng.random() ** 3)]
+            else:
+                customer_id = None
+
+            dpj = (date - timedelta(days=rng.randint(0, 3))).strftime('%d/%m/%Y')
+            key = (product['category'], product['name'], dpj)
+            if key not in dates_cache:
+                dates_cache[key] = app.calculate_dates(product['category'], movement_type, product['name'], dpj)
+            dates = dates_cache[key]
+
+            batch.append((product['id'], quantity, customer_id, movement_type, date.isoformat(),
+                          dates['best_before'], dates['batch'], dates['sub_batch'], dpj))
+            if len(batch) >= CHUNK_SIZE:
+                _insert_movements(conn, batch)
+
+        _insert_movements(conn, batch)
+        conn.executemany('''
+        INSERT INTO inventory (product_id, quantity)
+        VALUES (?, ?)
+        ON CONFLICT(product_id) DO UPDATE SET
+        quantity = excluded.quantity
+        ''', list(stock.items()))
+        app.rebuild_lots(conn)
+        app.recount_dashboard_counters(conn)
+        conn.commit()
+        app.take_all_snapshots(conn)
+        conn.execute('ANALYZE')
+        max_id = conn.execute('SELECT MAX(id) FROM movements').fetchone()[0]
+
+    # The generated history does not need to go through the Excel log writer
+    app.EXCEL_LOG_STATE_PATH.parent.mkdir(exist_ok=True)
+    app.EXCEL_LOG_STATE_PATH.write_text(str(max_id))
+    app.excel_log_writer.last_id = max_id
+
+    return {'products': n_products, 'customers': n_customers, 'movements': movements}
+
+
+def _insert_movements(conn, batch):
+    conn.executemany('''
+    INSERT INTO movements (
+        product_id, quantity, customer_id, movement_type, 
+        date, best_before, batch, sub_batch, dpj
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    batch.clear()
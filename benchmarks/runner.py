@@ -0,0 +1,142 @@
+"""Times the main routes through the Flask test client."""
+import gc
+import platform
+import resource
+import sqlite3
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile on sorted values
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def build_cases(app, conn):
+    """Returns [(name, method, url, data, before_each)] for the routes to time."""
+    busiest_client = conn.execute('''
+    SELECT customer_id FROM movements WHERE customer_id IS NOT NULL
+    GROUP BY customer_id ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()[0]
+    median_client = conn.execute('''
+    SELECT customer_id FROM (
+        SELECT customer_id, COUNT(*) AS n FROM movements WHERE customer_id IS NOT NULL
+        GROUP BY customer_id ORDER BY n
+    ) LIMIT 1 OFFSET (SELECT COUNT(DISTINCT customer_id) / 2 FROM movements)
+    ''').fetchone()[0]
+    latest_id = conn.execute('SELECT MAX(id) FROM movements').fetchone()[0]
+    product_id = conn.execute('SELECT id FROM products ORDER BY id LIMIT 1').fetchone()[0]
+    month_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    # Mid-month, so the lot figures need a delta on top of a month-end snapshot
+    last_month_mid = (datetime.now().replace(day=1) - timedelta(days=15)).strftime('%Y-%m-%d')
+    last_year_end = f'{datetime.now().year - 1}-12-31'
+
+    return [
+        ('movements', 'GET', '/movements', None, None),
+        ('movements_filtered', 'GET', f'/movements?date_from={month_ago}&movement_type=Exit', None, None),
+        ('dashboard', 'GET', '/dashboard', None, None),
+        ('inventory', 'GET', '/inventory', None, None),
+        ('inventory_as_of', 'GET', f'/inventory?as_of={last_year_end}', None, None),
+        ('inventory_lots_as_of', 'GET', f'/inventory?as_of={last_month_mid}&lots=1', None, None),
+        ('client_details_median', 'GET', f'/client/{median_client}', None, None),
+        ('client_details_busiest', 'GET', f'/client/{busiest_client}', None, None),
+        ('print_receipt', 'GET', f'/print_receipt/{latest_id}', None, None),
+        ('print_receipt_uncached', 'GET', f'/print_receipt/{latest_id}', None,
+         lambda: app.invalidate_receipt(latest_id)),
+        ('export_client_pdf', 'GET', f'/export_client_pdf/{busiest_client}', None, None),
+        ('add_movement', 'POST', '/add_movement', {
+            'product_id': str(product_id), 'quantity': '1', 'movement_type': 'Entry',
+            'dpj': datetime.now().strftime('%d/%m/%Y'),
+        }, None),
+    ]
+
+
+def run(app, iterations=20, routes=None, username='admin', password='admin123'):
+    """Times each route `iterations` times and measures its peak allocation.
+
+    Returns {'meta': ..., 'results': {name: stats}} ready for json.dump().
+    """
+    # Measure the uncached dashboard rather than the in-process cache
+    app.app.config['DASHBOARD_CACHE_TTL'] = 0
+    client = app.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise SystemExit('Login failed')
+
+    with app.db_connection() as conn:
+        cases = build_cases(app, conn)
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('products', 'customers', 'movements')}
+
+    results = {}
+    for name, method, url, data, before_each in cases:
+        if routes and name not in routes:
+            continue
+
+        def call():
+            if before_each:
+                before_each()
+            if method == 'POST':
+                response = client.post(url, data=data)
+            else:
+                response = client.get(url)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: HTTP {response.status_code}')
+            return response
+
+        call()  # warm-up
+        timings = []
+        for _ in range(iterations):
+            gc.collect()
+            started = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        tracemalloc.start()
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {
+            'url': url,
+            'iterations': iterations,
+            'mean_ms': sum(timings) / len(timings),
+            'p50_ms': percentile(timings, 50),
+            'p95_ms': percentile(timings, 95),
+            'p99_ms': percentile(timings, 99),
+            'max_ms': max(timings),
+            'peak_alloc_kb': peak / 1024,
+        }
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'db_path': str(app.DB_PATH),
+            'counts': counts,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            # KiB on Linux, bytes on macOS
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        'results': results,
+    }
+
+
+def compare(before, after):
+    """Returns printable lines comparing two result files route by route."""
+    lines = [f"{'route':<26}{'p50 before':>12}{'p50 after':>12}{'change':>9}"
+             f"{'p95 before':>12}{'p95 after':>12}{'change':>9}"]
+    for name, new in after['results'].items():
+        old = before['results'].get(name)
+        if not old:
+            continue
+        row = f'{name:<26}'
+        for key in ('p50_ms', 'p95_ms'):
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+            row += f'{old[key]:>12.1f}{new[key]:>12.1f}{change:>+8.0f}%'
+        lines.append(row)
+    return lines
@@ -74,6 +74,9 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Search suggestions for inputs with data-autocomplete="product|customer|batch"
+    document.querySelectorAll('[data-autocomplete]').forEach(setupAutocomplete);
+
     // Dark mode toggle functionality
     const darkModeToggle = document.getElementById('darkModeToggle');
     if (darkModeToggle) {
@@ -89,6 +92,112 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
+// Autocomplete: queries /autocomplete once typing pauses and shows a dropdown.
+// With data-target, the chosen item's id is copied into that (hidden) input.
+// Pages adding inputs later call it for them; each input is set up once.
+function setupAutocomplete(input) {
+    if (input.dataset.autocompleteReady) {
+        return;
+    }
+    input.dataset.autocompleteReady = 'true';
+    const url = document.body.dataset.autocompleteUrl;
+    const target = input.dataset.target ? document.getElementById(input.dataset.target) : null;
+    const menu = document.createElement('div');
+    let timer = null;
+    let controller = null;
+    let items = [];
+    let active = -1;
+
+    menu.className = 'dropdown-menu autocomplete-menu';
+    input.parentNode.style.position = 'relative';
+    input.after(menu);
+    input.setAttribute('autocomplete', 'off');
+
+    function close() {
+        menu.classList.remove('show');
+        active = -1;
+    }
+
+    function choose(item) {
+        input.value = item.label;
+        if (target) {
+            target.value = item.id;
+        }
+        close();
+        input.dispatchEvent(new CustomEvent('autocomplete:select', { detail: item }));
+    }
+
+    function render() {
+        menu.innerHTML = '';
+        items.forEach(function(item, index) {
+            const option = document.createElement('button');
+            option.type = 'button';
+            option.className = 'dropdown-item' + (index === active ? ' active' : '');
+            option.textContent = item.label;
+            if (item.detail) {
+                const detail = document.createElement('small');
+                detail.className = 'text-muted ms-2';
+                detail.textContent = item.detail;
+                option.appendChild(detail);
+            }
+            // mousedown fires before the input's blur closes the menu
+            option.addEventListener('mousedown', function(e) {
+                e.preventDefault();
+                choose(item);
+            });
+            menu.appendChild(option);
+        });
+        menu.classList.toggle('show', items.length > 0);
+    }
+
+    input.addEventListener('input', function() {
+        const q = input.value.trim();
+        if (target) {
+            target.value = '';
+        }
+        clearTimeout(timer);
+        if (q.length < 2) {
+            items = [];
+            close();
+            return;
+        }
+        timer = setTimeout(function() {
+            // Drop the previous request so a slow answer cannot overwrite a newer one
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            fetch(url + '?kind=' + encodeURIComponent(input.dataset.autocomplete) + '&q=' + encodeURIComponent(q),
+                  { signal: controller.signal, credentials: 'same-origin' })
+                .then(function(response) { return response.ok ? response.json() : []; })
+                .then(function(data) {
+                    items = data;
+                    active = -1;
+                    render();
+                })
+                .catch(function() {});
+        }, 250);
+    });
+
+    input.addEventListener('keydown', function(e) {
+        if (!menu.classList.contains('show')) {
+            return;
+        }
+        if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+            e.preventDefault();
+            active = (active + (e.key === 'ArrowDown' ? 1 : items.length - 1)) % items.length;
+            render();
+        } else if (e.key === 'Enter' && active >= 0) {
+            e.preventDefault();
+            choose(items[active]);
+        } else if (e.key === 'Escape') {
+            close();
+        }
+    });
+
+    input.addEventListener('blur', close);
+}
+
 // Ripple effect animation
 var rippleKeyframes = `
 @keyframes ripple {
@@ -141,6 +250,12 @@ styleElement.innerHTML = rippleKeyframes + fadeInKeyframes + `
 
 .animate-fadeIn {
     animation: fadeIn 0.6s ease-out forwards;
+}
+
+.autocomplete-menu {
+    width: 100%;
+    max-height: 300px;
+    overflow-y: auto;
 }`;
 
 document.head.appendChild(styleElement);
\ No newline at end of file